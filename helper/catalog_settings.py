@@ -0,0 +1,41 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# The embedding model, dimension, normalization and distance metric of the vectors stored in the catalog.
+# They are the deployed ones until a catalog rebuild is swapped in, and then the ones of the latest swapped rebuild.
+# The data loading and the search read them from the database, so that right after a swap (or a rollback) they embed
+# with the model of the live vectors, without waiting for a deployment.
+
+# Statuses of a rebuild in the catalog_rebuilds table, see lib/vectordb/db_setup_lambda/catalog_rebuild.py
+STATUS_PREPARED = "prepared"
+STATUS_LOADING = "loading"
+STATUS_LOADED = "loaded"
+STATUS_INDEXED = "indexed"
+STATUS_VALIDATED = "validated"
+STATUS_SWAPPED = "swapped"
+STATUS_CLEANED = "cleaned"
+STATUS_ABORTED = "aborted"
+STATUS_ROLLED_BACK = "rolled_back"
+
+# Statuses of the rebuilds whose vector table is live
+LIVE_REBUILD_STATUSES = [STATUS_SWAPPED, STATUS_CLEANED]
+
+def get_catalog_settings(conn, model_id: str, dimension: int, normalize: bool, distance_metric: str) -> dict:
+    # The arguments are the deployed settings, returned when no rebuild was swapped in
+    settings = {"model_id": model_id, "dimension": int(dimension) if dimension is not None else None, "normalize": normalize, "distance_metric": distance_metric}
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT id, settings FROM catalog_rebuilds WHERE status = ANY(%s) ORDER BY id DESC LIMIT 1;", (LIVE_REBUILD_STATUSES,))
+        row = cur.fetchone()
+    finally:
+        cur.close()
+    if row is None: return settings
+
+    rebuild_id, rebuild_settings = row
+    # A rebuild without model ID was embedded with the deployed model
+    if rebuild_settings.get('model_id'): settings['model_id'] = rebuild_settings['model_id']
+    settings['dimension'] = int(rebuild_settings['dimension'])
+    settings['normalize'] = str(rebuild_settings.get('normalize', normalize)).lower() == "true"
+    settings['distance_metric'] = rebuild_settings.get('vector_index', {}).get('distance_metric', distance_metric)
+    settings['rebuild_id'] = rebuild_id
+    return settings
@@ -0,0 +1,91 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import re
+
+# Size of the chunks and of the overlap between consecutive chunks, in characters.
+# The chunks stay well below the input limit of the embedding model, and each one keeps a focused meaning.
+DEFAULT_CHUNK_SIZE = 1500
+DEFAULT_CHUNK_OVERLAP = 200
+
+PARAGRAPH_BOUNDARY = re.compile(r"\n\s*\n")
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+
+def split_units(text: str, chunk_size: int) -> list:
+    # Sentences of the text, each with the separator that precedes it in the chunk: a blank line between paragraphs, a space otherwise.
+    # A sentence longer than a chunk is cut on whitespace, or hard when it has none.
+    units = []
+    for paragraph in PARAGRAPH_BOUNDARY.split(text.strip()):
+        separator = "\n\n"
+        for sentence in SENTENCE_BOUNDARY.split(paragraph.strip()):
+            sentence = " ".join(sentence.split())
+            while len(sentence) > chunk_size:
+                cut = sentence.rfind(" ", 0, chunk_size + 1)
+                if cut <= 0: cut = chunk_size
+                units.append((separator, sentence[:cut]))
+                sentence = sentence[cut:].lstrip()
+                separator = " "
+            if sentence != "":
+                units.append((separator, sentence))
+                separator = " "
+    return units
+
+def chunk_text(text: str, chunk_size: int = DEFAULT_CHUNK_SIZE, chunk_overlap: int = DEFAULT_CHUNK_OVERLAP) -> list:
+    # Split the text on paragraph and sentence boundaries into chunks of up to chunk_size characters.
+    # Each chunk starts with the last sentences of the previous one, up to chunk_overlap characters, so a meaning spanning
+    # the boundary is in one of the chunks. A text which fits in one chunk is returned as it is.
+    if len(text) <= chunk_size: return [text]
+
+    chunks = []
+    current = []
+    length = 0
+    for separator, sentence in split_units(text, chunk_size):
+        if len(current) > 0 and length + len(separator) + len(sentence) > chunk_size:
+            chunks.append(current)
+            # Carry over the trailing sentences of the chunk which fit in the overlap
+            overlap = []
+            overlap_length = 0
+            for previous in reversed(current):
+                if overlap_length + len(previous[1]) + 1 > chunk_overlap or overlap_length + len(previous[1]) + 1 + len(sentence) > chunk_size: break
+                overlap.insert(0, previous)
+                overlap_length = overlap_length + len(previous[1]) + 1
+            current = overlap
+            length = overlap_length
+        current.append((separator, sentence))
+        length = length + len(separator) + len(sentence)
+    if len(current) > 0: chunks.append(current)
+
+    return ["".join(separator + sentence for separator, sentence in chunk).strip() for chunk in chunks]
+
+class ChunkedEmbeddingClient:
+    # Embeds each text as the list of the embeddings of its chunks, for the "chunked" storage layout.
+    # The chunks of all texts are embedded together, so they share the adaptive concurrency of the wrapped EmbeddingClient.
+    def __init__(self, embedding_client, chunk_size: int = DEFAULT_CHUNK_SIZE, chunk_overlap: int = DEFAULT_CHUNK_OVERLAP):
+        if chunk_overlap >= chunk_size: raise Exception("The chunk overlap must be smaller than the chunk size")
+        self.embedding_client = embedding_client
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+
+    def reset_stats(self):
+        self.embedding_client.reset_stats()
+
+    def stats(self) -> dict:
+        return self.embedding_client.stats()
+
+    def embed(self, text: str) -> list:
+        embeddings = self.embed_many([text])[0]
+        if isinstance(embeddings, Exception): raise embeddings
+        return embeddings
+
+    def embed_many(self, texts: list) -> list:
+        # Returns the chunk embeddings of each text in the same order, or the exception raised when embedding one of its chunks.
+        chunked_texts = [chunk_text(text, self.chunk_size, self.chunk_overlap) for text in texts]
+        embeddings = self.embedding_client.embed_many([chunk for chunks in chunked_texts for chunk in chunks])
+
+        results = []
+        start = 0
+        for chunks in chunked_texts:
+            chunk_embeddings = embeddings[start:start + len(chunks)]
+            start = start + len(chunks)
+            errors = [e for e in chunk_embeddings if isinstance(e, Exception)]
+            results.append(errors[0] if len(errors) > 0 else chunk_embeddings)
+        return results
@@ -0,0 +1,25 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import hashlib
+import unicodedata
+
+# Content is deduplicated per tenant by the hash of its normalized text, in the data loading API and in load_catalog.py.
+
+def get_content_hash(text: str) -> str:
+    # Hash of the normalized text, so that the same content with different whitespace or unicode form is loaded only once.
+    normalized_text = " ".join(unicodedata.normalize("NFC", text).split())
+    return hashlib.sha256(normalized_text.encode("utf-8")).hexdigest()
+
+def find_existing_content_hashes(conn, content_hashes, tenant_id: str) -> set:
+    # Only the partition of the tenant is searched, as content is deduplicated per tenant.
+    # Items of the staged ingest mode which are not merged yet are in the items_staging table, and near-duplicates in item_links.
+    content_hashes = list(content_hashes)
+    cur = conn.cursor()
+    try:
+        cur.execute("""SELECT content_hash FROM items WHERE tenant_id = %s AND content_hash = ANY(%s)
+                       UNION SELECT content_hash FROM items_staging WHERE tenant_id = %s AND content_hash = ANY(%s)
+                       UNION SELECT content_hash FROM item_links WHERE tenant_id = %s AND content_hash = ANY(%s);""",
+                    (tenant_id, content_hashes, tenant_id, content_hashes, tenant_id, content_hashes))
+        return set(r[0] for r in cur.fetchall())
+    finally:
+        cur.close()
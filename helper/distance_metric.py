@@ -0,0 +1,26 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import math
+
+# The distance metric is one setting (distance_metric in lib/app.py) which decides both the operator class of the vector index
+# and the operator in the vector search query. Postgres only uses the index when they match.
+DISTANCE_METRICS = {
+    "l2": {"operator": "<->", "opclass": "vector_l2_ops"},
+    "cosine": {"operator": "<=>", "opclass": "vector_cosine_ops"},
+    # <#> returns the negative inner product, so that ORDER BY ascending still returns the closest items first.
+    "inner_product": {"operator": "<#>", "opclass": "vector_ip_ops"},
+}
+
+def get_distance_metric(name: str) -> dict:
+    if name not in DISTANCE_METRICS:
+        raise Exception(f"Invalid distance metric: {name}. Valid metrics are {list(DISTANCE_METRICS.keys())}")
+    return DISTANCE_METRICS[name]
+
+def get_distance_operator(name: str) -> str:
+    return get_distance_metric(name)["operator"]
+
+def normalize_embedding(embedding: list) -> list:
+    # Unit length vectors rank the same with inner product as with cosine distance, and the inner product is cheaper to compute.
+    norm = math.sqrt(sum(x * x for x in embedding))
+    if norm == 0: return embedding
+    return [x / norm for x in embedding]
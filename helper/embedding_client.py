@@ -0,0 +1,185 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionClosedError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError
+from helper.distance_metric import normalize_embedding
+from helper.embedding_provider import DEFAULT_MODEL_ID, INPUT_TYPE_DOCUMENT, get_embedding_provider, is_local_model
+
+THROTTLING_ERROR_CODES = ["ThrottlingException", "TooManyRequestsException"]
+# Errors which a retry may get past, like the retries of botocore. They are retried without lowering the concurrency limit.
+TRANSIENT_ERROR_CODES = ["ModelNotReadyException", "ServiceUnavailableException", "InternalServerException", "RequestTimeout", "RequestTimeoutException"]
+TRANSIENT_CONNECTION_ERRORS = (ConnectionClosedError, ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError)
+
+def is_transient_error(error: ClientError) -> bool:
+    return error.response.get("Error", {}).get("Code") in TRANSIENT_ERROR_CODES or error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500
+
+class AIMDConcurrencyLimiter:
+    # Additive increase / multiplicative decrease of the number of requests in flight.
+    # The limit grows by 1 after a full window of successful requests, and is cut by decrease_factor on throttling.
+    def __init__(self, initial_limit: int = 4, min_limit: int = 1, max_limit: int = 64, decrease_factor: float = 0.5):
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled: bool = False, failed: bool = False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                self.successes = 0
+            elif failed:
+                # Other failures neither grow nor cut the limit
+                pass
+            else:
+                self.successes += 1
+                if self.successes >= int(self.limit):
+                    self.limit = min(self.max_limit, self.limit + 1)
+                    self.successes = 0
+            self.condition.notify_all()
+
+class TokenBucket:
+    # Caps the request rate, e.g. at the Amazon Bedrock requests-per-minute quota of the account.
+    def __init__(self, rate: float, burst: float = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+class EmbeddingClient:
+    # Calls the text-to-embedding model at the highest sustainable rate. The model is called through an EmbeddingProvider,
+    # e.g. Amazon Titan on Amazon Bedrock or the local embedder, and the texts are sent in batches to the models with a batch API.
+    # Concurrency is adapted with AIMD on ThrottlingException, and the rate can be capped with a token bucket. Each batch is one request.
+    def __init__(self,
+                 bedrock=None,
+                 model_id: str = DEFAULT_MODEL_ID,
+                 initial_concurrency: int = 4,
+                 max_concurrency: int = 64,
+                 max_requests_per_second: float = None,
+                 max_retries: int = 8,
+                 normalize: bool = False,
+                 dimension: int = None,
+                 input_type: str = INPUT_TYPE_DOCUMENT,
+                 provider=None):
+        if provider is None:
+            # Retries are done here rather than by botocore, so that every throttling is seen by the limiter.
+            # The transient errors which botocore would retry are retried here too.
+            if bedrock is None and not is_local_model(model_id):
+                bedrock = boto3.client("bedrock-runtime", config=Config(retries={"mode": "standard", "max_attempts": 1}))
+            provider = get_embedding_provider(model_id, bedrock=bedrock, dimension=dimension, input_type=input_type)
+        self.provider = provider
+        self.model_id = provider.model_id
+        self.dimension = provider.dimension
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.normalize = normalize # Unit-normalize the embeddings, e.g. for the inner product distance metric
+        self.limiter = AIMDConcurrencyLimiter(initial_limit=min(initial_concurrency, max_concurrency), max_limit=max_concurrency)
+        self.token_bucket = TokenBucket(max_requests_per_second) if max_requests_per_second else None
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.started_at = time.monotonic()
+            self.requests = 0
+            self.successes = 0
+            self.throttles = 0
+            self.embeddings = 0
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            elapsed = time.monotonic() - self.started_at
+            return {
+                "requests": self.requests,
+                "successes": self.successes,
+                "throttles": self.throttles,
+                "embeddings": self.embeddings,
+                "achieved_rps": self.successes / elapsed if elapsed > 0 else 0,
+                "throttle_rate": self.throttles / self.requests if self.requests > 0 else 0,
+                "concurrency_limit": int(self.limiter.limit)
+            }
+
+    def invoke(self, texts: list) -> list:
+        embeddings = self.provider.embed_batch(texts) if len(texts) > 1 else [self.provider.embed(texts[0])]
+        return [normalize_embedding(embedding) for embedding in embeddings] if self.normalize else embeddings
+
+    def embed_batch(self, texts: list) -> list:
+        # Embed the texts in one request, retrying it when throttled or after a transient error
+        for attempt in range(self.max_retries + 1):
+            if self.token_bucket is not None: self.token_bucket.acquire()
+            self.limiter.acquire()
+            throttled = False
+            failed = True
+            try:
+                embeddings = self.invoke(texts)
+                failed = False
+                with self.stats_lock:
+                    self.requests += 1
+                    self.successes += 1
+                    self.embeddings += len(embeddings)
+                return embeddings
+            except ClientError as e:
+                with self.stats_lock:
+                    self.requests += 1
+                throttled = e.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+                if (not throttled and not is_transient_error(e)) or attempt == self.max_retries: raise
+                if throttled:
+                    with self.stats_lock:
+                        self.throttles += 1
+                else:
+                    print(f"Retrying the embedding request after a transient error: {e}")
+            except TRANSIENT_CONNECTION_ERRORS as e:
+                with self.stats_lock:
+                    self.requests += 1
+                if attempt == self.max_retries: raise
+                print(f"Retrying the embedding request after a connection error: {e}")
+            finally:
+                self.limiter.release(throttled=throttled, failed=failed)
+            # Exponential backoff with full jitter before retrying
+            time.sleep(random.uniform(0, min(20, 0.1 * (2 ** attempt))))
+
+    def embed(self, text: str) -> list:
+        return self.embed_batch([text])[0]
+
+    def embed_many(self, texts: list) -> list:
+        # Returns the embedding of each text in the same order, or the exception raised when embedding it.
+        # The texts are embedded in batches of up to max_batch_size of the provider, so a failed request fails its whole batch.
+        batch_size = max(1, self.provider.max_batch_size)
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+
+        def embed_or_error(batch):
+            try:
+                return self.embed_batch(batch)
+            except Exception as e:
+                return [e] * len(batch)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            return [embedding for embeddings in executor.map(embed_or_error, batches) for embedding in embeddings]
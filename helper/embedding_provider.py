@@ -0,0 +1,107 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import hashlib
+import json
+import math
+import re
+
+DEFAULT_MODEL_ID = "amazon.titan-embed-text-v1"
+# Model ID of the local embedder, which runs without Amazon Bedrock, e.g. for offline tests and load tests
+LOCAL_MODEL_ID = "local"
+
+# Input types of the models which embed documents and search queries differently
+INPUT_TYPE_DOCUMENT = "search_document"
+INPUT_TYPE_QUERY = "search_query"
+
+class EmbeddingProvider:
+    # Turns texts into embeddings with one model. embed_batch embeds up to max_batch_size texts in one request,
+    # and falls back to one request per text for the models without a batch API.
+    model_id = None
+    dimension = None
+    max_batch_size = 1
+
+    def embed(self, text: str) -> list:
+        raise NotImplementedError()
+
+    def embed_batch(self, texts: list) -> list:
+        return [self.embed(text) for text in texts]
+
+class TitanEmbeddingProvider(EmbeddingProvider):
+    # Amazon Titan Text Embeddings on Amazon Bedrock. v1 always returns 1536 dimensions, while v2 returns 1024, 512 or 256.
+    def __init__(self, bedrock, model_id: str = DEFAULT_MODEL_ID, dimension: int = None):
+        self.bedrock = bedrock
+        self.model_id = model_id
+        self.is_v2 = model_id.startswith("amazon.titan-embed-text-v2")
+        if self.is_v2:
+            self.dimension = int(dimension) if dimension else 1024
+            if self.dimension not in [256, 512, 1024]: raise Exception(f"{model_id} supports 256, 512 or 1024 dimensions, not {self.dimension}")
+        else:
+            self.dimension = 1536
+            if dimension and int(dimension) != self.dimension: raise Exception(f"{model_id} only supports {self.dimension} dimensions, not {dimension}")
+
+    def embed(self, text: str) -> list:
+        request = {"inputText": text}
+        # The embeddings are normalized by the embedding client if the deployment is configured so
+        if self.is_v2: request = {"inputText": text, "dimensions": self.dimension, "normalize": False}
+        response = self.bedrock.invoke_model(body=json.dumps(request), modelId=self.model_id)
+        # Disabling semgrep rule for checking data size to be loaded to JSON as the source is from Amazon Bedrock
+        # nosemgrep: python.aws-lambda.deserialization.tainted-json-aws-lambda.tainted-json-aws-lambda
+        return json.loads(response.get("body").read())["embedding"]
+
+class CohereEmbeddingProvider(EmbeddingProvider):
+    # Cohere Embed on Amazon Bedrock, which embeds up to 96 texts per request. The documents and the search queries
+    # are embedded with their own input type, so the data loading and the search must each use the matching one.
+    max_batch_size = 96
+
+    def __init__(self, bedrock, model_id: str, input_type: str = INPUT_TYPE_DOCUMENT, dimension: int = None):
+        self.bedrock = bedrock
+        self.model_id = model_id
+        self.input_type = input_type
+        self.dimension = 1024
+        if dimension and int(dimension) != self.dimension: raise Exception(f"{model_id} only supports {self.dimension} dimensions, not {dimension}")
+
+    def embed(self, text: str) -> list:
+        return self.embed_batch([text])[0]
+
+    def embed_batch(self, texts: list) -> list:
+        # The model rejects texts longer than 2048 characters unless asked to truncate them
+        request = {"texts": texts, "input_type": self.input_type, "truncate": "END"}
+        response = self.bedrock.invoke_model(body=json.dumps(request), modelId=self.model_id)
+        # Disabling semgrep rule for checking data size to be loaded to JSON as the source is from Amazon Bedrock
+        # nosemgrep: python.aws-lambda.deserialization.tainted-json-aws-lambda.tainted-json-aws-lambda
+        return json.loads(response.get("body").read())["embeddings"]
+
+class LocalEmbeddingProvider(EmbeddingProvider):
+    # Deterministic embedder which runs on the CPU without any model or network call. Each word and pair of consecutive words
+    # is hashed into one of the dimensions with a sign, so texts sharing words get close embeddings, and the same text
+    # always gets the same embedding. The results are not semantic, so it is only meant for tests and benchmarks.
+    max_batch_size = 256
+
+    def __init__(self, model_id: str = LOCAL_MODEL_ID, dimension: int = None):
+        self.model_id = model_id
+        self.dimension = int(dimension) if dimension else 1536
+
+    def embed(self, text: str) -> list:
+        embedding = [0.0] * self.dimension
+        words = re.findall(r"\w+", text.lower())
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dimension
+            embedding[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(x * x for x in embedding))
+        # An empty text gets a fixed unit vector, as a zero vector has no cosine distance
+        if norm == 0: return [1.0] + [0.0] * (self.dimension - 1)
+        return [x / norm for x in embedding]
+
+def is_local_model(model_id: str) -> bool:
+    return model_id == LOCAL_MODEL_ID or model_id.startswith(LOCAL_MODEL_ID + "-")
+
+def get_embedding_provider(model_id: str = DEFAULT_MODEL_ID, bedrock=None, dimension: int = None, input_type: str = INPUT_TYPE_DOCUMENT) -> EmbeddingProvider:
+    # Provider of the model ID. The Bedrock client is only needed for the Amazon Bedrock models.
+    if is_local_model(model_id):
+        return LocalEmbeddingProvider(model_id, dimension=dimension)
+    if model_id.startswith("amazon.titan-embed-text-"):
+        return TitanEmbeddingProvider(bedrock, model_id, dimension=dimension)
+    if model_id.startswith("cohere.embed-"):
+        return CohereEmbeddingProvider(bedrock, model_id, input_type=input_type, dimension=dimension)
+    raise Exception(f"Unsupported embedding model: {model_id}. Supported models are {LOCAL_MODEL_ID}, amazon.titan-embed-text-v1, amazon.titan-embed-text-v2:0 and cohere.embed-*")
@@ -0,0 +1,38 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import json, re
+
+# A WebSocket client can send many requests on one connection, each with its own ID in this key of the request body.
+# The handlers echo it in the reply, so that the client can match the replies, which arrive in any order, to the requests.
+REQUEST_ID_KEY = "request_id"
+MAX_REQUEST_ID_LENGTH = 128
+
+def get_request_id(parsed_event_body):
+    # Returns the client request ID of the request, or None if it has none or an invalid one
+    if not isinstance(parsed_event_body, dict): return None
+    request_id = parsed_event_body.get(REQUEST_ID_KEY)
+    if not isinstance(request_id, str) or len(request_id) == 0 or len(request_id) > MAX_REQUEST_ID_LENGTH: return None
+    return request_id
+
+# The request ID in the raw text of a body which is not parsed, e.g. as it is too large
+REQUEST_ID_PATTERN = re.compile(r'"' + REQUEST_ID_KEY + r'"\s*:\s*"([^"\\]{1,' + str(MAX_REQUEST_ID_LENGTH) + r'})"')
+
+def find_request_id(event_body):
+    # Returns the first request ID found in the text, or None. It is only used to tag the error reply of a request which cannot be parsed.
+    if not isinstance(event_body, str): return None
+    match = REQUEST_ID_PATTERN.search(event_body)
+    return match.group(1) if match is not None else None
+
+def tag_reply(body: str, status_code: int, request_id: str) -> str:
+    # The reply as a JSON object with the request ID and the status code, which a WebSocket message does not have otherwise.
+    # A JSON object body keeps its keys, and any other body is put in "message".
+    try:
+        # Disabling semgrep rule for checking data size to be loaded to JSON as the body is built by the handler itself.
+        # nosemgrep: python.aws-lambda.deserialization.tainted-json-aws-lambda.tainted-json-aws-lambda
+        tagged = json.loads(body)
+    except json.JSONDecodeError:
+        tagged = None
+    if not isinstance(tagged, dict): tagged = {"message": body}
+    tagged[REQUEST_ID_KEY] = request_id
+    tagged["status_code"] = status_code
+    return json.dumps(tagged)
@@ -0,0 +1,212 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import asyncio
+import datetime
+import functools
+import hashlib
+import json
+import random
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import requests
+from requests.adapters import HTTPAdapter
+from helper.presigned_url import AWSAPIWebSocketPresignedURL
+
+# Statuses of the requests which API Gateway or the function did not process, e.g. when throttled or when the function was unavailable
+RETRYABLE_STATUS_CODES = [429, 500, 502, 503, 504]
+# A throttled request was rejected before reaching the function, so it is retried even when it is not idempotent
+THROTTLED_STATUS_CODE = 429
+IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS", "PUT", "DELETE"]
+
+# A bulk request must stay below the body size limit of the data loading function
+MAX_BULK_BODY_SIZE = 5000000
+
+@functools.lru_cache(maxsize=32)
+def get_signing_key(secret_key: str, date_stamp: str, region: str, service: str) -> bytes:
+    # The signing key only changes with the date, the credentials, the region and the service,
+    # so its four HMACs are computed once per day instead of once per request
+    return AWSAPIWebSocketPresignedURL.get_signature_key(secret_key, date_stamp, region, service)
+
+class SigV4Signer():
+    # Signs requests to API Gateway with AWS Signature Version 4 in the Authorization header
+    def __init__(self, session, region: str, service: str = "execute-api"):
+        self.session = session
+        self.region = region
+        self.service = service
+
+    def sign(self, method: str, url: str, body: bytes = b"") -> dict:
+        # Returns the headers to send with the request. The URL is the final one of the prepared request, with its query string,
+        # so that the signature covers exactly what is sent. The credentials are read for each request, as they may have been refreshed.
+        credentials = self.session.get_credentials().get_frozen_credentials()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+        date_stamp = now.strftime("%Y%m%d")
+
+        parsed_url = urllib.parse.urlsplit(url)
+        host = parsed_url.netloc
+        # The path as sent is already URI-encoded, and is encoded again as for all services other than Amazon S3
+        canonical_uri = urllib.parse.quote(parsed_url.path or "/", safe="/~")
+        # Each name and value is decoded as sent and URI-encoded the way of SigV4, then the pairs are sorted by name and value
+        query = [pair.partition("=") for pair in parsed_url.query.split("&") if pair != ""]
+        query = sorted((urllib.parse.quote(urllib.parse.unquote(k), safe='-_.~'), urllib.parse.quote(urllib.parse.unquote(v), safe='-_.~')) for k, _, v in query)
+        canonical_querystring = "&".join(f"{k}={v}" for k, v in query)
+
+        headers = {"host": host, "x-amz-date": amz_date}
+        if credentials.token: headers["x-amz-security-token"] = credentials.token
+        signed_headers = ";".join(sorted(headers))
+        canonical_headers = "".join(f"{k}:{headers[k]}\n" for k in sorted(headers))
+        payload_hash = hashlib.sha256(body).hexdigest()
+
+        canonical_request = f"{method}\n{canonical_uri}\n{canonical_querystring}\n{canonical_headers}\n{signed_headers}\n{payload_hash}"
+        credential_scope = f"{date_stamp}/{self.region}/{self.service}/aws4_request"
+        string_to_sign = f"AWS4-HMAC-SHA256\n{amz_date}\n{credential_scope}\n{hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()}"
+        signing_key = get_signing_key(credentials.secret_key, date_stamp, self.region, self.service)
+        signature = AWSAPIWebSocketPresignedURL.get_keyed_hash(signing_key, string_to_sign).hex()
+
+        headers["Authorization"] = f"AWS4-HMAC-SHA256 Credential={credentials.access_key}/{credential_scope}, SignedHeaders={signed_headers}, Signature={signature}"
+        del headers["host"]
+        return headers
+
+class RecommenderAPIError(Exception):
+    def __init__(self, status_code, body):
+        super().__init__(f"Request failed with status {status_code}: {body[:500]}")
+        self.status_code = status_code
+        self.body = body
+
+class RecommenderClient():
+    # Client of the REST API for services which call it often. The connections are kept alive in a pool shared by all requests,
+    # so only the first requests pay for the TCP and TLS handshakes, and the SigV4 signing key is cached for the day.
+    # The requests are retried with exponential backoff when throttled or when the API is unavailable,
+    # but the requests which are not idempotent, e.g. an asynchronous ingest which creates a job, are only retried when throttled.
+    # Each method has an asyncio counterpart prefixed with "a", which runs it in the thread pool of the client. e.g.
+    #   client = RecommenderClient(api_url)
+    #   results = client.recommend_many(texts, num_items=3)
+    #   results = await client.arecommend_many(texts, num_items=3)
+    def __init__(self, api_url: str, session=None, region: str = None, max_connections: int = 32,
+                 timeout: float = 45, max_retries: int = 4):
+        self.api_url = api_url
+        self.session = session if session is not None else boto3.Session()
+        self.signer = SigV4Signer(self.session, region or self.session.region_name)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.max_connections = max_connections
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+        # Runs the concurrent requests of the batch helpers and of the asyncio interface, one per pooled connection
+        self.executor = ThreadPoolExecutor(max_workers=max_connections)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.http.close()
+
+    def request(self, method: str, payload=None, params: dict = None, body: str = None, idempotent: bool = None):
+        # Sends one request and returns the parsed JSON reply, or the text of a reply which is not JSON
+        if idempotent is None: idempotent = method in IDEMPOTENT_METHODS
+        if body is None: body = json.dumps(payload) if payload is not None else ""
+        body = body.encode("utf-8")
+
+        # The query string is encoded the way of SigV4, e.g. spaces as %20 rather than +, so that it is sent as it is signed
+        url = self.api_url
+        if params: url = url + ("&" if "?" in url else "?") + urllib.parse.urlencode(params, quote_via=urllib.parse.quote, safe="-_.~")
+        prepared = self.http.prepare_request(requests.Request(method, url, data=body, headers={"Content-Type": "application/json"}))
+        settings = self.http.merge_environment_settings(prepared.url, {}, None, None, None)
+
+        for attempt in range(self.max_retries + 1):
+            # Signed again for each attempt, as the signature is only valid for a few minutes
+            prepared.headers.update(self.signer.sign(prepared.method, prepared.url, prepared.body or b""))
+            try:
+                response = self.http.send(prepared, timeout=self.timeout, **settings)
+            except requests.exceptions.ConnectionError:
+                # The request may have been processed if the connection broke after it was sent
+                if not idempotent or attempt == self.max_retries: raise
+            else:
+                if response.status_code < 400:
+                    try:
+                        return response.json()
+                    except ValueError:
+                        return response.text
+                retryable = response.status_code == THROTTLED_STATUS_CODE or (idempotent and response.status_code in RETRYABLE_STATUS_CODES)
+                if not retryable or attempt == self.max_retries: raise RecommenderAPIError(response.status_code, response.text)
+            # Exponential backoff with full jitter before retrying
+            time.sleep(random.uniform(0, min(20, 0.2 * (2 ** attempt))))
+
+    def recommend(self, text: str, **parameters) -> dict:
+        # e.g. client.recommend(text, num_items=3, search_mode="direct", tenant_id="default").
+        # The search only reads, so it is retried although it is a POST.
+        return self.request("POST", {"text": text, **parameters}, idempotent=True)
+
+    def ingest(self, text: str, asynchronous: bool = False, **parameters):
+        # Loading the same text again is skipped by its content hash, so the synchronous ingest is retried.
+        # The asynchronous ingest creates a new job for each request, so it is not.
+        payload = {"text": text, **parameters}
+        if asynchronous: payload["async"] = True
+        return self.request("PUT", payload, idempotent=not asynchronous)
+
+    def get_job(self, job_id: str) -> dict:
+        # The status and the per-item results of an asynchronous ingest job, e.g. of the job_id returned by ingest(text, asynchronous=True)
+        return self.request("GET", params={"job_id": job_id})
+
+    def ingest_bulk(self, items: list, tenant_id: str = None, asynchronous: bool = False, batch_size: int = 500) -> list:
+        # Loads the items, e.g. [{"text": ...}], in bulk requests of up to batch_size items, sent concurrently.
+        # Returns the reply of each bulk request, or the exception raised for it.
+        return self.run_many(lambda body: self.request("PUT", body=body, idempotent=not asynchronous), get_bulk_bodies(items, tenant_id, asynchronous, batch_size))
+
+    def recommend_many(self, texts: list, **parameters) -> list:
+        # Returns the reply for each text in the same order, or the exception raised for it
+        return self.run_many(lambda text: self.recommend(text, **parameters), texts)
+
+    def run_many(self, function, inputs) -> list:
+        def call_or_error(value):
+            try:
+                return function(value)
+            except Exception as e:
+                return e
+        return list(self.executor.map(call_or_error, inputs))
+
+    async def run_async(self, function, *args, **kwargs):
+        # Runs a blocking call in the thread pool, so at most max_connections calls run at once
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(function, *args, **kwargs))
+
+    async def arecommend(self, text: str, **parameters) -> dict:
+        return await self.run_async(self.recommend, text, **parameters)
+
+    async def aingest(self, text: str, asynchronous: bool = False, **parameters):
+        return await self.run_async(self.ingest, text, asynchronous=asynchronous, **parameters)
+
+    async def arecommend_many(self, texts: list, **parameters) -> list:
+        return await asyncio.gather(*[self.arecommend(text, **parameters) for text in texts], return_exceptions=True)
+
+    async def aingest_bulk(self, items: list, tenant_id: str = None, asynchronous: bool = False, batch_size: int = 500) -> list:
+        bodies = get_bulk_bodies(items, tenant_id, asynchronous, batch_size)
+        return await asyncio.gather(*[self.run_async(self.request, "PUT", body=body, idempotent=not asynchronous) for body in bodies], return_exceptions=True)
+
+def get_bulk_bodies(items: list, tenant_id: str, asynchronous: bool, batch_size: int) -> list:
+    # JSON bodies with an "items" array of up to batch_size items, below MAX_BULK_BODY_SIZE bytes
+    options = ""
+    if tenant_id is not None: options = options + f', "tenant_id": {json.dumps(tenant_id)}'
+    if asynchronous: options = options + ', "async": true'
+
+    bodies = []
+    batch = []
+    size = 0
+    for item in items:
+        serialized_item = json.dumps(item)
+        if len(batch) > 0 and (len(batch) >= batch_size or size + len(serialized_item) + 1 > MAX_BULK_BODY_SIZE):
+            bodies.append('{"items": [' + ",".join(batch) + "]" + options + "}")
+            batch = []
+            size = 0
+        batch.append(serialized_item)
+        size = size + len(serialized_item) + 1
+    if len(batch) > 0: bodies.append('{"items": [' + ",".join(batch) + "]" + options + "}")
+    return bodies
@@ -0,0 +1,50 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import os
+import time
+
+try:
+    # Part of the AWS Lambda Python runtimes which support SnapStart
+    from snapshot_restore_py import register_after_restore, register_before_snapshot
+except ImportError:
+    register_after_restore = None
+    register_before_snapshot = None
+
+# With SnapStart, the function is initialized once when a version is published, and its memory is snapshotted.
+# New execution environments are restored from the snapshot instead of running the initialization again,
+# so the imports and the configuration are already done. The network connections and the credentials in the snapshot
+# would be shared by all restored environments and stale, so they are closed before the snapshot and opened again after each restore.
+
+def is_snap_start_init() -> bool:
+    return os.environ.get("AWS_LAMBDA_INITIALIZATION_TYPE") == "snap-start"
+
+class PhaseTimer():
+    # Logs how long each phase of the start of the function takes, e.g. "Phase imports: 850 ms"
+    def __init__(self, started_at: float = None):
+        self.started_at = started_at if started_at is not None else time.monotonic()
+        self.phase_started_at = self.started_at
+
+    def log(self, phase: str):
+        now = time.monotonic()
+        print(f"Phase {phase}: {(now - self.phase_started_at) * 1000:.0f} ms")
+        self.phase_started_at = now
+
+    def log_total(self, phase: str):
+        print(f"Phase {phase}: {(time.monotonic() - self.started_at) * 1000:.0f} ms")
+
+def timed(phase: str, hook):
+    def run_timed():
+        timer = PhaseTimer()
+        hook()
+        timer.log(phase)
+    return run_timed
+
+def before_snapshot(hook, phase: str = "before snapshot"):
+    # Runs the hook before the snapshot is taken. Does nothing without SnapStart.
+    if register_before_snapshot is not None and is_snap_start_init():
+        register_before_snapshot(timed(phase, hook))
+
+def after_restore(hook, phase: str = "after restore"):
+    # Runs the hook in each execution environment restored from the snapshot. Does nothing without SnapStart.
+    if register_after_restore is not None and is_snap_start_init():
+        register_after_restore(timed(phase, hook))
@@ -0,0 +1,33 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import heapq, json
+from itertools import chain
+
+# A catalog too large for the vector index of one cluster is split into shards, each in its own database cluster.
+# The first shard is the cluster of the deployment, and the others are configured as a JSON list of
+# {"writer": ..., "reader": ..., "port": ..., "secret_arn": ...} in the ADDITIONAL_DB_SHARDS environment variable.
+# Each item is stored in the shard chosen by the hash of its content, so loading the same content again goes to the same shard,
+# where it is found and skipped. The order of the shards is part of the routing, so it must not change once items are loaded.
+
+def get_additional_shards(value: str) -> list:
+    if value is None or value.strip() == "": return []
+    shards = json.loads(value)
+    for shard in shards:
+        if "writer" not in shard or "secret_arn" not in shard:
+            raise Exception(f"Each additional database shard must have a \"writer\" endpoint and a \"secret_arn\": {shard}")
+    return shards
+
+def get_shard_index(content_hash: str, shard_count: int) -> int:
+    # The content hash is a SHA-256 hex digest, so its first 64 bits are uniformly distributed
+    return int(content_hash[:16], 16) % shard_count
+
+def group_by_shard(content_hashes: list, shard_count: int) -> dict:
+    # Positions of the content hashes of each shard, as {shard index: [position]}
+    groups = {}
+    for position, content_hash in enumerate(content_hashes):
+        groups.setdefault(get_shard_index(content_hash, shard_count), []).append(position)
+    return groups
+
+def merge_top_k(results_per_shard: list, num_items: int, key: str = "distance") -> list:
+    # The num_items nearest items across the top-k results of all shards, kept in a heap of num_items items
+    return heapq.nsmallest(num_items, chain.from_iterable(results_per_shard), key=lambda item: item[key])
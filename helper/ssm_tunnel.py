@@ -0,0 +1,93 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import atexit
+import shutil
+import socket
+import subprocess
+import threading
+import time
+
+import psycopg2
+
+class SSMTunnel:
+    # Forwards a local port to a host in the VPC, e.g. the Aurora writer, through the bastion host with an AWS Systems Manager session,
+    # so that the notebooks can use regular psycopg2 connections without a network path to the VPC.
+    # The session runs in the background with the AWS CLI and the Session Manager plugin, which must be installed.
+    # It is started again when it ends, e.g. after the idle timeout of Session Manager, and stopped when Python exits.
+    def __init__(self, instance_id: str, remote_host: str, remote_port: int = 5432, local_port: int = None, region: str = None, ready_timeout: float = 30):
+        self.instance_id = instance_id
+        self.remote_host = remote_host
+        self.remote_port = remote_port
+        self.local_port = local_port
+        self.region = region
+        self.ready_timeout = ready_timeout
+        self.process = None
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        with self.lock:
+            if self.is_alive(): return
+            if shutil.which("aws") is None or shutil.which("session-manager-plugin") is None:
+                raise Exception("The AWS CLI and the Session Manager plugin are needed for the tunnel: https://docs.aws.amazon.com/systems-manager/latest/userguide/session-manager-working-with-install-plugin.html")
+            if self.local_port is None: self.local_port = find_free_port()
+
+            command = ["aws", "ssm", "start-session",
+                       "--target", self.instance_id,
+                       "--document-name", "AWS-StartPortForwardingSessionToRemoteHost",
+                       "--parameters", f"host={self.remote_host},portNumber={self.remote_port},localPortNumber={self.local_port}"]
+            if self.region is not None: command = command + ["--region", self.region]
+            self.process = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+
+            # The session is ready when the local port accepts connections
+            deadline = time.monotonic() + self.ready_timeout
+            while time.monotonic() < deadline:
+                if self.process.poll() is not None:
+                    error = self.process.stderr.read().decode("utf-8", errors="replace")
+                    self.process = None
+                    raise Exception(f"The SSM session to {self.remote_host}:{self.remote_port} through {self.instance_id} ended: {error}")
+                if is_port_open(self.local_port):
+                    print(f"Forwarding localhost:{self.local_port} to {self.remote_host}:{self.remote_port} through {self.instance_id}")
+                    return
+                time.sleep(0.2)
+            self.stop_process()
+            raise Exception(f"The SSM session to {self.remote_host}:{self.remote_port} was not ready after {self.ready_timeout} seconds")
+
+    def connect(self, **connect_kwargs):
+        # A regular psycopg2 connection through the tunnel, e.g. tunnel.connect(user=..., password=..., database=...).
+        # The tunnel is started again first if its session ended.
+        self.start()
+        return psycopg2.connect(host="localhost", port=self.local_port, **connect_kwargs)
+
+    def stop_process(self):
+        if self.process is None: return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        self.process = None
+
+    def close(self):
+        with self.lock:
+            self.stop_process()
+
+def find_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+def is_port_open(port: int) -> bool:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.settimeout(0.5)
+        return s.connect_ex(("localhost", port)) == 0
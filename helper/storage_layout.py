@@ -0,0 +1,25 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+# Storage layouts of the catalog.
+# "single": the embeddings are in the items table, next to the descriptions. This is the original layout.
+# "split": the embeddings are in the narrow item_vectors table (id, tenant_id, embedding), and the items table only keeps the descriptions
+# and other content. The vector search then only reads the narrow rows, and joins the descriptions for the final top-k.
+# "chunked": long descriptions are split into overlapping chunks, with one embedding per chunk in the item_chunks table
+# (id, tenant_id, chunk_index, embedding). The search ranks each item by its closest chunk.
+STORAGE_LAYOUT_SINGLE = "single"
+STORAGE_LAYOUT_SPLIT = "split"
+STORAGE_LAYOUT_CHUNKED = "chunked"
+STORAGE_LAYOUTS = [STORAGE_LAYOUT_SINGLE, STORAGE_LAYOUT_SPLIT, STORAGE_LAYOUT_CHUNKED]
+
+# Table holding the embeddings of each storage layout
+VECTOR_TABLES = {
+    STORAGE_LAYOUT_SINGLE: "items",
+    STORAGE_LAYOUT_SPLIT: "item_vectors",
+    STORAGE_LAYOUT_CHUNKED: "item_chunks"
+}
+
+def get_vector_table(storage_layout: str) -> str:
+    if storage_layout not in VECTOR_TABLES:
+        raise Exception(f"Invalid storage layout: {storage_layout}. Valid layouts are {STORAGE_LAYOUTS}")
+    return VECTOR_TABLES[storage_layout]
@@ -0,0 +1,24 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import re
+
+# Each tenant (e.g. a brand) has its own catalog, stored in its own partition of the items table with its own vector index.
+# Items loaded or searched without a tenant ID belong to the default tenant, which also holds the items loaded before tenants existed.
+DEFAULT_TENANT = "default"
+
+# Tenant IDs become part of the partition and index names and are written into the query templates, so only a safe subset is allowed.
+# Partition and index names must stay within the 63 characters of a PostgreSQL identifier.
+TENANT_ID_PATTERN = re.compile(r"^[a-z][a-z0-9_]{0,31}$")
+# Partitions are named <table>_<tenant ID>, so the tenant IDs which would give the name of another relation are reserved: the staging table
+# (items_staging), the ID sequence (items_id_seq), the partitions of the shadow and previous tables of a catalog rebuild (e.g. items_new_<tenant ID>),
+# and the index and constraint names which PostgreSQL derives from the partition names (e.g. items_<tenant ID>_pkey).
+RESERVED_TENANT_ID_PATTERN = re.compile(r"^(staging|id_seq|(new|old)_.*|.*_(pkey|key|fkey|idx|seq))$")
+
+def is_valid_tenant_id(tenant_id) -> bool:
+    return isinstance(tenant_id, str) and TENANT_ID_PATTERN.match(tenant_id) is not None and RESERVED_TENANT_ID_PATTERN.match(tenant_id) is None
+
+def validate_tenant_id(tenant_id) -> str:
+    if not is_valid_tenant_id(tenant_id):
+        raise Exception(f"Invalid tenant ID: {tenant_id}. Tenant IDs must start with a lowercase letter and have up to 32 lowercase letters, digits or underscores, "
+                        "and must not be staging or id_seq, start with new_ or old_, or end with _pkey, _key, _fkey, _idx or _seq")
+    return tenant_id
@@ -0,0 +1,190 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+import json
+import threading
+import time
+import urllib.parse
+import uuid
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import boto3
+import websocket
+from helper.presigned_url import AWSAPIWebSocketPresignedURL
+from helper.request_id import REQUEST_ID_KEY
+
+# API Gateway closes WebSocket connections after 2 hours, or after 10 minutes without messages.
+# The client moves to a new connection a bit before either happens.
+MAX_CONNECTION_AGE = 2 * 60 * 60 - 300
+MAX_IDLE_TIME = 10 * 60 - 60
+
+class RequestFailed(Exception):
+    def __init__(self, status_code, reply):
+        super().__init__(f"Request failed with status {status_code}: {reply.get('message', reply)}")
+        self.status_code = status_code
+        self.reply = reply
+
+class WebSocketConnection():
+    # One signed connection and the requests waiting for their reply on it.
+    # The replies are read by a background thread and routed to the requests by their ID.
+    def __init__(self, url, connect_timeout):
+        self.ws = websocket.create_connection(url, timeout=connect_timeout)
+        # Reading blocks until a reply comes, the requests have their own timeout
+        self.ws.settimeout(None)
+        self.opened_at = time.monotonic()
+        self.last_used_at = self.opened_at
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.retired = False
+        self.closed = False
+        self.reader = threading.Thread(target=self.read_replies, daemon=True)
+        self.reader.start()
+
+    def is_usable(self, max_connection_age, max_idle_time) -> bool:
+        now = time.monotonic()
+        return not self.closed and not self.retired and now - self.opened_at < max_connection_age and now - self.last_used_at < max_idle_time
+
+    def send(self, request_id, payload) -> Future:
+        future = Future()
+        with self.lock:
+            if self.closed: raise Exception("The WebSocket connection is closed")
+            self.pending[request_id] = future
+            self.last_used_at = time.monotonic()
+            try:
+                self.ws.send(json.dumps(payload))
+            except Exception:
+                self.pending.pop(request_id, None)
+                raise
+        return future
+
+    def cancel(self, request_id):
+        with self.lock:
+            self.pending.pop(request_id, None)
+            self.close_if_drained()
+
+    def retire(self):
+        # No new requests are sent on the connection, and it is closed once the replies of the sent ones are in
+        with self.lock:
+            self.retired = True
+            self.close_if_drained()
+
+    def close_if_drained(self):
+        if self.retired and len(self.pending) == 0 and not self.closed:
+            self.closed = True
+            self.ws.close()
+
+    def read_replies(self):
+        error = None
+        while True:
+            try:
+                message = self.ws.recv()
+            except Exception as e:
+                error = e
+                break
+            if message is None or message == "": continue
+            try:
+                reply = json.loads(message)
+            except json.JSONDecodeError:
+                print(f"Ignoring a reply which is not JSON: {message[:200]}")
+                continue
+            with self.lock:
+                future = self.pending.pop(reply.get(REQUEST_ID_KEY), None) if isinstance(reply, dict) else None
+                self.close_if_drained()
+            if future is None:
+                print(f"Ignoring a reply without a pending request ID: {message[:200]}")
+                continue
+            status_code = reply.get("status_code", 200)
+            if status_code >= 400: future.set_exception(RequestFailed(status_code, reply))
+            else: future.set_result(reply)
+
+        # The replies of the requests still waiting are lost with the connection
+        with self.lock:
+            self.closed = True
+            pending = list(self.pending.values())
+            self.pending = {}
+        for future in pending:
+            future.set_exception(Exception(f"The WebSocket connection was closed before the reply came: {error}"))
+
+class RecommenderWebSocketClient():
+    # Client of the WebSocket API which keeps one signed connection open for many requests, instead of one connection per request.
+    # The requests are sent without waiting for the previous replies, each with a client request ID which the API echoes in its reply.
+    # The presigned URL is only valid for a few minutes to open a connection, so a new URL is signed with the current credentials
+    # for each new connection. A new connection is opened before API Gateway would close the current one for its age or idle time,
+    # and the current one is closed once its replies are in. e.g.
+    #   client = RecommenderWebSocketClient(ws_api_endpoint, ws_api_stage)
+    #   futures = [client.send("inference", {"text": text}) for text in texts]
+    #   replies = [future.result(timeout=60) for future in futures]
+    def __init__(self, endpoint: str, stage: str, session=None, timeout: float = 60, connect_timeout: float = 10,
+                 max_connection_age: float = MAX_CONNECTION_AGE, max_idle_time: float = MAX_IDLE_TIME):
+        self.endpoint = endpoint
+        self.path = f"/{stage}"
+        self.host = urllib.parse.urlparse(endpoint).hostname
+        self.session = session if session is not None else boto3.Session()
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_connection_age = max_connection_age
+        self.max_idle_time = max_idle_time
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_request_url(self) -> str:
+        # Signed with the current credentials, which may have been refreshed since the previous connection
+        credentials = self.session.get_credentials().get_frozen_credentials()
+        url_generator = AWSAPIWebSocketPresignedURL(credentials.access_key, credentials.secret_key, credentials.token,
+                                                    self.endpoint, self.path, self.host, self.session.region_name)
+        return url_generator.get_request_url()
+
+    def get_connection(self) -> WebSocketConnection:
+        with self.lock:
+            if self.connection is None or not self.connection.is_usable(self.max_connection_age, self.max_idle_time):
+                if self.connection is not None: self.connection.retire()
+                self.connection = WebSocketConnection(self.get_request_url(), self.connect_timeout)
+            return self.connection
+
+    def send(self, action: str, payload: dict) -> Future:
+        # Sends the request and returns the future of its reply, without waiting for it
+        request_id = str(uuid.uuid4())
+        connection = self.get_connection()
+        future = connection.send(request_id, {**payload, "action": action, REQUEST_ID_KEY: request_id})
+        future.request_id = request_id
+        future.connection = connection
+        return future
+
+    def request(self, action: str, payload: dict, timeout: float = None) -> dict:
+        future = self.send(action, payload)
+        try:
+            return future.result(timeout=timeout if timeout is not None else self.timeout)
+        except FutureTimeoutError:
+            future.connection.cancel(future.request_id)
+            raise
+
+    def request_many(self, action: str, payloads: list, timeout: float = None) -> list:
+        # Sends all requests at once on the connection, and returns the reply of each one in the same order, or the exception raised for it
+        futures = [self.send(action, payload) for payload in payloads]
+        deadline = time.monotonic() + (timeout if timeout is not None else self.timeout)
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(timeout=max(0, deadline - time.monotonic())))
+            except Exception as e:
+                if isinstance(e, FutureTimeoutError): future.connection.cancel(future.request_id)
+                results.append(e)
+        return results
+
+    def recommend(self, text: str, timeout: float = None, **parameters) -> dict:
+        # e.g. client.recommend(text, num_items=3, search_mode="direct", tenant_id="default")
+        return self.request("inference", {"text": text, **parameters}, timeout=timeout)
+
+    def insert(self, text: str, timeout: float = None, **parameters) -> dict:
+        return self.request("insertdata", {"text": text, **parameters}, timeout=timeout)
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.retire()
+                self.connection = None
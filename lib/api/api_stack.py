@@ -8,6 +8,10 @@ from aws_cdk import (
     aws_logs as logs,
     aws_secretsmanager as secretsmanager,
     aws_s3_deployment as s3deploy,
+    aws_events as events,
+    aws_events_targets as targets,
+    aws_sqs as sqs,
+    aws_lambda_event_sources as lambda_event_sources,
     Aws, Stack, NestedStack, Duration, BundlingOptions
 )
 from cdk_nag import NagSuppressions
@@ -24,6 +28,16 @@ class APIStack(NestedStack):
                  db_reader_endpoint, 
                  database_name: str,
                  db_secret_arn: str,
+                 distance_metric: str,
+                 normalize_embeddings: bool,
+                 storage_layout: str,
+                 embedding_model_id: str,
+                 embedding_dimension: int,
+                 ingest_mode: str,
+                 duplicate_policy: str,
+                 duplicate_min_similarity: float,
+                 inference_snap_start: bool,
+                 additional_db_shards: list,
                  environment,
                  **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
@@ -31,6 +45,10 @@ class APIStack(NestedStack):
         aws_region = Stack.of(self).region
         aws_account_id = Stack.of(self).account
         
+        # Additional clusters of a sharded catalog, see helper/sharding.py
+        additional_db_shards_json = json.dumps(additional_db_shards)
+        db_secret_arns = [db_secret_arn] + [shard["secret_arn"] for shard in additional_db_shards]
+        
         # ====== API COMMON ======
 
         # CloudWatch Logs
@@ -59,7 +77,7 @@ class APIStack(NestedStack):
         api_resource_item = api.root.add_resource(
             'item',
             default_cors_preflight_options=apigw.CorsOptions(
-                allow_methods=['PUT', 'POST', 'OPTIONS'],
+                allow_methods=['GET', 'PUT', 'POST', 'OPTIONS'],
                 allow_origins=apigw.Cors.ALL_ORIGINS)
         )
 
@@ -90,17 +108,26 @@ class APIStack(NestedStack):
         insert_data_route_key = "insertdata"
         
         # Upload the vector insert query template to the bucket
+        # With the "split" storage layout, the default template writes the description and the embedding into their own tables.
+        # With the "chunked" storage layout, it writes the description into items and one embedding per chunk into item_chunks.
+        # With the "staged" ingest mode, it writes into the unindexed staging table of the single and split layouts instead.
+        if ingest_mode == "staged" and storage_layout == "chunked":
+            raise Exception("The staged ingest mode is not supported with the chunked storage layout")
+        if duplicate_policy != "off" and storage_layout == "chunked":
+            raise Exception("The near-duplicate detection is not supported with the chunked storage layout")
+        insert_query_template_source = s3deploy.Source.asset("./vector_insert_query.txt.zip")
+        if ingest_mode == "staged":
+            insert_query_template_source = s3deploy.Source.data("vector_insert_query.txt", open("./vector_insert_query_staged.txt").read())
+        elif storage_layout != "single":
+            insert_query_template_source = s3deploy.Source.data("vector_insert_query.txt", open(f"./vector_insert_query_{storage_layout}.txt").read())
         insert_query_template_upload = s3deploy.BucketDeployment(self, "S3InsertQueryUpload",
-            sources=[s3deploy.Source.asset("./vector_insert_query.txt.zip")],
+            sources=[insert_query_template_source],
             destination_bucket= bucket,
             destination_key_prefix="query/"
         )
         
-        # Define the Lambda function for REST API
-        data_load_function = _lambda.Function(self, f'DataLoadingLambda',
-           handler='lambda-handler.handler',
-           runtime=_lambda.Runtime.PYTHON_3_12,
-           code=_lambda.Code.from_asset('./lib/api/data_loading_lambda',
+        # Code of the data loading Lambda functions, shared by the API and the S3 ingest handlers
+        data_load_code = _lambda.Code.from_asset('./lib/api/data_loading_lambda',
             bundling= BundlingOptions(
               image= _lambda.Runtime.PYTHON_3_12.bundling_image,
               command= [
@@ -109,23 +136,80 @@ class APIStack(NestedStack):
                 'pip install -r requirements.txt -t /asset-output && cp -au . /asset-output',
               ],
             )
-           ),  
+        )
+        
+        # Layer with the helper modules shared with the notebooks, e.g. the adaptive embedding client and the distance metric
+        helper_layer = _lambda.LayerVersion(self, "HelperLayer",
+            code=_lambda.Code.from_asset('./helper',
+                bundling= BundlingOptions(
+                  image= _lambda.Runtime.PYTHON_3_12.bundling_image,
+                  command= [
+                    'bash',
+                    '-c',
+                    'mkdir -p /asset-output/python/helper && cp -au *.py /asset-output/python/helper',
+                  ],
+                )
+            ),
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_12]
+        )
+        
+        # Queue for asynchronous ingest, with a dead-letter queue for the messages which keep failing
+        ingest_dead_letter_queue = sqs.Queue(self, "IngestDeadLetterQueue",
+            encryption=sqs.QueueEncryption.SQS_MANAGED,
+            enforce_ssl=True,
+            retention_period=Duration.days(14)
+        )
+        ingest_queue = sqs.Queue(self, "IngestQueue",
+            encryption=sqs.QueueEncryption.SQS_MANAGED,
+            enforce_ssl=True,
+            visibility_timeout=Duration.minutes(30), # 6 times the timeout of the queue consumer Lambda function
+            dead_letter_queue=sqs.DeadLetterQueue(max_receive_count=3, queue=ingest_dead_letter_queue)
+        )
+        
+        # Results of the asynchronous ingest jobs in the bucket
+        job_results_prefix = "jobs/"
+        
+        # Define the Lambda function for REST API
+        data_load_function = _lambda.Function(self, f'DataLoadingLambda',
+           handler='lambda-handler.handler',
+           runtime=_lambda.Runtime.PYTHON_3_12,
+           code=data_load_code,
+           layers=[helper_layer],
            vpc=vpc,
            vpc_subnets=private_with_egress_subnets,
            timeout=Duration.minutes(15),
            environment = {
                 'DB_WRITER_ENDPOINT': db_writer_endpoint.hostname,
                 'DATABASE_NAME': database_name,
+                'ADDITIONAL_DB_SHARDS': additional_db_shards_json,
                 'TEMPLATE_BUCKET_NAME': bucket.bucket_name,
                 'QUERY_TEMPLATE_OBJECT_PATH': "query/vector_insert_query.txt",
+                'BULK_BATCH_SIZE': "100", # Number of items written to the database in one multi-row insert during bulk ingest.
+                'EMBEDDING_CONCURRENCY': "32", # Maximum number of concurrent calls to the embedding model. The actual number adapts to the Bedrock throttling.
+                'EMBEDDING_MAX_RPS': "0", # Cap on the embedding requests per second e.g. at the account quota. 0 means no cap.
+                'NORMALIZE_EMBEDDINGS': str(normalize_embeddings).lower(),
+                'EMBEDDING_MODEL_ID': embedding_model_id,
+                'EMBEDDING_DIMENSION': str(embedding_dimension),
+                'STORAGE_LAYOUT': storage_layout,
+                'CHUNK_SIZE': "1500", # Characters per chunk of the descriptions with the chunked storage layout
+                'CHUNK_OVERLAP': "200", # Characters shared by consecutive chunks
+                'DUPLICATE_POLICY': duplicate_policy,
+                'DUPLICATE_MIN_SIMILARITY': str(duplicate_min_similarity),
+                'DISTANCE_METRIC': distance_metric,
+                'INGEST_QUEUE_URL': ingest_queue.queue_url,
+                'MAX_SYNC_BULK_ITEMS': "500", # Larger bulk requests are loaded asynchronously, as they would not finish within the API Gateway timeout
+                'JOB_RESULTS_PREFIX': job_results_prefix,
            }
         )
         bucket.grant_read(data_load_function)
+        # The job.json of each asynchronous job, read by the job status lookup
+        bucket.grant_put(data_load_function, f"{job_results_prefix}*")
+        ingest_queue.grant_send_messages(data_load_function)
         
         # Add permission to access Secrets Manager to the Lambda function
         statement = iam.PolicyStatement()
         statement.add_actions("secretsmanager:GetSecretValue")
-        statement.add_resources(db_secret_arn)
+        statement.add_resources(*db_secret_arns)
         data_load_function.add_to_role_policy(statement)
         
         # Add permission to access Bedrock to the Lambda function
@@ -177,9 +261,25 @@ class APIStack(NestedStack):
                 type=apigw.JsonSchemaType.OBJECT,
                 properties={
                     "text": apigw.JsonSchema(type=apigw.JsonSchemaType.STRING),
-                    "additional_query_parameters": apigw.JsonSchema(type=apigw.JsonSchemaType.ARRAY)
+                    "additional_query_parameters": apigw.JsonSchema(type=apigw.JsonSchemaType.ARRAY),
+                    "async": apigw.JsonSchema(type=apigw.JsonSchemaType.BOOLEAN),
+                    "items": apigw.JsonSchema(
+                        type=apigw.JsonSchemaType.ARRAY,
+                        items=apigw.JsonSchema(
+                            type=apigw.JsonSchemaType.OBJECT,
+                            properties={
+                                "text": apigw.JsonSchema(type=apigw.JsonSchemaType.STRING),
+                                "additional_query_parameters": apigw.JsonSchema(type=apigw.JsonSchemaType.ARRAY)
+                            },
+                            required=["text"]
+                        )
+                    )
                 },
-                required=["text"]
+                # Either a single item with "text" or a bulk request with "items"
+                one_of=[
+                    apigw.JsonSchema(required=["text"]),
+                    apigw.JsonSchema(required=["items"])
+                ]
             )
         )
 
@@ -201,10 +301,17 @@ class APIStack(NestedStack):
                     response_parameters={
                         'method.response.header.Access-Control-Allow-Origin': True
                     }
+                ),
+                apigw.MethodResponse(
+                    status_code="202",
+                    response_parameters={
+                        'method.response.header.Access-Control-Allow-Origin': True
+                    }
                 )
             ],
             request_parameters={
-                "method.request.querystring.db": False
+                "method.request.querystring.db": False,
+                "method.request.querystring.async": False
             },
             request_models= {
                 "application/json": data_loading_request_model,
@@ -212,6 +319,24 @@ class APIStack(NestedStack):
             request_validator=data_loading_request_validator
         )
         
+        # Add "GET" method to the API "item" resource, which returns the status and the results of an asynchronous ingest job
+        api_resource_item.add_method(
+            'GET', data_load_api_lambda_integration,
+            authorization_type=apigw.AuthorizationType.IAM,
+            method_responses=[
+                apigw.MethodResponse(
+                    status_code="200",
+                    response_parameters={
+                        'method.response.header.Access-Control-Allow-Origin': True
+                    }
+                )
+            ],
+            request_parameters={
+                "method.request.querystring.job_id": True
+            },
+            request_validator=data_loading_request_validator
+        )
+        
         # API Gateway WS - Lambda integration
         ws_insert_data_integration = apigw2.CfnIntegration(self, "InsertDataIntegration",
             api_id=ws_api.attr_api_id,
@@ -232,6 +357,231 @@ class APIStack(NestedStack):
             { "id": 'AwsSolutions-APIG4', "reason": 'For API Gateway Web Socket, the auth is configured on $connect only, which will protect other routes too.' }
         ])
         
+        # ====== ASYNCHRONOUS INGEST ======
+        # Define the Lambda function which consumes the ingest queue in micro-batches
+        queue_consumer_function = _lambda.Function(self, f'IngestQueueConsumerLambda',
+           handler='queue-consumer-handler.handler',
+           runtime=_lambda.Runtime.PYTHON_3_12,
+           code=data_load_code,
+           layers=[helper_layer],
+           vpc=vpc,
+           vpc_subnets=private_with_egress_subnets,
+           timeout=Duration.minutes(5),
+           environment = {
+                'DB_WRITER_ENDPOINT': db_writer_endpoint.hostname,
+                'DATABASE_NAME': database_name,
+                'ADDITIONAL_DB_SHARDS': additional_db_shards_json,
+                'TEMPLATE_BUCKET_NAME': bucket.bucket_name,
+                'QUERY_TEMPLATE_OBJECT_PATH': "query/vector_insert_query.txt",
+                'INGEST_QUEUE_URL': ingest_queue.queue_url,
+                'JOB_RESULTS_PREFIX': job_results_prefix,
+                'BULK_BATCH_SIZE': "100",
+                'EMBEDDING_CONCURRENCY': "32",
+                'EMBEDDING_MAX_RPS': "0",
+                'NORMALIZE_EMBEDDINGS': str(normalize_embeddings).lower(),
+                'EMBEDDING_MODEL_ID': embedding_model_id,
+                'EMBEDDING_DIMENSION': str(embedding_dimension),
+                'STORAGE_LAYOUT': storage_layout,
+                'CHUNK_SIZE': "1500", # Characters per chunk of the descriptions with the chunked storage layout
+                'CHUNK_OVERLAP': "200", # Characters shared by consecutive chunks
+                'DUPLICATE_POLICY': duplicate_policy,
+                'DUPLICATE_MIN_SIMILARITY': str(duplicate_min_similarity),
+                'DISTANCE_METRIC': distance_metric,
+           }
+        )
+        bucket.grant_read(queue_consumer_function)
+        bucket.grant_put(queue_consumer_function, f"{job_results_prefix}*")
+        
+        # Receive up to 100 messages at once, waiting up to 5 seconds to fill the micro-batch
+        queue_consumer_function.add_event_source(lambda_event_sources.SqsEventSource(ingest_queue,
+            batch_size=100,
+            max_batching_window=Duration.seconds(5),
+            report_batch_item_failures=True
+        ))
+        
+        # Add permission to access Secrets Manager to the Lambda function
+        statement = iam.PolicyStatement()
+        statement.add_actions("secretsmanager:GetSecretValue")
+        statement.add_resources(*db_secret_arns)
+        queue_consumer_function.add_to_role_policy(statement)
+        
+        # Add permission to access Bedrock to the Lambda function
+        statement = iam.PolicyStatement()
+        statement.add_actions("bedrock:InvokeModel")
+        statement.add_resources("*")
+        queue_consumer_function.add_to_role_policy(statement)
+        
+        # Suppress CDK nag rule for using * in IAM policy since for flexibility in choosing Bedrock model and for reading the templates
+        # Suppress CDK nag rule for using managed policy AWSLambdaVPCAccessExecutionRole and AWSLambdaBasicExecutionRole
+        NagSuppressions.add_resource_suppressions(queue_consumer_function, [
+            { "id": 'AwsSolutions-IAM5', "reason": 'Allow  * in the resources string for flexibility in choosing Bedrock model and reading the templates' },
+            { "id": 'AwsSolutions-IAM4', "reason": 'Allow  using managed policy AWSLambdaVPCAccessExecutionRole and AWSLambdaBasicExecutionRole' }
+        ], True)
+        
+        # ====== S3 CATALOG INGEST ======
+        catalog_prefix = "catalog/"
+        checkpoint_prefix = "checkpoints/"
+        
+        # Define the Lambda function which streams catalog files uploaded to S3 into the database
+        s3_ingest_function = _lambda.Function(self, f'S3IngestLambda',
+           handler='s3-ingest-handler.handler',
+           runtime=_lambda.Runtime.PYTHON_3_12,
+           code=data_load_code,
+           layers=[helper_layer],
+           vpc=vpc,
+           vpc_subnets=private_with_egress_subnets,
+           timeout=Duration.minutes(15),
+           memory_size=1024,
+           environment = {
+                'DB_WRITER_ENDPOINT': db_writer_endpoint.hostname,
+                'DATABASE_NAME': database_name,
+                'ADDITIONAL_DB_SHARDS': additional_db_shards_json,
+                'TEMPLATE_BUCKET_NAME': bucket.bucket_name,
+                'QUERY_TEMPLATE_OBJECT_PATH': "query/vector_insert_query.txt",
+                'CATALOG_DELIMITER': "###", # The delimiter of items in the catalog files
+                'CHECKPOINT_PREFIX': checkpoint_prefix,
+                'BULK_BATCH_SIZE': "100",
+                'EMBEDDING_CONCURRENCY': "32",
+                'EMBEDDING_MAX_RPS': "0",
+                'NORMALIZE_EMBEDDINGS': str(normalize_embeddings).lower(),
+                'EMBEDDING_MODEL_ID': embedding_model_id,
+                'EMBEDDING_DIMENSION': str(embedding_dimension),
+                'STORAGE_LAYOUT': storage_layout,
+                'CHUNK_SIZE': "1500", # Characters per chunk of the descriptions with the chunked storage layout
+                'CHUNK_OVERLAP': "200", # Characters shared by consecutive chunks
+                'DUPLICATE_POLICY': duplicate_policy,
+                'DUPLICATE_MIN_SIMILARITY': str(duplicate_min_similarity),
+                'DISTANCE_METRIC': distance_metric,
+           }
+        )
+        bucket.grant_read(s3_ingest_function)
+        bucket.grant_put(s3_ingest_function, f"{checkpoint_prefix}*")
+        
+        # Add permission to access Secrets Manager to the Lambda function
+        statement = iam.PolicyStatement()
+        statement.add_actions("secretsmanager:GetSecretValue")
+        statement.add_resources(*db_secret_arns)
+        s3_ingest_function.add_to_role_policy(statement)
+        
+        # Add permission to access Bedrock to the Lambda function
+        statement = iam.PolicyStatement()
+        statement.add_actions("bedrock:InvokeModel")
+        statement.add_resources("*")
+        s3_ingest_function.add_to_role_policy(statement)
+        
+        # Add permission for the Lambda function to invoke itself to continue a large catalog file from its checkpoint
+        statement = iam.PolicyStatement()
+        statement.add_actions("lambda:InvokeFunction")
+        statement.add_resources(f"arn:aws:lambda:{aws_region}:{aws_account_id}:function:*S3IngestLambda*")
+        s3_ingest_function.add_to_role_policy(statement)
+        
+        # Trigger the ingest when a catalog file is uploaded
+        events.Rule(self, "S3CatalogUploadRule",
+            event_pattern=events.EventPattern(
+                source=["aws.s3"],
+                detail_type=["Object Created"],
+                detail={
+                    "bucket": {"name": [bucket.bucket_name]},
+                    "object": {"key": [{"prefix": catalog_prefix}]}
+                }
+            ),
+            targets=[targets.LambdaFunction(s3_ingest_function, retry_attempts=2)]
+        )
+        
+        # Suppress CDK nag rule for using * in IAM policy since for flexibility in choosing Bedrock model, for reading the catalog files, and for invoking itself
+        # Suppress CDK nag rule for using managed policy AWSLambdaVPCAccessExecutionRole and AWSLambdaBasicExecutionRole
+        NagSuppressions.add_resource_suppressions(s3_ingest_function, [
+            { "id": 'AwsSolutions-IAM5', "reason": 'Allow  * in the resources string for flexibility in choosing Bedrock model, reading catalog files, and invoking itself' },
+            { "id": 'AwsSolutions-IAM4', "reason": 'Allow  using managed policy AWSLambdaVPCAccessExecutionRole and AWSLambdaBasicExecutionRole' }
+        ], True)
+        
+        # ====== STAGING MERGE ======
+        
+        if ingest_mode == "staged":
+            # Define the Lambda function which merges the staging table of the staged ingest mode into the indexed table
+            staging_merge_function = _lambda.Function(self, f'StagingMergeLambda',
+               handler='merge-handler.handler',
+               runtime=_lambda.Runtime.PYTHON_3_12,
+               code=data_load_code,
+               layers=[helper_layer],
+               vpc=vpc,
+               vpc_subnets=private_with_egress_subnets,
+               timeout=Duration.minutes(5),
+               environment = {
+                    'DB_WRITER_ENDPOINT': db_writer_endpoint.hostname,
+                    'DATABASE_NAME': database_name,
+                    'ADDITIONAL_DB_SHARDS': additional_db_shards_json,
+                    'STORAGE_LAYOUT': storage_layout,
+                    'MERGE_BATCH_SIZE': "5000", # Number of staged items moved into the indexed table in one transaction
+               }
+            )
+            
+            # Add permission to access Secrets Manager to the Lambda function
+            statement = iam.PolicyStatement()
+            statement.add_actions("secretsmanager:GetSecretValue")
+            statement.add_resources(*db_secret_arns)
+            staging_merge_function.add_to_role_policy(statement)
+            
+            # Merge periodically. The staging table stays small, so the exact scan of it in the searches stays cheap.
+            events.Rule(self, "StagingMergeSchedule",
+                schedule=events.Schedule.rate(Duration.minutes(1)),
+                targets=[targets.LambdaFunction(staging_merge_function, retry_attempts=0)]
+            )
+            
+            # Suppress CDK nag rule for using managed policy AWSLambdaVPCAccessExecutionRole and AWSLambdaBasicExecutionRole
+            NagSuppressions.add_resource_suppressions(staging_merge_function, [
+                { "id": 'AwsSolutions-IAM4', "reason": 'Allow  using managed policy AWSLambdaVPCAccessExecutionRole and AWSLambdaBasicExecutionRole' }
+            ], True)
+        
+        # ====== CATALOG REBUILD ======
+        
+        # Define the Lambda function which embeds the catalog into the shadow table of a blue/green catalog rebuild.
+        # See lib/vectordb/db_setup_lambda/catalog_rebuild.py for the other steps, run by the vector index admin Lambda function.
+        catalog_reembed_function = _lambda.Function(self, f'CatalogReembedLambda',
+           handler='reembed-handler.handler',
+           runtime=_lambda.Runtime.PYTHON_3_12,
+           code=data_load_code,
+           layers=[helper_layer],
+           vpc=vpc,
+           vpc_subnets=private_with_egress_subnets,
+           timeout=Duration.minutes(15),
+           memory_size=1024,
+           environment = {
+                'DB_WRITER_ENDPOINT': db_writer_endpoint.hostname,
+                'DATABASE_NAME': database_name,
+                'REEMBED_BATCH_SIZE': "200", # Number of items embedded and written to the shadow table at once
+                'EMBEDDING_CONCURRENCY': "64", # The rebuild does not serve traffic, so it can use more of the embedding quota than the data loading
+                'EMBEDDING_MAX_RPS': "0",
+                'EMBEDDING_MODEL_ID': embedding_model_id, # Used unless the rebuild is prepared with another model_id
+           }
+        )
+        self.catalog_reembed_function_name = catalog_reembed_function.function_name
+        
+        # Add permission to access Secrets Manager to the Lambda function
+        statement = iam.PolicyStatement()
+        statement.add_actions("secretsmanager:GetSecretValue")
+        statement.add_resources(db_secret_arn)
+        catalog_reembed_function.add_to_role_policy(statement)
+        
+        # Add permission to access Bedrock to the Lambda function
+        statement = iam.PolicyStatement()
+        statement.add_actions("bedrock:InvokeModel")
+        statement.add_resources("*")
+        catalog_reembed_function.add_to_role_policy(statement)
+        
+        # Add permission for the Lambda function to invoke itself to continue the load where it stopped
+        statement = iam.PolicyStatement()
+        statement.add_actions("lambda:InvokeFunction")
+        statement.add_resources(f"arn:aws:lambda:{aws_region}:{aws_account_id}:function:*CatalogReembedLambda*")
+        catalog_reembed_function.add_to_role_policy(statement)
+        
+        # Suppress CDK nag rule for using * in IAM policy since for flexibility in choosing Bedrock model, and for invoking itself
+        # Suppress CDK nag rule for using managed policy AWSLambdaVPCAccessExecutionRole and AWSLambdaBasicExecutionRole
+        NagSuppressions.add_resource_suppressions(catalog_reembed_function, [
+            { "id": 'AwsSolutions-IAM5', "reason": 'Allow  * in the resources string for flexibility in choosing Bedrock model, and invoking itself' },
+            { "id": 'AwsSolutions-IAM4', "reason": 'Allow  using managed policy AWSLambdaVPCAccessExecutionRole and AWSLambdaBasicExecutionRole' }
+        ], True)
+        
         # ====== INFERENCE ======
         inference_route_key = "inference"
         
@@ -243,8 +593,15 @@ class APIStack(NestedStack):
         )
         
         # Upload the vector search query template to the bucket
+        # With the "split" storage layout, the default template searches the narrow vector table and joins the descriptions of the top-k items.
+        # With the "chunked" storage layout, it searches the chunks and ranks each item by its closest chunk, returning each item once.
+        # With the "staged" ingest mode, it also scans the staging table exactly, so the items which are not merged yet are found too.
+        search_query_template_source = s3deploy.Source.asset("./vector_search_query.txt.zip")
+        if storage_layout != "single" or ingest_mode != "direct":
+            search_query_template_file = "./vector_search_query" + ("" if storage_layout == "single" else f"_{storage_layout}") + ("_staged" if ingest_mode == "staged" else "") + ".txt"
+            search_query_template_source = s3deploy.Source.data("vector_search_query.txt", open(search_query_template_file).read())
         search_query_template_upload = s3deploy.BucketDeployment(self, "S3QueryUpload",
-            sources=[s3deploy.Source.asset("./vector_search_query.txt.zip")],
+            sources=[search_query_template_source],
             destination_bucket= bucket,
             destination_key_prefix="query/"
         )
@@ -266,7 +623,9 @@ class APIStack(NestedStack):
         default_recommendation_parameters = { 
             "num_types": '1', # Number of item types that LLM should recommend given a profile/requirement.
             "num_items": '1', # Number of recommended items to be returned by vector DB during search.
-            "model_id": "anthropic.claude-v2"
+            "model_id": "anthropic.claude-v2",
+            "max_tokens_per_type": 300, # Token budget per item type. The LLM generation is capped at num_types x max_tokens_per_type.
+            "stream_completion": False # Stream the LLM completion and stop it as soon as num_types item types are generated.
         }
         ssm_recommendation_parameter = ssm.StringParameter(self, "RecommendationParameters",
             parameter_name="recommendation",
@@ -288,30 +647,49 @@ class APIStack(NestedStack):
               ],
             )
            ),                                   
+           layers=[helper_layer],
            vpc=vpc,
            vpc_subnets=private_with_egress_subnets,
            timeout=Duration.minutes(5),
            environment = {
                 'DB_READER_ENDPOINT': db_reader_endpoint.hostname,
+                'DB_WRITER_ENDPOINT': db_writer_endpoint.hostname, # Serves the searches when no reader is available
                 'TEMPLATE_BUCKET_NAME': bucket.bucket_name,
                 'PROMPT_TEMPLATE_OBJECT_PATH': "prompt/prompt_template.txt",
                 'QUERY_TEMPLATE_OBJECT_PATH': "query/vector_search_query.txt",
                 'RECOMMENDATION_PARAMETER_NAME': ssm_recommendation_parameter.parameter_name,
                 'LLM_PARAMETER_NAME': ssm_llm_parameter.parameter_name,
-                "DATABASE_NAME": database_name
+                "DATABASE_NAME": database_name,
+                'ADDITIONAL_DB_SHARDS': additional_db_shards_json,
+                'SHARD_TIMEOUT_MS': "3000", # With a sharded catalog, the shards which do not answer in time are left out of the results
+                'DISTANCE_METRIC': distance_metric,
+                'NORMALIZE_EMBEDDINGS': str(normalize_embeddings).lower(),
+                'EMBEDDING_MODEL_ID': embedding_model_id,
+                'EMBEDDING_DIMENSION': str(embedding_dimension),
+                'VECTOR_INDEX_CHECK': "fail", # Fail the start of the function if the vector search cannot use the vector index. "warn" or "off" to relax.
            }
         )
         bucket.grant_read(inference_function)
         
+        # With SnapStart, the APIs invoke an alias of the latest published version, which is restored from its snapshot.
+        # It is set on the underlying CloudFormation resource, which supports the Python runtimes on all versions of the CDK.
+        inference_target = inference_function
+        if inference_snap_start:
+            inference_function.node.default_child.snap_start = _lambda.CfnFunction.SnapStartProperty(apply_on="PublishedVersions")
+            inference_target = _lambda.Alias(self, "InferenceLambdaLiveAlias",
+                alias_name="live",
+                version=inference_function.current_version
+            )
+        
         # Add permission to access Secrets Manager to the Lambda function
         statement = iam.PolicyStatement()
         statement.add_actions("secretsmanager:GetSecretValue")
-        statement.add_resources(db_secret_arn)
+        statement.add_resources(*db_secret_arns)
         inference_function.add_to_role_policy(statement)
         
         # Add permission to access Bedrock to the Lambda function
         statement = iam.PolicyStatement()
-        statement.add_actions("bedrock:InvokeModel")
+        statement.add_actions("bedrock:InvokeModel", "bedrock:InvokeModelWithResponseStream")
         statement.add_resources("*")
         inference_function.add_to_role_policy(statement)
         
@@ -334,7 +712,7 @@ class APIStack(NestedStack):
         inference_function.add_to_role_policy(statement)
        
         # Add resource based policy to allow access from API Gateway WebSocket
-        inference_function.add_permission(id="AllowInferenceFromAPIGWWS", 
+        inference_target.add_permission(id="AllowInferenceFromAPIGWWS", 
                                           principal=iam.ServicePrincipal("apigateway.amazonaws.com"),
                                           action="lambda:InvokeFunction",
                                           source_arn=f"arn:aws:execute-api:{aws_region}:{aws_account_id}:{ws_api.attr_api_id}/*/{inference_route_key}"
@@ -349,7 +727,7 @@ class APIStack(NestedStack):
         
         # API Gateway - Lambda integration
         inference_api_lambda_integration = apigw.LambdaIntegration(
-            inference_function,
+            inference_target,
             integration_responses=[
                 apigw.IntegrationResponse(
                     status_code="200",
@@ -373,7 +751,9 @@ class APIStack(NestedStack):
                     "num_items": apigw.JsonSchema(type=apigw.JsonSchemaType.INTEGER),
                     "num_types": apigw.JsonSchema(type=apigw.JsonSchemaType.INTEGER),
                     "additional_query_parameters": apigw.JsonSchema(type=apigw.JsonSchemaType.ARRAY),
-                    "additional_prompt_parameters": apigw.JsonSchema(type=apigw.JsonSchemaType.ARRAY)
+                    "additional_prompt_parameters": apigw.JsonSchema(type=apigw.JsonSchemaType.ARRAY),
+                    "search_mode": apigw.JsonSchema(type=apigw.JsonSchemaType.STRING, enum=["reasoning", "direct"]),
+                    "latency_tier": apigw.JsonSchema(type=apigw.JsonSchemaType.STRING, enum=["fast", "standard"])
                 },
                 required=["text"]
             )
@@ -412,7 +792,7 @@ class APIStack(NestedStack):
         ws_inference_integration = apigw2.CfnIntegration(self, "InferenceIntegration",
             api_id=ws_api.attr_api_id,
             integration_type="AWS_PROXY",
-            integration_uri=f"arn:aws:apigateway:{aws_region}:lambda:path/2015-03-31/functions/{inference_function.function_arn}/invocations"
+            integration_uri=f"arn:aws:apigateway:{aws_region}:lambda:path/2015-03-31/functions/{inference_target.function_arn}/invocations"
         )
         
         # API Gateway WS - Route
@@ -0,0 +1,319 @@
+import json, re, string, functools
+import boto3
+import psycopg2, psycopg2.errors, psycopg2.extras
+from helper.tenant import DEFAULT_TENANT, validate_tenant_id
+from helper.sharding import get_shard_index, group_by_shard
+from helper.catalog_settings import get_catalog_settings
+from helper.content_hash import get_content_hash, find_existing_content_hashes
+
+# Rows written in one statement by insert_vectors, which bounds the statement size for any batch size
+INSERT_PAGE_SIZE = 100
+
+class Database():
+    def __init__(self, writer, database_name, embedding_dimension=1536, port=5432, secret_id='AuroraClusterCredentials'):
+        self.writer_endpoint = writer
+        self.username = None
+        self.password = None
+        self.port = port
+        self.database_name = database_name
+        self.secret_id = secret_id
+        self.conn = None
+    
+    def fetch_credentials(self):
+        secrets_manager = boto3.client("secretsmanager")
+        credentials = json.loads(secrets_manager.get_secret_value(
+            SecretId=self.secret_id
+        )["SecretString"])
+        self.username = credentials["username"]
+        self.password = credentials["password"]
+    
+    def connect_for_writing(self):
+        if self.username is None or self.password is None: self.fetch_credentials()
+        
+        conn = psycopg2.connect(host=self.writer_endpoint, port=self.port, user=self.username, password=self.password, database=self.database_name)
+        conn.autocommit = True
+        self.conn = conn
+        return conn
+    
+    def close_connection(self):
+        self.conn.close()
+        self.conn = None
+    
+    def get_catalog_settings(self, model_id, dimension, normalize, distance_metric):
+        # The embedding settings of the stored vectors, which a catalog rebuild may have changed since the deployment
+        if self.conn is None:
+            self.connect_for_writing()
+        return get_catalog_settings(self.conn, model_id, dimension, normalize, distance_metric)
+        
+    
+    def find_existing_content_hashes(self, content_hashes, tenant_id=DEFAULT_TENANT):
+        if self.conn is None:
+            self.connect_for_writing()
+        
+        try:
+            return find_existing_content_hashes(self.conn, content_hashes, tenant_id)
+        except (psycopg2.errors.UndefinedColumn, psycopg2.errors.UndefinedTable):
+            print("The items table has no content_hash or tenant_id column, or there is no items_staging or item_links table, so all items are treated as new")
+            return set()
+    
+    def insert_vector(self, query_template, text, embedding, additional_query_parameters=[], content_hash=None, tenant_id=DEFAULT_TENANT):
+        if self.conn is None:
+            self.connect_for_writing()
+        
+        if content_hash is None: content_hash = get_content_hash(text)
+        text = psycopg2.extensions.adapt(text)
+        # The tenant ID is written into the statement, so it must be validated first
+        validate_tenant_id(tenant_id)
+        
+        all_query_parameters = [text, str(embedding)] + additional_query_parameters
+        query_statement = query_template.format(*all_query_parameters, content_hash=content_hash, tenant_id=tenant_id)
+
+        cur = self.conn.cursor()
+
+        # Disabling semgrep rule for raw query as this is meant to be run by admin/engineer with authentication
+        # nosemgrep: python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        response = cur.execute(query_statement)
+        cur.close()
+        self.conn.commit()
+
+        return response
+    
+    def insert_vectors(self, query_template, rows, tenant_id=DEFAULT_TENANT):
+        # Insert many rows of one tenant in one transaction, with multi-row INSERT statements of up to INSERT_PAGE_SIZE rows whose values are bound.
+        # Each row is a tuple of (text, embedding, additional_query_parameters, content_hash).
+        if self.conn is None:
+            self.connect_for_writing()
+        
+        # The tenant ID is written into the statement, so it must be validated first
+        validate_tenant_id(tenant_id)
+        statement, row_template, fields = compile_insert_template(query_template)
+        values = [get_insert_parameters(fields, [text, str(embedding)] + additional_query_parameters, {"content_hash": content_hash, "tenant_id": tenant_id})
+                  for text, embedding, additional_query_parameters, content_hash in rows]
+        
+        self.conn.autocommit = False
+        cur = self.conn.cursor()
+        try:
+            # Disabling semgrep rule for formatted query as the statement is the insert query template of the deployment, with the values bound
+            # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+            psycopg2.extras.execute_values(cur, statement.format(tenant_id=tenant_id), values, template=row_template, page_size=INSERT_PAGE_SIZE)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+            self.conn.autocommit = True
+
+    def find_near_duplicates(self, embeddings, vector_table, distance_operator, min_similarity, tenant_id=DEFAULT_TENANT):
+        # Probe the vector index for the nearest item of each embedding in one query, and return the ones with a cosine similarity
+        # of at least min_similarity as {position: (canonical_id, similarity, source)}. The staging table is scanned exactly,
+        # as it has no vector index. The candidates are found with the operator of the index, so the index is used with every distance metric.
+        if self.conn is None:
+            self.connect_for_writing()
+        
+        cur = self.conn.cursor()
+        # Disabling semgrep rule for formatted query as the table name and the operator come from the deployment configuration.
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"""SELECT n.position, m.id, m.similarity, m.source FROM unnest(%s::text[]) WITH ORDINALITY AS n (probe, position)
+                        CROSS JOIN LATERAL (
+                            (SELECT id, 1 - (embedding <=> n.probe::vector) AS similarity, 'items' AS source FROM {vector_table}
+                             WHERE tenant_id = %s ORDER BY embedding {distance_operator} n.probe::vector LIMIT 1)
+                            UNION ALL
+                            (SELECT id, 1 - (embedding <=> n.probe::vector) AS similarity, 'items_staging' AS source FROM items_staging
+                             WHERE tenant_id = %s ORDER BY embedding {distance_operator} n.probe::vector LIMIT 1)
+                            ORDER BY similarity DESC LIMIT 1) m
+                        WHERE m.similarity >= %s;""",
+                    ([str(embedding) for embedding in embeddings], tenant_id, tenant_id, min_similarity))
+        duplicates = {int(position) - 1: (canonical_id, similarity, source) for position, canonical_id, similarity, source in cur.fetchall()}
+        cur.close()
+        return duplicates
+    
+    def link_items(self, links, tenant_id=DEFAULT_TENANT):
+        # Record near-duplicates in one statement. Each link is a tuple of (content_hash, canonical_id, description, similarity).
+        if self.conn is None:
+            self.connect_for_writing()
+        
+        cur = self.conn.cursor()
+        psycopg2.extras.execute_values(cur,
+            "INSERT INTO item_links (tenant_id, content_hash, canonical_id, description, similarity) VALUES %s ON CONFLICT (tenant_id, content_hash) DO NOTHING;",
+            [(tenant_id, content_hash, canonical_id, description, similarity) for content_hash, canonical_id, description, similarity in links],
+            page_size=len(links))
+        cur.close()
+        self.conn.commit()
+    
+    def link_items_by_content_hash(self, links, tenant_id=DEFAULT_TENANT):
+        # Record near-duplicates of items stored in the same batch, whose IDs are looked up by their content hash.
+        # Each link is a tuple of (content_hash, canonical_content_hash, description, similarity).
+        if self.conn is None:
+            self.connect_for_writing()
+        
+        cur = self.conn.cursor()
+        psycopg2.extras.execute_values(cur,
+            """INSERT INTO item_links (tenant_id, content_hash, canonical_id, description, similarity)
+               SELECT v.tenant_id, v.content_hash, c.id, v.description, v.similarity FROM (VALUES %s) AS v (tenant_id, content_hash, canonical_content_hash, description, similarity)
+               CROSS JOIN LATERAL (SELECT id FROM items WHERE tenant_id = v.tenant_id AND content_hash = v.canonical_content_hash
+                                   UNION ALL SELECT id FROM items_staging WHERE tenant_id = v.tenant_id AND content_hash = v.canonical_content_hash LIMIT 1) c
+               ON CONFLICT (tenant_id, content_hash) DO NOTHING;""",
+            [(tenant_id, content_hash, canonical_content_hash, description, similarity) for content_hash, canonical_content_hash, description, similarity in links],
+            template="(%s, %s, %s, %s, %s::real)",
+            page_size=len(links))
+        cur.close()
+        self.conn.commit()
+    
+    def merge_item(self, canonical_id, source, vector_table, text, embedding, content_hash, similarity, tenant_id=DEFAULT_TENANT):
+        # Replace the description and the embedding of the canonical item with the newer version, in one transaction.
+        # The previous description is linked to the item, so loading it again skips it instead of flipping the item back.
+        if self.conn is None:
+            self.connect_for_writing()
+        
+        table = "items_staging" if source == "items_staging" else "items"
+        if table == vector_table or table == "items_staging":
+            updates = f"updated AS (UPDATE {table} SET description = %s, content_hash = %s, embedding = %s::vector WHERE tenant_id = %s AND id = %s)"
+            parameters = (tenant_id, canonical_id, text, content_hash, str(embedding), tenant_id, canonical_id, similarity)
+        else:
+            updates = f"""updated AS (UPDATE {table} SET description = %s, content_hash = %s WHERE tenant_id = %s AND id = %s),
+                          vectors AS (UPDATE {vector_table} SET embedding = %s::vector WHERE tenant_id = %s AND id = %s)"""
+            parameters = (tenant_id, canonical_id, text, content_hash, tenant_id, canonical_id, str(embedding), tenant_id, canonical_id, similarity)
+        cur = self.conn.cursor()
+        # Disabling semgrep rule for formatted query as the table names come from the deployment configuration.
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"""WITH previous AS (SELECT tenant_id, content_hash, id, description FROM {table} WHERE tenant_id = %s AND id = %s FOR UPDATE), {updates}
+                        INSERT INTO item_links (tenant_id, content_hash, canonical_id, description, similarity)
+                        SELECT tenant_id, content_hash, id, description, %s FROM previous WHERE content_hash IS NOT NULL ON CONFLICT (tenant_id, content_hash) DO NOTHING;""",
+                    parameters)
+        cur.close()
+        self.conn.commit()
+
+class ShardedDatabase():
+    # Catalog split across the databases of several clusters. Each item is written to the shard chosen by its content hash,
+    # and its content is looked up in the same shard, so the deduplication by content hash works as with a single database.
+    # The batch writes are split per shard by write_batch in ingest.py, each shard writing its rows in its own transaction.
+    def __init__(self, shards):
+        self.shards = shards
+    
+    @property
+    def conn(self):
+        # The connection of any connected shard, for the callers which check whether the database is connected
+        return next((shard.conn for shard in self.shards if shard.conn is not None), None)
+    
+    def connect_for_writing(self):
+        for shard in self.shards:
+            if shard.conn is None: shard.connect_for_writing()
+    
+    def close_connection(self):
+        for shard in self.shards:
+            if shard.conn is not None: shard.close_connection()
+    
+    def get_catalog_settings(self, model_id, dimension, normalize, distance_metric):
+        # Catalog rebuilds run on the first shard only
+        return self.shards[0].get_catalog_settings(model_id, dimension, normalize, distance_metric)
+    
+    def get_shard(self, content_hash):
+        return self.shards[get_shard_index(content_hash, len(self.shards))]
+    
+    def group_by_shard(self, content_hashes):
+        # Positions of the content hashes of each shard, as {shard: [position]}
+        return {self.shards[shard_index]: positions for shard_index, positions in group_by_shard(content_hashes, len(self.shards)).items()}
+    
+    def find_existing_content_hashes(self, content_hashes, tenant_id=DEFAULT_TENANT):
+        content_hashes = list(content_hashes)
+        existing_hashes = set()
+        for shard, positions in self.group_by_shard(content_hashes).items():
+            existing_hashes.update(shard.find_existing_content_hashes([content_hashes[i] for i in positions], tenant_id=tenant_id))
+        return existing_hashes
+    
+    def insert_vector(self, query_template, text, embedding, additional_query_parameters=[], content_hash=None, tenant_id=DEFAULT_TENANT):
+        if content_hash is None: content_hash = get_content_hash(text)
+        return self.get_shard(content_hash).insert_vector(query_template, text, embedding, 
+                                                          additional_query_parameters=additional_query_parameters, 
+                                                          content_hash=content_hash, 
+                                                          tenant_id=tenant_id)
+
+def get_database(writer, database_name, additional_shards=[]):
+    # The cluster of the deployment is the first shard, followed by the additional shards in their configured order
+    db = Database(writer=writer, database_name=database_name)
+    if len(additional_shards) == 0: return db
+    return ShardedDatabase([db] + [Database(writer=shard["writer"], 
+                                            database_name=database_name, 
+                                            port=shard.get("port", 5432), 
+                                            secret_id=shard["secret_arn"]) for shard in additional_shards])
+
+# Tokens of SQL: a string constant with '' escapes, an E'' string constant which also has backslash escapes, a dollar-quoted string constant,
+# a quoted identifier, a comment, a word, or any other character
+SQL_TOKEN_PATTERN = re.compile(r"""(?P<escape_string>[eE]'(?:[^'\\]|\\.|'')*')
+                                   |(?P<string>'(?:[^']|'')*')
+                                   |(?P<dollar_string>\$(?P<tag>(?:[A-Za-z_][A-Za-z_0-9]*)?)\$.*?\$(?P=tag)\$)
+                                   |(?P<identifier>"(?:[^"]|"")*")
+                                   |(?P<comment>--[^\n]*|/\*.*?\*/)
+                                   |(?P<word>[A-Za-z_][A-Za-z_0-9$]*)
+                                   |(?P<other>.)""", re.S | re.X)
+
+@functools.lru_cache(maxsize=32)
+def compile_insert_template(query_template):
+    # Turn an insert query template with a "VALUES (...)" row, e.g. "INSERT INTO items (...) VALUES ('{tenant_id}', {0}, '{1}', '{content_hash}') ...;",
+    # into the statement of psycopg2.extras.execute_values, the row template with a %s placeholder for each field of the row, and these fields,
+    # so that the values are bound instead of written into the SQL. A field quoted as a string constant, e.g. '{1}', becomes one placeholder.
+    # The statement may only have the tenant ID field outside the row, which is written into it as in insert_vector.
+    tokens = [(m.lastgroup if m.lastgroup != "tag" else "dollar_string", m.group()) for m in SQL_TOKEN_PATTERN.finditer(query_template)]
+    values_index = next((i for i, (kind, text) in enumerate(tokens) if kind == "word" and text.upper() == "VALUES"), None)
+    if values_index is None: raise Exception("The insert query template must have a VALUES clause for bulk insert")
+    start = next((i for i in range(values_index + 1, len(tokens)) if tokens[i][0] != "comment" and not tokens[i][1].isspace()), None)
+    if start is None or tokens[start] != ("other", "("): raise Exception("The VALUES clause of the insert query template must be followed by a row in parentheses")
+    
+    depth = 0
+    for end in range(start, len(tokens)):
+        if tokens[end] == ("other", "("): depth += 1
+        if tokens[end] == ("other", ")"): depth -= 1
+        if depth == 0: break
+    else:
+        raise Exception("The insert query template has unbalanced parentheses in its VALUES clause")
+    
+    statement = "".join(text for _, text in tokens[:values_index + 1]).replace("%", "%%") + " %s " + "".join(text for _, text in tokens[end + 1:]).replace("%", "%%")
+    try:
+        statement.format(tenant_id=DEFAULT_TENANT)
+    except (IndexError, KeyError):
+        raise Exception("The insert query template may only have the tenant_id field outside the row of its VALUES clause")
+    
+    fields = []
+    row_template = ""
+    # Consecutive words and other characters are joined, so that each field outside a string constant is in one piece
+    row_tokens = []
+    for kind, text in tokens[start:end + 1]:
+        if kind in ["word", "other"]: kind = "code"
+        if kind == "code" and len(row_tokens) > 0 and row_tokens[-1][0] == "code":
+            row_tokens[-1] = (kind, row_tokens[-1][1] + text)
+        else:
+            row_tokens.append((kind, text))
+    for kind, text in row_tokens:
+        if kind == "code":
+            # A field outside a string constant, e.g. {0}, is bound as it is
+            for literal_text, field_name, format_spec, conversion in string.Formatter().parse(text):
+                row_template += literal_text.replace("%", "%%")
+                if field_name is not None:
+                    fields.append((None, field_name, conversion, format_spec))
+                    row_template += "%s"
+            continue
+        if kind in ["string", "dollar_string"]:
+            constant = text[1:-1].replace("''", "'") if kind == "string" else text[text.index("$", 1) + 1:text.rindex("$", 0, -1)]
+            if any(field_name is not None for _, field_name, _, _ in string.Formatter().parse(constant)):
+                fields.append((constant, None, None, None))
+                row_template += "%s"
+                continue
+        elif kind == "escape_string" and any(field_name is not None for _, field_name, _, _ in string.Formatter().parse(text)):
+            raise Exception(f"The insert query template has a field in an E'' string constant, which bulk insert does not support: {text}")
+        row_template += text.replace("{{", "{").replace("}}", "}").replace("%", "%%")
+    return statement, row_template, fields
+
+def get_insert_parameters(fields, args, kwargs):
+    # The values of the fields of a row of compile_insert_template, formatted like str.format does.
+    # A field alone is bound as it is, e.g. a number of the additional query parameters stays a number.
+    formatter = string.Formatter()
+    parameters = []
+    for constant, field_name, conversion, format_spec in fields:
+        if constant is not None:
+            parameters.append(constant.format(*args, **kwargs))
+            continue
+        value = formatter.get_field(field_name, args, kwargs)[0]
+        if conversion or format_spec: value = formatter.format_field(formatter.convert_field(value, conversion), format_spec)
+        parameters.append(value)
+    return tuple(parameters)
@@ -0,0 +1,213 @@
+import json
+from helper.embedding_client import EmbeddingClient
+from helper.chunking import ChunkedEmbeddingClient, DEFAULT_CHUNK_SIZE, DEFAULT_CHUNK_OVERLAP
+from helper.distance_metric import get_distance_operator
+from helper.tenant import DEFAULT_TENANT
+from helper.content_hash import get_content_hash
+from helper.sharding import get_additional_shards
+from helper.storage_layout import STORAGE_LAYOUT_SINGLE, STORAGE_LAYOUT_CHUNKED
+from database import ShardedDatabase, get_database
+from near_duplicates import NearDuplicateDetector, DUPLICATE_POLICY_OFF
+
+class EmbeddingClientCache():
+    # One embedding client per embedding settings of the catalog, see helper/catalog_settings.py. The clients are shared by the invocations
+    # in this execution environment, so the learned concurrency limit is kept between them, and a new one is built after a catalog rebuild swap.
+    def __init__(self, build_client):
+        self.build_client = build_client
+        self.clients = {}
+
+    def get(self, settings):
+        key = (settings['model_id'], settings['dimension'], settings['normalize'])
+        if key not in self.clients:
+            print(f"Embedding with {settings['model_id']}, dimension {settings['dimension']}, normalize {settings['normalize']}")
+            self.clients[key] = self.build_client(*key)
+        return self.clients[key]
+
+class IngestEnvironment():
+    # The setup shared by the Lambda functions which ingest items: their environment variables, the database,
+    # and the embedding client and near-duplicate detector of the current catalog settings, set by apply_catalog_settings().
+    def __init__(self, environ):
+        self.writer_endpoint = environ['DB_WRITER_ENDPOINT']
+        self.database_name = environ['DATABASE_NAME']
+        self.additional_shards = get_additional_shards(environ.get('ADDITIONAL_DB_SHARDS', ''))
+        self.template_bucket_name = environ['TEMPLATE_BUCKET_NAME']
+        self.query_template_object_path = environ['QUERY_TEMPLATE_OBJECT_PATH']
+        self.bulk_batch_size = int(environ.get('BULK_BATCH_SIZE', '100'))
+        self.embedding_concurrency = int(environ.get('EMBEDDING_CONCURRENCY', '32'))
+        self.embedding_max_rps = float(environ.get('EMBEDDING_MAX_RPS', '0'))
+        self.normalize_embeddings = environ.get('NORMALIZE_EMBEDDINGS', 'false').lower() == 'true'
+        self.embedding_model_id = environ.get('EMBEDDING_MODEL_ID', 'amazon.titan-embed-text-v1')
+        self.embedding_dimension = int(environ.get('EMBEDDING_DIMENSION', '1536'))
+        self.storage_layout = environ.get('STORAGE_LAYOUT', STORAGE_LAYOUT_SINGLE)
+        self.chunk_size = int(environ.get('CHUNK_SIZE', str(DEFAULT_CHUNK_SIZE)))
+        self.chunk_overlap = int(environ.get('CHUNK_OVERLAP', str(DEFAULT_CHUNK_OVERLAP)))
+        self.duplicate_policy = environ.get('DUPLICATE_POLICY', DUPLICATE_POLICY_OFF)
+        self.duplicate_min_similarity = float(environ.get('DUPLICATE_MIN_SIMILARITY', '0.95'))
+        self.distance_metric = environ.get('DISTANCE_METRIC', 'l2')
+        
+        self.db = get_database(writer=self.writer_endpoint, database_name=self.database_name, additional_shards=self.additional_shards)
+        self.embedding_clients = EmbeddingClientCache(self.build_embedding_client)
+        # Set by apply_catalog_settings()
+        self.embedding_client = None
+        self.near_duplicates = self.build_near_duplicates(self.distance_metric)
+
+    def build_embedding_client(self, model_id, dimension, normalize):
+        embedding_client = EmbeddingClient(model_id=model_id,
+                                           max_concurrency=self.embedding_concurrency,
+                                           max_requests_per_second=self.embedding_max_rps if self.embedding_max_rps > 0 else None,
+                                           normalize=normalize,
+                                           dimension=dimension)
+        if self.storage_layout == STORAGE_LAYOUT_CHUNKED:
+            # One embedding per chunk of the description, written to the item_chunks table by the insert query template of the chunked layout
+            embedding_client = ChunkedEmbeddingClient(embedding_client, chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
+        return embedding_client
+
+    def build_near_duplicates(self, metric):
+        # Probe the vector index for near-duplicates of the new items before inserting them, if enabled
+        if self.duplicate_policy == DUPLICATE_POLICY_OFF: return None
+        return NearDuplicateDetector(self.duplicate_policy, self.duplicate_min_similarity, get_distance_operator(metric), self.storage_layout,
+                                     shard_count=len(self.additional_shards) + 1)
+
+    def apply_catalog_settings(self):
+        # Embed with the settings of the stored vectors, which a catalog rebuild swap may have changed since the deployment
+        settings = self.db.get_catalog_settings(self.embedding_model_id, self.embedding_dimension, self.normalize_embeddings, self.distance_metric)
+        self.embedding_client = self.embedding_clients.get(settings)
+        self.near_duplicates = self.build_near_duplicates(settings['distance_metric'])
+
+    def load_query_template(self, s3):
+        return s3.get_object(Bucket=self.template_bucket_name, Key=self.query_template_object_path)['Body'].read().decode("utf-8")
+
+def parse_ndjson_items(event_body):
+    # Disabling semgrep rule for checking data size to be loaded to JSON as the size is checked by the caller.
+    # nosemgrep: python.aws-lambda.deserialization.tainted-json-aws-lambda.tainted-json-aws-lambda
+    return [json.loads(line) for line in event_body.splitlines() if line.strip() != '']
+
+def embed_items(embedding_client, items):
+    # Returns the embedding for each item in the same order, or the exception raised when embedding it.
+    # The embedding client adapts the number of concurrent calls to the throttling of Amazon Bedrock.
+    return embedding_client.embed_many([item['text'] for item in items])
+
+def format_embedding_stats(stats):
+    return f"{stats['embeddings']} embeddings in {stats['successes']} requests at {stats['achieved_rps']:.1f} requests/s, throttle rate {stats['throttle_rate']:.1%}, concurrency limit {stats['concurrency_limit']}"
+
+def write_batch(db, query_template, items, embeddings, content_hashes, tenant_id=DEFAULT_TENANT):
+    # Write the whole batch in one statement. If it fails, write the rows one by one so a bad row does not fail the others.
+    if isinstance(db, ShardedDatabase):
+        # Each shard writes its rows in its own statement, so the rows already written by one shard are not written again when another one fails
+        errors = [None] * len(items)
+        for shard, positions in db.group_by_shard(content_hashes).items():
+            shard_errors = write_batch(shard, query_template, 
+                                       [items[i] for i in positions], 
+                                       [embeddings[i] for i in positions], 
+                                       [content_hashes[i] for i in positions], 
+                                       tenant_id=tenant_id)
+            for i, error in zip(positions, shard_errors): errors[i] = error
+        return errors
+    
+    rows = [(item['text'], embedding, item.get('additional_query_parameters', []), content_hash) for item, embedding, content_hash in zip(items, embeddings, content_hashes)]
+    try:
+        db.insert_vectors(query_template, rows, tenant_id=tenant_id)
+        return [None] * len(rows)
+    except Exception as e:
+        print(f"Batch insert failed, retrying row by row: {e}")
+        if db.conn is not None and not db.conn.closed and not db.conn.autocommit: db.conn.rollback()
+
+    errors = []
+    for text, embedding, additional_query_parameters, content_hash in rows:
+        try:
+            db.insert_vector(query_template, text, embedding, additional_query_parameters=additional_query_parameters, content_hash=content_hash, tenant_id=tenant_id)
+            errors.append(None)
+        except Exception as e:
+            errors.append(e)
+    return errors
+
+def ingest_items(db, embedding_client, query_template, items, batch_size=100, tenant_id=DEFAULT_TENANT, near_duplicates=None):
+    # Embed and insert the items into the catalog of the tenant in batches and return the result of each item in the input order.
+    # Items whose content is already in the database (or earlier in the same request) are skipped without calling the embedding model.
+    # With a NearDuplicateDetector, the embedded items close to an item of the catalog are handled by its policy instead of being inserted.
+    embedding_client.reset_stats()
+    results = []
+    for batch_start in range(0, len(items), batch_size):
+        batch = items[batch_start:batch_start + batch_size]
+        batch_results = [None] * len(batch)
+
+        content_hashes = [get_content_hash(item['text']) for item in batch]
+        known_hashes = db.find_existing_content_hashes(content_hashes, tenant_id=tenant_id)
+        new_items = []
+        for i, content_hash in enumerate(content_hashes):
+            if content_hash in known_hashes:
+                batch_results[i] = {"index": batch_start + i, "status": "skipped"}
+            else:
+                known_hashes.add(content_hash)
+                new_items.append(i)
+
+        embeddings = embed_items(embedding_client, [batch[i] for i in new_items])
+
+        embedded = []
+        for i, embedding in zip(new_items, embeddings):
+            if isinstance(embedding, Exception):
+                batch_results[i] = {"index": batch_start + i, "status": "failed", "error": f"Embedding failed: {embedding}"}
+            else:
+                embedded.append((i, embedding))
+
+        probed = embedded
+        duplicate_results = None
+        if near_duplicates is not None and len(embedded) > 0:
+            try:
+                duplicate_results = near_duplicates.resolve(db, 
+                                                            [batch[i] for i, _ in embedded], 
+                                                            [embedding for _, embedding in embedded], 
+                                                            [content_hashes[i] for i, _ in embedded],
+                                                            tenant_id=tenant_id)
+            except Exception as e:
+                print(f"Near-duplicate probe failed, inserting the items: {e}")
+                if db.conn is not None and not db.conn.closed and not db.conn.autocommit: db.conn.rollback()
+                duplicate_results = None
+            if duplicate_results is not None:
+                embedded = [(i, embedding) for (i, embedding), result in zip(embedded, duplicate_results) if result is None]
+
+        if len(embedded) > 0:
+            errors = write_batch(db, query_template, 
+                                 [batch[i] for i, _ in embedded], 
+                                 [embedding for _, embedding in embedded], 
+                                 [content_hashes[i] for i, _ in embedded],
+                                 tenant_id=tenant_id)
+            for (i, _), error in zip(embedded, errors):
+                if error is None:
+                    batch_results[i] = {"index": batch_start + i, "status": "succeeded"}
+                else:
+                    batch_results[i] = {"index": batch_start + i, "status": "failed", "error": f"Insert failed: {error}"}
+
+        if duplicate_results is not None:
+            # The results of the probed items, by their position in the probe, where "duplicate_of" points to the first record of the cluster
+            probed_results = [duplicate_results[position] or batch_results[i] for position, (i, _) in enumerate(probed)]
+            near_duplicates.link_batch_duplicates(db, [batch[i] for i, _ in probed], [content_hashes[i] for i, _ in probed], probed_results, tenant_id=tenant_id)
+            for (i, _), result in zip(probed, probed_results):
+                if 'duplicate_of' in result: result = {**result, "duplicate_of": batch_start + probed[result['duplicate_of']][0]}
+                batch_results[i] = {"index": batch_start + i, **result}
+
+        results = results + batch_results
+        print(f"Ingested {batch_start + len(batch)} of {len(items)} items, {len(new_items)} of the last {len(batch)} were new")
+
+    print(f"Embedding: {format_embedding_stats(embedding_client.stats())}")
+    return results
+
+def iter_delimited_records(chunks, delimiter, start_offset=0):
+    # Incrementally split a stream of byte chunks into records separated by the delimiter, without loading the whole stream.
+    # Yields each record text with the absolute byte offset right after it, which is where a resumed read should start.
+    delimiter = delimiter.encode("utf-8")
+    buffer = b""
+    buffer_offset = start_offset
+    for chunk in chunks:
+        buffer = buffer + chunk
+        start = 0
+        while True:
+            i = buffer.find(delimiter, start)
+            if i < 0: break
+            yield buffer[start:i].decode("utf-8"), buffer_offset + i + len(delimiter)
+            start = i + len(delimiter)
+        buffer = buffer[start:]
+        buffer_offset = buffer_offset + start
+
+    if len(buffer) > 0:
+        yield buffer.decode("utf-8"), buffer_offset + len(buffer)
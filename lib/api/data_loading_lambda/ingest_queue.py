@@ -0,0 +1,250 @@
+import json, time, uuid, sqlite3, threading
+from collections import deque
+import boto3
+from helper.tenant import DEFAULT_TENANT
+from ingest import ingest_items
+
+# Ingest queues. They all exchange messages as dicts of {"id", "receipt", "body", "sent_timestamp"}, where "body" is a JSON string.
+# SQSIngestQueue is used when deployed, while LocalIngestQueue and SQLiteIngestQueue can stand in for it in tests and local runs.
+
+class SQSIngestQueue():
+    def __init__(self, queue_url):
+        self.queue_url = queue_url
+        self.sqs = boto3.client('sqs')
+
+    def send(self, body):
+        return self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=body)['MessageId']
+
+    def receive(self, max_messages=10, wait_time_seconds=0):
+        response = self.sqs.receive_message(QueueUrl=self.queue_url,
+                                            MaxNumberOfMessages=min(max_messages, 10),
+                                            WaitTimeSeconds=wait_time_seconds,
+                                            AttributeNames=['SentTimestamp'])
+        return [{
+            "id": m['MessageId'],
+            "receipt": m['ReceiptHandle'],
+            "body": m['Body'],
+            "sent_timestamp": int(m['Attributes']['SentTimestamp']) / 1000
+        } for m in response.get('Messages', [])]
+
+    def delete(self, message):
+        self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=message['receipt'])
+
+    def depth(self):
+        attributes = self.sqs.get_queue_attributes(QueueUrl=self.queue_url,
+                                                   AttributeNames=['ApproximateNumberOfMessages'])['Attributes']
+        return int(attributes['ApproximateNumberOfMessages'])
+
+    @staticmethod
+    def from_lambda_records(records):
+        # Messages delivered by the SQS event source mapping of AWS Lambda
+        return [{
+            "id": r['messageId'],
+            "receipt": r['receiptHandle'],
+            "body": r['body'],
+            "sent_timestamp": int(r['attributes']['SentTimestamp']) / 1000
+        } for r in records]
+
+class LocalIngestQueue():
+    # In-process queue. Received messages are not delivered again, even if they are not deleted.
+    def __init__(self):
+        self.messages = deque()
+        self.lock = threading.Lock()
+
+    def send(self, body):
+        message = {"id": str(uuid.uuid4()), "body": body, "sent_timestamp": time.time()}
+        message['receipt'] = message['id']
+        with self.lock:
+            self.messages.append(message)
+        return message['id']
+
+    def receive(self, max_messages=10, wait_time_seconds=0):
+        with self.lock:
+            return [self.messages.popleft() for _ in range(min(max_messages, len(self.messages)))]
+
+    def delete(self, message):
+        pass
+
+    def depth(self):
+        with self.lock:
+            return len(self.messages)
+
+class SQLiteIngestQueue():
+    # Queue persisted in a SQLite file. Like SQS, received messages become visible again after the visibility timeout unless deleted.
+    def __init__(self, path, visibility_timeout=300):
+        self.visibility_timeout = visibility_timeout
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        self.conn.execute("CREATE TABLE IF NOT EXISTS messages (id TEXT PRIMARY KEY, body TEXT, sent_timestamp REAL, visible_after REAL);")
+
+    def send(self, body):
+        message_id = str(uuid.uuid4())
+        now = time.time()
+        with self.lock:
+            self.conn.execute("INSERT INTO messages VALUES (?, ?, ?, ?);", (message_id, body, now, now))
+        return message_id
+
+    def receive(self, max_messages=10, wait_time_seconds=0):
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE;")
+            rows = self.conn.execute("SELECT id, body, sent_timestamp FROM messages WHERE visible_after <= ? ORDER BY sent_timestamp LIMIT ?;",
+                                     (now, max_messages)).fetchall()
+            self.conn.executemany("UPDATE messages SET visible_after = ? WHERE id = ?;",
+                                  [(now + self.visibility_timeout, r[0]) for r in rows])
+            self.conn.execute("COMMIT;")
+        return [{"id": r[0], "receipt": r[0], "body": r[1], "sent_timestamp": r[2]} for r in rows]
+
+    def delete(self, message):
+        with self.lock:
+            self.conn.execute("DELETE FROM messages WHERE id = ?;", (message['receipt'],))
+
+    def depth(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM messages;").fetchone()[0]
+
+# SQS messages are limited to 256 KB, so a job is split into parts which stay below this size.
+MAX_MESSAGE_SIZE = 200000
+
+def enqueue_job(queue, items, tenant_id=DEFAULT_TENANT):
+    # Split the items of one ingest request into queue messages and return the job ID.
+    job_id = str(uuid.uuid4())
+    part = 0
+    first_index = 0
+    part_items = []
+    part_size = 0
+
+    def send_part():
+        queue.send(json.dumps({"job_id": job_id, "tenant_id": tenant_id, "part": part, "first_index": first_index, "items": part_items}))
+
+    for i, item in enumerate(items):
+        item_size = len(json.dumps(item))
+        if len(part_items) > 0 and part_size + item_size > MAX_MESSAGE_SIZE:
+            send_part()
+            part = part + 1
+            first_index = i
+            part_items = []
+            part_size = 0
+        part_items.append(item)
+        part_size = part_size + item_size
+
+    if len(part_items) > 0: send_part()
+    return job_id, part + 1
+
+def get_job_status(s3, bucket, job_results_prefix, job_id):
+    # The status of a job and the results of its parts loaded so far, saved by the queue consumer under <job_results_prefix><job_id>/part-<part>.json,
+    # next to the job.json written when the job was enqueued. Returns None for an unknown job.
+    try:
+        uuid.UUID(job_id)
+        job = json.loads(s3.get_object(Bucket=bucket, Key=f"{job_results_prefix}{job_id}/job.json")['Body'].read())
+    except (ValueError, s3.exceptions.NoSuchKey):
+        return None
+    
+    results = []
+    parts_completed = 0
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=f"{job_results_prefix}{job_id}/part-"):
+        for content in page.get('Contents', []):
+            results.extend(json.loads(s3.get_object(Bucket=bucket, Key=content['Key'])['Body'].read())['results'])
+            parts_completed = parts_completed + 1
+    results.sort(key=lambda r: r['index'])
+    
+    return {
+        "job_id": job_id,
+        "tenant_id": job['tenant_id'],
+        "status": "completed" if parts_completed >= job['parts'] else "in_progress",
+        "items": job['items'],
+        "parts": job['parts'],
+        "parts_completed": parts_completed,
+        **{status: len([r for r in results if r['status'] == status]) for status in ["succeeded", "skipped", "duplicate", "failed"]},
+        "results": results
+    }
+
+def print_metrics(metrics, namespace="ContentBasedRecommender/Ingest"):
+    # Metrics in the CloudWatch embedded metric format, which are extracted from the Lambda function logs.
+    print(json.dumps({
+        "_aws": {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": namespace,
+                "Dimensions": [[]],
+                "Metrics": [{"Name": name, "Unit": unit} for name, (value, unit) in metrics.items()]
+            }]
+        },
+        **{name: value for name, (value, unit) in metrics.items()}
+    }))
+
+def consume_messages(db, embedding_client, query_template, messages, batch_size=100, queue_depth=None, save_job_results=None, near_duplicates=None):
+    # Ingest the items of all received messages of a tenant together, so the writes are group-committed across requests.
+    # Returns the messages which could not be processed and should be delivered again.
+    start_time = time.time()
+    jobs = []
+    for message in messages:
+        try:
+            jobs.append((message, json.loads(message['body'])))
+        except Exception as e:
+            print(f"Dropping message {message['id']} which is not a valid ingest job: {e}")
+
+    # The items of each tenant are ingested together. Jobs enqueued before tenants existed belong to the default tenant.
+    tenant_jobs = {}
+    for message, job in jobs:
+        tenant_jobs.setdefault(job.get('tenant_id', DEFAULT_TENANT), []).append((message, job))
+
+    items = []
+    results = []
+    failed_messages = []
+    for tenant_id, group in tenant_jobs.items():
+        tenant_items = [item for _, job in group for item in job['items']]
+        try:
+            tenant_results = ingest_items(db, embedding_client, query_template, tenant_items, batch_size=batch_size, tenant_id=tenant_id, near_duplicates=near_duplicates)
+        except Exception as e:
+            print(f"Failed to ingest the received messages of tenant {tenant_id}: {e}")
+            failed_messages = failed_messages + [message for message, _ in group]
+            continue
+        items = items + tenant_items
+        results = results + tenant_results
+
+        offset = 0
+        for message, job in group:
+            # Map the index in this micro-batch back to the index in the original ingest request
+            job_results = tenant_results[offset:offset + len(job['items'])]
+            for r in job_results: r['index'] = job['first_index'] + r['index'] - offset
+            offset = offset + len(job['items'])
+            print(f"Job {job['job_id']} part {job['part']}: " + ", ".join(f"{len([r for r in job_results if r['status'] == status])} {status}" for status in ["succeeded", "skipped", "duplicate", "failed"]))
+            if save_job_results is not None:
+                try:
+                    save_job_results(job, job_results)
+                except Exception as e:
+                    print(f"Failed to save the results of job {job['job_id']} part {job['part']}: {e}")
+
+    duration = time.time() - start_time
+    embedding_stats = embedding_client.stats()
+    metrics = {
+        "Messages": (len(messages), "Count"),
+        "IngestedItems": (len([r for r in results if r['status'] == "succeeded"]), "Count"),
+        "SkippedItems": (len([r for r in results if r['status'] == "skipped"]), "Count"),
+        "DuplicateItems": (len([r for r in results if r['status'] == "duplicate"]), "Count"),
+        "FailedItems": (len([r for r in results if r['status'] == "failed"]), "Count"),
+        "Throughput": (len(items) / duration if duration > 0 else 0, "Count/Second"),
+        "QueueLag": (max([start_time - m['sent_timestamp'] for m in messages], default=0), "Seconds"),
+        "EmbeddingRequestRate": (embedding_stats['achieved_rps'], "Count/Second"),
+        "EmbeddingThrottleRate": (embedding_stats['throttle_rate'] * 100, "Percent"),
+        "EmbeddingConcurrencyLimit": (embedding_stats['concurrency_limit'], "Count"),
+    }
+    if queue_depth is not None: metrics["QueueDepth"] = (queue_depth, "Count")
+    print_metrics(metrics)
+
+    return failed_messages
+
+def drain_queue(queue, db, embedding_client, query_template, max_messages=10, batch_size=100, save_job_results=None, near_duplicates=None):
+    # Consume the queue in micro-batches until it is empty. Used with the local queues, while AWS Lambda is fed by the SQS event source.
+    while True:
+        messages = queue.receive(max_messages=max_messages)
+        if len(messages) == 0: return
+        failed_messages = consume_messages(db, embedding_client, query_template, messages,
+                                           batch_size=batch_size,
+                                           queue_depth=queue.depth(),
+                                           save_job_results=save_job_results,
+                                           near_duplicates=near_duplicates)
+        failed_ids = set(m['id'] for m in failed_messages)
+        for message in messages:
+            if message['id'] not in failed_ids: queue.delete(message)
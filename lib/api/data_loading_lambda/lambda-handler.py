@@ -1,131 +1,226 @@
 import os, json
 import boto3
-import psycopg2
+from helper.tenant import DEFAULT_TENANT, is_valid_tenant_id
+from helper.request_id import get_request_id, find_request_id, tag_reply
+from helper.content_hash import get_content_hash
+from ingest import IngestEnvironment, parse_ndjson_items, ingest_items
+from ingest_queue import SQSIngestQueue, enqueue_job, get_job_status, MAX_MESSAGE_SIZE
 
 s3 = boto3.client('s3')
-bedrock = boto3.client("bedrock-runtime")
-
-writer_endpoint = os.environ['DB_WRITER_ENDPOINT']
-database_name = os.environ['DATABASE_NAME']
-template_bucket_name = os.environ['TEMPLATE_BUCKET_NAME']
-query_template_object_path = os.environ['QUERY_TEMPLATE_OBJECT_PATH']
-
-class Database():
-    def __init__(self, writer, database_name, embedding_dimension=1536, port=5432):
-        self.writer_endpoint = writer
-        self.username = None
-        self.password = None
-        self.port = port
-        self.database_name = database_name
-        self.conn = None
-    
-    def fetch_credentials(self):
-        secrets_manager = boto3.client("secretsmanager")
-        credentials = json.loads(secrets_manager.get_secret_value(
-            SecretId='AuroraClusterCredentials'
-        )["SecretString"])
-        self.username = credentials["username"]
-        self.password = credentials["password"]
-    
-    def connect_for_writing(self):
-        if self.username is None or self.password is None: self.fetch_credentials()
-        
-        conn = psycopg2.connect(host=self.writer_endpoint, port=self.port, user=self.username, password=self.password, database=database_name)
-        conn.autocommit = True
-        self.conn = conn
-        return conn
-    
-    def close_connection(self):
-        self.conn.close()
-        self.conn = None
-        
-    
-    def insert_vector(self, query_template, text, embedding, additional_query_parameters=[]):
-        if self.conn is None:
-            self.connect_for_writing()
-            
-        text = psycopg2.extensions.adapt(text)
-        
-        all_query_parameters = [text, str(embedding)] + additional_query_parameters
-        query_statement = query_template.format(*all_query_parameters)
-
-        cur = self.conn.cursor()
-
-        # Disabling semgrep rule for raw query as this is meant to be run by admin/engineer with authentication
-        # nosemgrep: python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
-        response = cur.execute(query_statement)
-        cur.close()
-        self.conn.commit()
-
-        return response
-    
-db = Database(writer=writer_endpoint, database_name=database_name)
+
+# The environment variables, database and embedding client shared with the other ingest functions
+ingest_env = IngestEnvironment(os.environ)
+ingest_queue_url = os.environ.get('INGEST_QUEUE_URL', '')
+job_results_prefix = os.environ.get('JOB_RESULTS_PREFIX', 'jobs/')
+# Synchronous bulk requests must finish within the 29 seconds of the API Gateway integration timeout.
+# Larger ones are loaded asynchronously through the ingest queue.
+max_sync_bulk_items = int(os.environ.get('MAX_SYNC_BULK_ITEMS', '500'))
+
+# A single item request body is limited to 200 KB, while a bulk request can go up to the Lambda payload limit.
+MAX_BODY_SIZE = 200000
+MAX_BULK_BODY_SIZE = 6000000
+
+db = ingest_env.db
 db.connect_for_writing()
 
+# Queue for asynchronous ingest, consumed by the queue consumer Lambda function
+ingest_queue = SQSIngestQueue(ingest_queue_url) if ingest_queue_url != '' else None
+
+def reply(event, mode, status_code, body, content_type=None, request_id=None):
+    if mode == "websocket":
+        # Echo the client request ID, so that a client multiplexing requests on the connection can match the reply
+        if request_id is not None: body = tag_reply(body, status_code, request_id)
+        domain = event['requestContext']['domainName']
+        stage = event['requestContext']['stage']
+        connection_id = event['requestContext']['connectionId']
+        callback_url = f"https://{domain}/{stage}"
+        apigw = boto3.client('apigatewaymanagementapi', endpoint_url= callback_url)
+
+        response = apigw.post_to_connection(
+            Data=bytes(body, "utf-8"),
+            ConnectionId=connection_id
+        )
+        return {
+            "statusCode": status_code
+        }
+    
+    response = {
+        "statusCode": status_code,
+        'body': body
+    }
+    if content_type is not None:
+        response["headers"] = {
+            "Content-Type": content_type
+        }
+
+    return response
+
+def validate_items(items):
+    return isinstance(items, list) and all(isinstance(item, dict) and isinstance(item.get('text'), str) for item in items)
+
+def is_async_request(event, parsed_event_body):
+    query_string_parameters = event.get('queryStringParameters') or {}
+    if str(query_string_parameters.get('async', 'false')).lower() == 'true': return True
+    return isinstance(parsed_event_body, dict) and str(parsed_event_body.get('async', False)).lower() == 'true'
+
+def get_tenant_id(event, parsed_event_body):
+    # The tenant is given as "tenant_id" in the JSON body, or as a query string parameter for NDJSON bulk requests.
+    if isinstance(parsed_event_body, dict) and 'tenant_id' in parsed_event_body: return parsed_event_body['tenant_id']
+    query_string_parameters = event.get('queryStringParameters') or {}
+    return query_string_parameters.get('tenant_id', DEFAULT_TENANT)
+
+def handle_async(event, mode, items, tenant_id, request_id=None):
+    if ingest_queue is None:
+        return reply(event, mode, 400, 'Asynchronous ingest is not enabled', request_id=request_id)
+    if not validate_items(items):
+        return reply(event, mode, 400, 'Every item must be an object with a "text" string', request_id=request_id)
+    if any(len(json.dumps(item)) > MAX_MESSAGE_SIZE for item in items):
+        return reply(event, mode, 400, f'Every item must be smaller than {MAX_MESSAGE_SIZE} bytes for asynchronous ingest', request_id=request_id)
+    
+    job_id, parts = enqueue_job(ingest_queue, items, tenant_id=tenant_id)
+    print(f"Enqueued job {job_id} of tenant {tenant_id} with {len(items)} items in {parts} parts")
+    # The number of parts tells the job status lookup when all the results are in
+    s3.put_object(Bucket=ingest_env.template_bucket_name, 
+                  Key=f"{job_results_prefix}{job_id}/job.json", 
+                  Body=json.dumps({"job_id": job_id, "tenant_id": tenant_id, "items": len(items), "parts": parts}).encode("utf-8"))
+    
+    return reply(event, mode, 202, json.dumps({
+        "job_id": job_id,
+        "items": len(items)
+    }), content_type="application/json", request_id=request_id)
+
+def handle_job_status(event, mode, job_id, request_id=None):
+    # GET ?job_id=<job_id> on the REST API, or {"job_id": "..."} on the WebSocket route, returns the results of an asynchronous job loaded so far
+    job_status = get_job_status(s3, ingest_env.template_bucket_name, job_results_prefix, job_id) if isinstance(job_id, str) else None
+    if job_status is None:
+        return reply(event, mode, 404, 'Unknown job_id', request_id=request_id)
+    return reply(event, mode, 200, json.dumps(job_status), content_type="application/json", request_id=request_id)
+
+def handle_bulk(event, mode, items, tenant_id, request_id=None):
+    if not validate_items(items):
+        return reply(event, mode, 400, 'Every item in a bulk request must be an object with a "text" string', request_id=request_id)
+    
+    query_template = ingest_env.load_query_template(s3)
+    
+    try:
+        ingest_env.apply_catalog_settings()
+        results = ingest_items(db, ingest_env.embedding_client, query_template, items, 
+                               batch_size=ingest_env.bulk_batch_size,
+                               tenant_id=tenant_id,
+                               near_duplicates=ingest_env.near_duplicates)
+    finally:
+        if db.conn is not None: db.close_connection()
+    
+    return reply(event, mode, 200, json.dumps({
+        "succeeded": len([r for r in results if r['status'] == "succeeded"]),
+        "skipped": len([r for r in results if r['status'] == "skipped"]),
+        "duplicates": len([r for r in results if r['status'] == "duplicate"]),
+        "failed": len([r for r in results if r['status'] == "failed"]),
+        "results": results
+    }), content_type="application/json", request_id=request_id)
+
 def handler(event, context):
     print(event)
     
-    additional_query_parameters = []
-    
     mode = "rest"
     if ('requestContext' in event) and ('routeKey' in event['requestContext']): mode = "websocket"
+    
+    try:
+        return handle_request(event, mode)
+    except Exception as e:
+        if mode != "websocket": raise
+        # A WebSocket client waits for the reply with its request ID, so it gets an error reply instead of none
+        print(f"The request failed: {e}")
+        return reply(event, mode, 500, 'Internal server error', request_id=find_request_id(event.get('body')))
+
+def handle_request(event, mode):
+    additional_query_parameters = []
 
+    if event.get('httpMethod') == "GET":
+        return handle_job_status(event, mode, (event.get('queryStringParameters') or {}).get('job_id'))
+    
     event_body = event['body']
-    if len(event_body) > 200000:
-        return {
-            "statusCode": 400,
-            'body': 'Event body is too large'
-        }
-    # Disabling semgrep rule for checking data size to be loaded to JSON as the check is already done right above.
-    # nosemgrep: python.aws-lambda.deserialization.tainted-json-aws-lambda.tainted-json-aws-lambda
-    event_body = json.loads(event_body)
+    if len(event_body) > MAX_BULK_BODY_SIZE:
+        return reply(event, mode, 400, 'Event body is too large', request_id=find_request_id(event_body))
+    
+    # Bulk requests are either NDJSON with one item per line, a JSON object with an "items" array, or a JSON array of items.
+    items = None
+    try:
+        # Disabling semgrep rule for checking data size to be loaded to JSON as the check is already done right above.
+        # nosemgrep: python.aws-lambda.deserialization.tainted-json-aws-lambda.tainted-json-aws-lambda
+        parsed_event_body = json.loads(event_body)
+        if isinstance(parsed_event_body, dict) and 'items' in parsed_event_body: items = parsed_event_body['items']
+        elif isinstance(parsed_event_body, list): items = parsed_event_body
+    except json.JSONDecodeError:
+        parsed_event_body = None
+        try:
+            items = parse_ndjson_items(event_body)
+        except json.JSONDecodeError:
+            return reply(event, mode, 400, 'Event body must be a JSON object or NDJSON with one item per line', request_id=find_request_id(event_body))
+    
+    if items is None and isinstance(parsed_event_body, dict) and 'job_id' in parsed_event_body and 'text' not in parsed_event_body:
+        return handle_job_status(event, mode, parsed_event_body['job_id'], request_id=get_request_id(parsed_event_body))
+    
+    if items is None and not (isinstance(parsed_event_body, dict) and isinstance(parsed_event_body.get('text'), str)):
+        return reply(event, mode, 400, 'Event body must be a JSON object with a "text" string, or a bulk request', request_id=get_request_id(parsed_event_body))
+    
+    if len(event_body) > MAX_BODY_SIZE and items is None:
+        return reply(event, mode, 400, 'Event body is too large', request_id=get_request_id(parsed_event_body))
+    
+    request_id = get_request_id(parsed_event_body)
+    tenant_id = get_tenant_id(event, parsed_event_body)
+    if not is_valid_tenant_id(tenant_id):
+        return reply(event, mode, 400, 'Invalid tenant_id', request_id=request_id)
+    
+    # Asynchronous requests are only validated and enqueued here, then loaded by the queue consumer.
+    if is_async_request(event, parsed_event_body):
+        if items is None: items = [{
+            "text": parsed_event_body.get('text'), 
+            "additional_query_parameters": parsed_event_body.get('additional_query_parameters', [])
+        }]
+        return handle_async(event, mode, items, tenant_id, request_id=request_id)
+    
+    if items is not None:
+        if isinstance(items, list) and len(items) > max_sync_bulk_items:
+            if ingest_queue is None:
+                return reply(event, mode, 400, f'A synchronous bulk request can have up to {max_sync_bulk_items} items. Split the items into several requests', request_id=request_id)
+            # Would not finish before the API Gateway timeout, so it is loaded asynchronously and the reply is the job to follow
+            print(f"Loading the {len(items)} items of the bulk request asynchronously, above the {max_sync_bulk_items} items of a synchronous request")
+            return handle_async(event, mode, items, tenant_id, request_id=request_id)
+        return handle_bulk(event, mode, items, tenant_id, request_id=request_id)
+    
+    event_body = parsed_event_body
     item_text = event_body['text']
     
     if 'additional_query_parameters' in event_body:
         additional_query_parameters = event_body['additional_query_parameters']
     
-    query_template = s3.get_object(Bucket=template_bucket_name, Key=query_template_object_path)['Body'].read().decode("utf-8")
-    
-    body = json.dumps(
-        {
-            "inputText": item_text,
-        }
-    )
-
-    response = bedrock.invoke_model(body=body, modelId="amazon.titan-embed-text-v1")
-    # Disabling semgrep rule for checking data size to be loaded to JSON as the source is from Amazon Bedrock
-    # nosemgrep: python.aws-lambda.deserialization.tainted-json-aws-lambda.tainted-json-aws-lambda
-    embedding = json.loads(response.get("body").read())["embedding"]
+    query_template = ingest_env.load_query_template(s3)
     
     try:
-        db.insert_vector(query_template, 
-                     item_text, 
-                     embedding, 
-                     additional_query_parameters=additional_query_parameters)
+        ingest_env.apply_catalog_settings()
+        # Skip the embedding and the insert when the same content is already loaded
+        content_hash = get_content_hash(item_text)
+        if content_hash in db.find_existing_content_hashes([content_hash], tenant_id=tenant_id):
+            print("The item is already loaded")
+        else:
+            embedding = ingest_env.embedding_client.embed(item_text)
+            duplicate = None
+            if ingest_env.near_duplicates is not None:
+                duplicate = ingest_env.near_duplicates.resolve(db, [event_body], [embedding], [content_hash], tenant_id=tenant_id)[0]
+            if duplicate is not None:
+                print(f"The item is a near-duplicate: {duplicate}")
+            else:
+                db.insert_vector(query_template, 
+                             item_text, 
+                             embedding, 
+                             additional_query_parameters=additional_query_parameters,
+                             content_hash=content_hash,
+                             tenant_id=tenant_id)
     except Exception as e:
         print("An error happens when inserting the vector into database")
         print(e)
     finally: 
         db.close_connection()
     
-    if mode == "websocket":
-        domain = event['requestContext']['domainName']
-        stage = event['requestContext']['stage']
-        connection_id = event['requestContext']['connectionId']
-        callback_url = f"https://{domain}/{stage}"
-        apigw = boto3.client('apigatewaymanagementapi', endpoint_url= callback_url)
-
-        response = apigw.post_to_connection(
-            Data=bytes('Data has been loaded', "utf-8"),
-            ConnectionId=connection_id
-        )
-        return {
-            "statusCode": 200
-        }
-    
-    response = {
-        "statusCode": 200,
-        'body': 'Data has been loaded'
-    }
-
-    return response
\ No newline at end of file
+    return reply(event, mode, 200, 'Data has been loaded', request_id=request_id)
\ No newline at end of file
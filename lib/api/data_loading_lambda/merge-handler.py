@@ -0,0 +1,46 @@
+import os
+from helper.sharding import get_additional_shards
+from helper.storage_layout import STORAGE_LAYOUT_SINGLE
+from database import ShardedDatabase, get_database
+from ingest_queue import print_metrics
+from staging import get_partitioned_tenants, count_staged_items, merge_staged_items
+
+writer_endpoint = os.environ['DB_WRITER_ENDPOINT']
+database_name = os.environ['DATABASE_NAME']
+additional_shards = get_additional_shards(os.environ.get('ADDITIONAL_DB_SHARDS', ''))
+storage_layout = os.environ.get('STORAGE_LAYOUT', STORAGE_LAYOUT_SINGLE)
+merge_batch_size = int(os.environ.get('MERGE_BATCH_SIZE', '5000'))
+
+# Stop taking new batches when less than this remains before the Lambda timeout. The next scheduled run continues.
+REMAINING_TIME_MARGIN_MS = 60000
+
+db = get_database(writer=writer_endpoint, database_name=database_name, additional_shards=additional_shards)
+
+def handler(event, context):
+    # Merge the items of the staged ingest mode into the indexed table in large batches, off the request path of the data loading.
+    # With a sharded catalog, each shard has its own staging table, merged in turn.
+    taken_total = 0
+    merged_total = 0
+    backlog = 0
+    for shard in (db.shards if isinstance(db, ShardedDatabase) else [db]):
+        conn = shard.connect_for_writing()
+        try:
+            tenants = get_partitioned_tenants(conn)
+            while context.get_remaining_time_in_millis() > REMAINING_TIME_MARGIN_MS:
+                taken, merged = merge_staged_items(conn, storage_layout, tenants, merge_batch_size)
+                taken_total = taken_total + taken
+                merged_total = merged_total + merged
+                if taken < merge_batch_size: break
+            backlog = backlog + count_staged_items(conn)
+        finally:
+            if shard.conn is not None: shard.close_connection()
+
+    print(f"Merged {merged_total} staged items, skipped {taken_total - merged_total} duplicates, {backlog} items left in the staging table")
+    print_metrics({
+        "MergedItems": (merged_total, "Count"),
+        "StagingBacklog": (backlog, "Count"),
+    })
+
+    return {
+        "statusCode": 200
+    }
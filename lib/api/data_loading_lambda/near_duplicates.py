@@ -0,0 +1,111 @@
+import operator
+from helper.distance_metric import normalize_embedding
+from helper.tenant import DEFAULT_TENANT
+from helper.storage_layout import STORAGE_LAYOUT_SINGLE, STORAGE_LAYOUT_SPLIT, get_vector_table
+
+# What to do with a new item whose nearest item is at least as similar as the threshold:
+# "skip" does not store it, "link" stores it in item_links pointing to the nearest item, which stays the canonical item,
+# and "merge" replaces the description and the embedding of the nearest item with the new ones, the newest version winning.
+DUPLICATE_POLICY_OFF = "off"
+DUPLICATE_POLICY_SKIP = "skip"
+DUPLICATE_POLICY_LINK = "link"
+DUPLICATE_POLICY_MERGE = "merge"
+DUPLICATE_POLICIES = [DUPLICATE_POLICY_OFF, DUPLICATE_POLICY_SKIP, DUPLICATE_POLICY_LINK, DUPLICATE_POLICY_MERGE]
+
+# The chunked layout has several embeddings per item, so an item is not near another one by a single embedding
+SUPPORTED_STORAGE_LAYOUTS = [STORAGE_LAYOUT_SINGLE, STORAGE_LAYOUT_SPLIT]
+
+def find_batch_duplicates(embeddings, min_similarity):
+    # Near-duplicates within a batch, which the probe of the catalog cannot find as none of them is stored yet.
+    # Each embedding is compared with the first embedding of each cluster found so far, in the batch order, so the first record
+    # of each cluster is kept. Returns {position: (position of the first record, cosine similarity)} for the other records.
+    unit_embeddings = [normalize_embedding(embedding) for embedding in embeddings]
+    firsts = []
+    duplicates = {}
+    for i, embedding in enumerate(unit_embeddings):
+        nearest, nearest_similarity = None, min_similarity
+        for j in firsts:
+            similarity = sum(map(operator.mul, embedding, unit_embeddings[j]))
+            if similarity >= nearest_similarity: nearest, nearest_similarity = j, similarity
+        if nearest is None:
+            firsts.append(i)
+        else:
+            duplicates[i] = (nearest, nearest_similarity)
+    return duplicates
+
+class NearDuplicateDetector():
+    def __init__(self, policy, min_similarity, distance_operator, storage_layout=STORAGE_LAYOUT_SINGLE, shard_count=1):
+        if policy not in DUPLICATE_POLICIES:
+            raise Exception(f"Invalid near-duplicate policy: {policy}. Valid policies are {DUPLICATE_POLICIES}")
+        if storage_layout not in SUPPORTED_STORAGE_LAYOUTS:
+            raise Exception(f"The near-duplicate detection is not supported with the {storage_layout} storage layout")
+        # The nearest item may be in another shard than the new item, whose links and content hash belong to the shard of its content
+        if shard_count > 1:
+            raise Exception("The near-duplicate detection is not supported with a sharded catalog")
+        self.policy = policy
+        self.min_similarity = float(min_similarity)
+        self.distance_operator = distance_operator
+        self.vector_table = get_vector_table(storage_layout)
+
+    def resolve(self, db, items, embeddings, content_hashes, tenant_id=DEFAULT_TENANT):
+        # Keep the first record of each cluster of near-duplicates within the batch, probe the vector index for them in one query,
+        # and apply the policy to the near-duplicates. Returns the result of each item, or None for the items which are not
+        # near-duplicates and still have to be written. The results of the other records of a cluster have the position of its
+        # first record in "duplicate_of". With the link policy, they are linked by link_batch_duplicates() once it is written.
+        if len(items) == 0: return []
+        batch_duplicates = find_batch_duplicates(embeddings, self.min_similarity)
+        firsts = [i for i in range(len(items)) if i not in batch_duplicates]
+        duplicates = db.find_near_duplicates([embeddings[i] for i in firsts], self.vector_table, self.distance_operator, self.min_similarity, tenant_id=tenant_id)
+        duplicates = {firsts[position]: duplicate for position, duplicate in duplicates.items()}
+        results = [None] * len(items)
+
+        links = []
+        for i, (canonical_id, similarity, source) in duplicates.items():
+            result = {"status": "duplicate", "policy": self.policy, "canonical_id": canonical_id, "similarity": round(similarity, 4)}
+            if self.policy == DUPLICATE_POLICY_LINK:
+                links.append((content_hashes[i], canonical_id, items[i]['text'], similarity))
+            elif self.policy == DUPLICATE_POLICY_MERGE:
+                try:
+                    db.merge_item(canonical_id, source, self.vector_table, items[i]['text'], embeddings[i], content_hashes[i], similarity, tenant_id=tenant_id)
+                except Exception as e:
+                    result = {"status": "failed", "error": f"Merge into item {canonical_id} failed: {e}"}
+            results[i] = result
+
+        for i, (first, similarity) in batch_duplicates.items():
+            result = {"status": "duplicate", "policy": self.policy, "duplicate_of": first, "similarity": round(similarity, 4)}
+            if first in duplicates:
+                # The first record is itself a near-duplicate of a stored item, which is then the canonical item of the whole cluster
+                canonical_id = duplicates[first][0]
+                result['canonical_id'] = canonical_id
+                if self.policy == DUPLICATE_POLICY_LINK: links.append((content_hashes[i], canonical_id, items[i]['text'], similarity))
+            results[i] = result
+
+        if len(links) > 0:
+            try:
+                db.link_items(links, tenant_id=tenant_id)
+            except Exception as e:
+                for i, result in enumerate(results):
+                    if result is not None and result['status'] == "duplicate" and 'canonical_id' in result:
+                        results[i] = {"status": "failed", "error": f"Link failed: {e}"}
+
+        if len(duplicates) + len(batch_duplicates) > 0:
+            print(f"{len(duplicates)} of {len(items)} items are near-duplicates of stored items and {len(batch_duplicates)} of other items of the batch, policy {self.policy}")
+        return results
+
+    def link_batch_duplicates(self, db, items, content_hashes, results, tenant_id=DEFAULT_TENANT):
+        # Link the near-duplicates within a batch to their first record, once it is written. results are the ones of resolve(),
+        # with the final status of the first records. Updates the results of the records which could not be linked.
+        if self.policy != DUPLICATE_POLICY_LINK: return
+        links = []
+        for i, result in enumerate(results):
+            if result is None or result['status'] != "duplicate" or 'canonical_id' in result or 'duplicate_of' not in result: continue
+            first = result['duplicate_of']
+            if results[first] is not None and results[first]['status'] == "succeeded":
+                links.append((i, (content_hashes[i], content_hashes[first], items[i]['text'], result['similarity'])))
+            else:
+                results[i] = {"status": "failed", "error": f"The near-duplicate at position {first} of the batch was not stored"}
+        if len(links) == 0: return
+        try:
+            db.link_items_by_content_hash([link for _, link in links], tenant_id=tenant_id)
+        except Exception as e:
+            for i, _ in links: results[i] = {"status": "failed", "error": f"Link failed: {e}"}
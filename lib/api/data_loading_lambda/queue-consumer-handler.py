@@ -0,0 +1,40 @@
+import os, json
+import boto3
+from ingest import IngestEnvironment
+from ingest_queue import SQSIngestQueue, consume_messages
+
+s3 = boto3.client('s3')
+
+# The environment variables, database and embedding client shared with the other ingest functions
+ingest_env = IngestEnvironment(os.environ)
+ingest_queue_url = os.environ['INGEST_QUEUE_URL']
+job_results_prefix = os.environ.get('JOB_RESULTS_PREFIX', 'jobs/')
+
+db = ingest_env.db
+queue = SQSIngestQueue(ingest_queue_url)
+
+def save_job_results(job, job_results):
+    s3.put_object(Bucket=ingest_env.template_bucket_name, 
+                  Key=f"{job_results_prefix}{job['job_id']}/part-{job['part']}.json", 
+                  Body=json.dumps({"job_id": job['job_id'], "part": job['part'], "results": job_results}).encode("utf-8"))
+
+def handler(event, context):
+    messages = SQSIngestQueue.from_lambda_records(event['Records'])
+    print(f"Received {len(messages)} messages")
+
+    query_template = ingest_env.load_query_template(s3)
+
+    try:
+        ingest_env.apply_catalog_settings()
+        failed_messages = consume_messages(db, ingest_env.embedding_client, query_template, messages,
+                                           batch_size=ingest_env.bulk_batch_size,
+                                           queue_depth=queue.depth(),
+                                           save_job_results=save_job_results,
+                                           near_duplicates=ingest_env.near_duplicates)
+    finally:
+        if db.conn is not None: db.close_connection()
+
+    # Only the failed messages are delivered again
+    return {
+        "batchItemFailures": [{"itemIdentifier": m['id']} for m in failed_messages]
+    }
@@ -0,0 +1,186 @@
+import os, json
+import boto3
+import psycopg2.extras
+from helper.embedding_client import EmbeddingClient
+from helper.tenant import validate_tenant_id
+from helper.catalog_settings import STATUS_PREPARED, STATUS_LOADING, STATUS_LOADED
+from database import Database
+from ingest import format_embedding_stats
+
+lambda_client = boto3.client('lambda')
+
+writer_endpoint = os.environ['DB_WRITER_ENDPOINT']
+database_name = os.environ['DATABASE_NAME']
+reembed_batch_size = int(os.environ.get('REEMBED_BATCH_SIZE', '200'))
+embedding_concurrency = int(os.environ.get('EMBEDDING_CONCURRENCY', '64'))
+embedding_max_rps = float(os.environ.get('EMBEDDING_MAX_RPS', '0'))
+embedding_model_id = os.environ.get('EMBEDDING_MODEL_ID', 'amazon.titan-embed-text-v1')
+
+# Stop taking new batches when less than this remains before the Lambda timeout, then continue in a new invocation.
+REMAINING_TIME_MARGIN_MS = 120000
+# Passes over the shadow table. Each pass first copies the items loaded since the previous one, then retries the failed embeddings.
+MAX_PASSES = 5
+
+db = Database(writer=writer_endpoint, database_name=database_name)
+
+# One client per model, shared by the invocations in this execution environment, so the learned concurrency limit is kept between them.
+embedding_clients = {}
+
+def get_embedding_client(model_id, normalize, dimension):
+    if (model_id, normalize, dimension) not in embedding_clients:
+        embedding_clients[(model_id, normalize, dimension)] = EmbeddingClient(model_id=model_id,
+                                                                              max_concurrency=embedding_concurrency,
+                                                                              max_requests_per_second=embedding_max_rps if embedding_max_rps > 0 else None,
+                                                                              normalize=normalize,
+                                                                              dimension=dimension)
+    return embedding_clients[(model_id, normalize, dimension)]
+
+def get_active_rebuild(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT id, status, settings FROM catalog_rebuilds WHERE status IN (%s, %s) ORDER BY id DESC LIMIT 1;", (STATUS_PREPARED, STATUS_LOADING))
+    row = cur.fetchone()
+    cur.close()
+    return None if row is None else {"id": row[0], "status": row[1], "settings": row[2]}
+
+def set_rebuild_model_id(conn, rebuild_id, model_id):
+    # Recorded in the rebuild, as the model of the vectors once the rebuild is swapped in, see helper/catalog_settings.py
+    cur = conn.cursor()
+    cur.execute("UPDATE catalog_rebuilds SET settings = jsonb_set(settings, '{model_id}', to_jsonb(%s::text)), updated_at = now() WHERE id = %s;", (model_id, rebuild_id))
+    cur.close()
+
+def set_rebuild_status(conn, rebuild_id, status):
+    cur = conn.cursor()
+    cur.execute("UPDATE catalog_rebuilds SET status = %s, updated_at = now() WHERE id = %s;", (status, rebuild_id))
+    cur.close()
+
+def sync_shadow_table(conn, settings):
+    # Copy the items loaded into the live catalog since the last pass into the shadow table, without embeddings,
+    # and remove the ones which were deleted. With the split layout, the foreign key to items removes them.
+    shadow_table = settings['shadow_table']
+    cur = conn.cursor()
+    # Tenants created after the rebuild was prepared also need their partition in the shadow table
+    cur.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'items'::regclass;")
+    for (partition,) in cur.fetchall():
+        tenant_id = validate_tenant_id(partition[len("items_"):])
+        # Disabling semgrep rule for formatted query as the table name comes from the rebuild settings and the tenant ID is validated.
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {shadow_table}_{tenant_id} PARTITION OF {shadow_table} FOR VALUES IN ('{tenant_id}');")
+
+    if settings['table'] == "items":
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"""INSERT INTO {shadow_table} (tenant_id, id, description, content_hash) SELECT i.tenant_id, i.id, i.description, i.content_hash FROM items i
+                        WHERE NOT EXISTS (SELECT 1 FROM {shadow_table} n WHERE n.tenant_id = i.tenant_id AND n.id = i.id);""")
+        added = cur.rowcount
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"DELETE FROM {shadow_table} n WHERE NOT EXISTS (SELECT 1 FROM items i WHERE i.tenant_id = n.tenant_id AND i.id = n.id);")
+        removed = cur.rowcount
+    else:
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"""INSERT INTO {shadow_table} (tenant_id, id) SELECT i.tenant_id, i.id FROM items i
+                        WHERE NOT EXISTS (SELECT 1 FROM {shadow_table} n WHERE n.tenant_id = i.tenant_id AND n.id = i.id);""")
+        added = cur.rowcount
+        removed = 0
+    cur.close()
+    print(f"Copied {added} new items into {shadow_table} and removed {removed} deleted ones")
+
+def count_missing_embeddings(conn, settings):
+    cur = conn.cursor()
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"SELECT count(*) FROM {settings['shadow_table']} WHERE embedding IS NULL;")
+    missing = cur.fetchone()[0]
+    cur.close()
+    return missing
+
+def fetch_rows_to_embed(conn, settings, last_key, batch_size):
+    # Next rows without embedding after last_key, in the order of the primary key, so each pass walks the table once.
+    shadow_table = settings['shadow_table']
+    cur = conn.cursor()
+    if settings['table'] == "items":
+        query = f"SELECT n.tenant_id, n.id, n.description FROM {shadow_table} n"
+    else:
+        query = f"SELECT n.tenant_id, n.id, i.description FROM {shadow_table} n JOIN items i ON i.tenant_id = n.tenant_id AND i.id = n.id"
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(query + " WHERE n.embedding IS NULL AND (n.tenant_id, n.id) > (%s, %s) ORDER BY n.tenant_id, n.id LIMIT %s;",
+                (last_key[0], last_key[1], batch_size))
+    rows = cur.fetchall()
+    cur.close()
+    return rows
+
+def write_embeddings(conn, settings, rows):
+    # Update the whole batch in one statement. Rows whose embedding failed stay without embedding for the next pass.
+    cur = conn.cursor()
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    psycopg2.extras.execute_values(cur,
+        f"UPDATE {settings['shadow_table']} AS n SET embedding = v.embedding::vector FROM (VALUES %s) AS v (tenant_id, id, embedding) WHERE n.tenant_id = v.tenant_id AND n.id = v.id;",
+        rows,
+        template="(%s, %s::bigint, %s)",
+        page_size=len(rows))
+    cur.close()
+
+def handler(event, context):
+    print(event)
+    # Embed the items of the live catalog into the shadow table of the catalog rebuild, as fast as the embedding model allows.
+    # The live table and its vector index are not touched, and the searches run on the reader instance.
+    resume = event.get('resume', {})
+    passes = resume.get('pass', 0)
+    last_key = resume.get('last_key')
+
+    conn = db.connect_for_writing()
+    try:
+        rebuild = get_active_rebuild(conn)
+        if rebuild is None:
+            print("There is no catalog rebuild to load. Start one with the rebuild_prepare action of the vector index admin Lambda function")
+            return {"statusCode": 400}
+        settings = rebuild['settings']
+        set_rebuild_status(conn, rebuild['id'], STATUS_LOADING)
+        if not settings.get('model_id'):
+            # Without model ID, the rebuild is embedded with the deployed model
+            settings['model_id'] = embedding_model_id
+            set_rebuild_model_id(conn, rebuild['id'], embedding_model_id)
+
+        embedding_client = get_embedding_client(settings['model_id'], settings.get('normalize', False), settings.get('dimension'))
+        embedding_client.reset_stats()
+
+        while True:
+            if last_key is None:
+                # Start of a pass
+                sync_shadow_table(conn, settings)
+                missing = count_missing_embeddings(conn, settings)
+                if missing == 0:
+                    set_rebuild_status(conn, rebuild['id'], STATUS_LOADED)
+                    print(f"Catalog rebuild {rebuild['id']} is loaded. Continue with the rebuild_index action")
+                    break
+                if passes >= MAX_PASSES:
+                    print(f"{missing} items are still without embedding after {passes} passes. Check the errors above and invoke this function again")
+                    break
+                passes = passes + 1
+                last_key = ["", 0]
+                print(f"Pass {passes}: {missing} items to embed")
+
+            rows = fetch_rows_to_embed(conn, settings, last_key, reembed_batch_size)
+            if len(rows) == 0:
+                last_key = None
+                continue
+
+            embeddings = embedding_client.embed_many([row[2] for row in rows])
+            values = [(tenant_id, item_id, str(embedding)) for (tenant_id, item_id, _), embedding in zip(rows, embeddings) if not isinstance(embedding, Exception)]
+            for embedding in embeddings:
+                if isinstance(embedding, Exception): print(f"Embedding failed: {embedding}")
+            if len(values) > 0: write_embeddings(conn, settings, values)
+            last_key = [rows[-1][0], rows[-1][1]]
+            print(f"Embedded {len(values)} of {len(rows)} items up to {last_key}. {format_embedding_stats(embedding_client.stats())}")
+
+            if context.get_remaining_time_in_millis() < REMAINING_TIME_MARGIN_MS:
+                # Running out of time. Continue from the last key in a new invocation.
+                lambda_client.invoke(
+                    FunctionName=context.invoked_function_arn,
+                    InvocationType='Event',
+                    Payload=json.dumps({"resume": {"pass": passes, "last_key": last_key}}).encode("utf-8")
+                )
+                break
+    finally:
+        if db.conn is not None: db.close_connection()
+
+    return {
+        "statusCode": 200
+    }
@@ -0,0 +1,146 @@
+import os, json, urllib.parse
+import boto3
+from helper.tenant import DEFAULT_TENANT, validate_tenant_id
+from ingest import IngestEnvironment, iter_delimited_records, ingest_items, format_embedding_stats
+
+s3 = boto3.client('s3')
+lambda_client = boto3.client('lambda')
+
+# The environment variables, database and embedding client shared with the other ingest functions
+ingest_env = IngestEnvironment(os.environ)
+catalog_delimiter = os.environ.get('CATALOG_DELIMITER', '###')
+checkpoint_prefix = os.environ.get('CHECKPOINT_PREFIX', 'checkpoints/')
+read_chunk_size = int(os.environ.get('READ_CHUNK_SIZE', str(1024 * 1024)))
+
+# Stop taking new batches when less than this remains before the Lambda timeout, then continue in a new invocation.
+REMAINING_TIME_MARGIN_MS = 120000
+
+db = ingest_env.db
+
+def get_objects(event):
+    # Supports S3 event notifications, Amazon EventBridge "Object Created" events, and the resume event sent by this function.
+    if 'Records' in event:
+        return [(r['s3']['bucket']['name'], urllib.parse.unquote_plus(r['s3']['object']['key'])) for r in event['Records']]
+    if 'detail' in event:
+        return [(event['detail']['bucket']['name'], event['detail']['object']['key'])]
+    return [(o['bucket'], o['key']) for o in event['resume']]
+
+def get_checkpoint_key(key):
+    return f"{checkpoint_prefix}{key}.json"
+
+def load_checkpoint(bucket, key, etag):
+    try:
+        checkpoint = json.loads(s3.get_object(Bucket=bucket, Key=get_checkpoint_key(key))['Body'].read())
+    except s3.exceptions.NoSuchKey:
+        return None
+    # A checkpoint of a previous version of the object is not valid for the new one.
+    if checkpoint['etag'] != etag: return None
+    return checkpoint
+
+def save_checkpoint(bucket, key, checkpoint):
+    s3.put_object(Bucket=bucket, Key=get_checkpoint_key(key), Body=json.dumps(checkpoint).encode("utf-8"))
+
+def get_failed_records_prefix(key):
+    return f"{checkpoint_prefix}{key}.failed/"
+
+def save_failed_records(bucket, key, failed_records, start_offset, end_offset):
+    # Dead-letter object of the records of a batch which failed, as NDJSON with the byte range of each record in the catalog object.
+    # It is written before the checkpoint moves past them, so they can be loaded again once the cause is fixed.
+    failed_key = f"{get_failed_records_prefix(key)}{start_offset:020d}-{end_offset:020d}.ndjson"
+    s3.put_object(Bucket=bucket, Key=failed_key, Body="\n".join(json.dumps(record) for record in failed_records).encode("utf-8"))
+    print(f"Saved {len(failed_records)} failed records to s3://{bucket}/{failed_key}")
+
+def ingest_object(bucket, key, context):
+    head = s3.head_object(Bucket=bucket, Key=key)
+    checkpoint = load_checkpoint(bucket, key, head['ETag'])
+    if checkpoint is None:
+        checkpoint = {"etag": head['ETag'], "size": head['ContentLength'], "offset": 0, "succeeded": 0, "skipped": 0, "failed": 0, "completed": False}
+    if checkpoint['completed'] or checkpoint['offset'] >= head['ContentLength']:
+        print(f"s3://{bucket}/{key} has already been ingested")
+        return True, checkpoint
+    # The catalog object is loaded into the tenant given in its "tenant-id" user metadata, e.g. aws s3 cp catalog.txt s3://... --metadata tenant-id=brand_a
+    tenant_id = validate_tenant_id(head.get('Metadata', {}).get('tenant-id', DEFAULT_TENANT))
+    print(f"Ingesting s3://{bucket}/{key} into tenant {tenant_id} from byte {checkpoint['offset']} of {head['ContentLength']}")
+
+    query_template = ingest_env.load_query_template(s3)
+    body = s3.get_object(Bucket=bucket, Key=key, IfMatch=head['ETag'], Range=f"bytes={checkpoint['offset']}-")['Body']
+
+    def ingest_batch(batch, offsets, end_offset):
+        # Checked for each batch, as a catalog rebuild may be swapped in during a long load
+        ingest_env.apply_catalog_settings()
+        results = ingest_items(db, ingest_env.embedding_client, query_template, batch,
+                               batch_size=ingest_env.bulk_batch_size,
+                               tenant_id=tenant_id,
+                               near_duplicates=ingest_env.near_duplicates)
+        failed_records = []
+        for r in results:
+            if r['status'] != "failed": continue
+            record_start, record_end = offsets[r['index']]
+            print(f"Failed to ingest the record at bytes {record_start}-{record_end}: {r['error']}")
+            failed_records.append({"start_offset": record_start, "end_offset": record_end, "text": batch[r['index']]['text'], "error": r['error']})
+        if len(failed_records) > 0:
+            save_failed_records(bucket, key, failed_records, checkpoint['offset'], end_offset)
+            checkpoint['failed_records_prefix'] = get_failed_records_prefix(key)
+        for status in ["succeeded", "skipped", "duplicate", "failed"]:
+            checkpoint[status] = checkpoint.get(status, 0) + len([r for r in results if r['status'] == status])
+        checkpoint['offset'] = end_offset
+        save_checkpoint(bucket, key, checkpoint)
+        print(f"Checkpoint at byte {end_offset} of {checkpoint['size']}: {checkpoint['succeeded']} succeeded, {checkpoint['skipped']} skipped, {checkpoint['failed']} failed")
+        print(f"Embedding: {format_embedding_stats(ingest_env.embedding_client.stats())}")
+
+    batch = []
+    # Byte range of each record of the batch in the catalog object
+    offsets = []
+    record_start = checkpoint['offset']
+    for text, end_offset in iter_delimited_records(body.iter_chunks(read_chunk_size), catalog_delimiter, start_offset=checkpoint['offset']):
+        if text != '' and not text.isspace():
+            batch.append({"text": text})
+            offsets.append((record_start, end_offset))
+        record_start = end_offset
+        if len(batch) < ingest_env.bulk_batch_size: continue
+
+        ingest_batch(batch, offsets, end_offset)
+        batch = []
+        offsets = []
+        if context.get_remaining_time_in_millis() < REMAINING_TIME_MARGIN_MS:
+            body.close()
+            return False, checkpoint
+
+    if len(batch) > 0: ingest_batch(batch, offsets, checkpoint['size'])
+    checkpoint['offset'] = checkpoint['size']
+    checkpoint['completed'] = True
+    save_checkpoint(bucket, key, checkpoint)
+    print(f"Finished ingesting s3://{bucket}/{key}: {checkpoint['succeeded']} succeeded, {checkpoint['skipped']} skipped, {checkpoint['failed']} failed")
+    return True, checkpoint
+
+def handler(event, context):
+    print(event)
+
+    # Counts of each object so far, including the previous invocations of a resumed object
+    results = []
+    try:
+        objects = get_objects(event)
+        for i, (bucket, key) in enumerate(objects):
+            finished, checkpoint = ingest_object(bucket, key, context)
+            results.append({"bucket": bucket, 
+                            "key": key, 
+                            "completed": finished, 
+                            **{status: checkpoint.get(status, 0) for status in ["succeeded", "skipped", "duplicate", "failed"]},
+                            "failed_records_prefix": checkpoint.get('failed_records_prefix')})
+            if not finished:
+                # Running out of time. Continue from the saved checkpoint in a new invocation.
+                print(f"Resuming s3://{bucket}/{key} in a new invocation")
+                lambda_client.invoke(
+                    FunctionName=context.invoked_function_arn,
+                    InvocationType='Event',
+                    Payload=json.dumps({"resume": [{"bucket": b, "key": k} for b, k in objects[i:]]}).encode("utf-8")
+                )
+                break
+    finally:
+        if db.conn is not None: db.close_connection()
+
+    return {
+        "statusCode": 200,
+        "failed": sum(result['failed'] for result in results),
+        "objects": results
+    }
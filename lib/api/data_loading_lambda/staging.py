@@ -0,0 +1,37 @@
+from helper.storage_layout import STORAGE_LAYOUT_SPLIT
+
+def get_partitioned_tenants(conn):
+    # Tenants with a partition in the items table. Rows of other tenants cannot be merged and stay in the staging table.
+    cur = conn.cursor()
+    cur.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'items'::regclass;")
+    tenants = [r[0][len("items_"):] for r in cur.fetchall()]
+    cur.close()
+    return tenants
+
+def count_staged_items(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT count(*) FROM items_staging;")
+    count = cur.fetchone()[0]
+    cur.close()
+    return count
+
+def merge_staged_items(conn, storage_layout, tenants, batch_size):
+    # Move the oldest staged items into the indexed table in one statement, so each row is in exactly one of the two tables
+    # for the searches. The items keep their IDs, and the ones whose content was loaded directly meanwhile are dropped.
+    # Rows locked by a concurrent merge are skipped. Returns the number of rows taken from the staging table and the number merged.
+    batch = """WITH batch AS (DELETE FROM items_staging WHERE id IN (SELECT id FROM items_staging WHERE tenant_id = ANY(%s) ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED)
+                              RETURNING id, tenant_id, description, embedding, content_hash)"""
+    if storage_layout == STORAGE_LAYOUT_SPLIT:
+        query = batch + """, inserted AS (INSERT INTO items (id, tenant_id, description, content_hash) SELECT id, tenant_id, description, content_hash FROM batch
+                                          ON CONFLICT (tenant_id, content_hash) DO NOTHING RETURNING tenant_id, id),
+                             vectors AS (INSERT INTO item_vectors (tenant_id, id, embedding) SELECT batch.tenant_id, batch.id, batch.embedding FROM batch JOIN inserted USING (tenant_id, id))"""
+    else:
+        query = batch + """, inserted AS (INSERT INTO items (id, tenant_id, description, embedding, content_hash) SELECT id, tenant_id, description, embedding, content_hash FROM batch
+                                          ON CONFLICT (tenant_id, content_hash) DO NOTHING RETURNING id)"""
+    query = query + " SELECT (SELECT count(*) FROM batch), (SELECT count(*) FROM inserted);"
+    cur = conn.cursor()
+    cur.execute(query, (list(tenants), batch_size))
+    taken, merged = cur.fetchone()
+    cur.close()
+    conn.commit()
+    return taken, merged
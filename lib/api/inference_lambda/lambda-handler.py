@@ -1,92 +1,375 @@
+import time
+init_started_at = time.monotonic()
 import os, json
 import boto3
-import psycopg2, psycopg2.extras
+import psycopg2, psycopg2.errors, psycopg2.extras
+from helper.catalog_settings import get_catalog_settings
+from helper.distance_metric import get_distance_operator, normalize_embedding
+from helper.embedding_provider import INPUT_TYPE_QUERY, get_embedding_provider
+from helper.tenant import DEFAULT_TENANT, is_valid_tenant_id
+from helper.request_id import get_request_id, find_request_id, tag_reply
+from helper.runtime_hooks import PhaseTimer, after_restore, before_snapshot
+from helper.sharding import get_additional_shards
+from llm import ModelRouter, parse_item_types, ITEM_TYPE_DELIMITER
+from read_router import ReadRouter
+from sharded_database import ShardedDatabase
 
-bedrock = boto3.client("bedrock-runtime")
-s3 = boto3.client('s3')
-ssm = boto3.client('ssm')
+# The start of the function is split into phases, which are logged with their duration.
+# With SnapStart, the imports and the configuration are in the snapshot, while the AWS clients, the parameters,
+# the database credentials and the connection are set up again by connect() after each restore.
+init_timer = PhaseTimer(init_started_at)
+init_timer.log("imports")
 
 reader_endpoint = os.environ['DB_READER_ENDPOINT']
+# The searches fall back to the writer when no reader is available
+writer_endpoint = os.environ.get('DB_WRITER_ENDPOINT')
+additional_shards = get_additional_shards(os.environ.get('ADDITIONAL_DB_SHARDS', ''))
+# With a sharded catalog, the shards which do not answer within this time are left out of the results
+shard_timeout_ms = int(os.environ.get('SHARD_TIMEOUT_MS', '3000'))
 template_bucket_name = os.environ['TEMPLATE_BUCKET_NAME']
 prompt_template_object_path = os.environ['PROMPT_TEMPLATE_OBJECT_PATH']
 query_template_object_path = os.environ['QUERY_TEMPLATE_OBJECT_PATH']
 ssm_recommendation_parameter_name = os.environ['RECOMMENDATION_PARAMETER_NAME']
 ssm_llm_parameter_name = os.environ['LLM_PARAMETER_NAME']
 database_name = os.environ['DATABASE_NAME']
+distance_metric = os.environ.get('DISTANCE_METRIC', 'l2')
+normalize_embeddings = os.environ.get('NORMALIZE_EMBEDDINGS', 'false').lower() == 'true'
+embedding_model_id = os.environ.get('EMBEDDING_MODEL_ID', 'amazon.titan-embed-text-v1')
+embedding_dimension = int(os.environ.get('EMBEDDING_DIMENSION', '1536'))
+# "fail" stops the function from starting when the vector search would not use the vector index, "warn" only logs it, "off" skips the check.
+vector_index_check = os.environ.get('VECTOR_INDEX_CHECK', 'fail')
+
+distance_operator = get_distance_operator(distance_metric)
+
+# Set up by connect()
+bedrock = None
+s3 = None
+ssm = None
+# One embedding provider per embedding model and dimension of the catalog, see get_embedding_provider_for()
+embedding_providers = {}
+ssm_llm_parameters = None
+ssm_recommendation_parameters = None
+model_router = None
+
+# The embedding settings of the stored vectors, read again for each request by read_catalog_settings(), as a catalog rebuild swap changes them.
+# Until they are read, and when they cannot be read, the last known ones are used.
+catalog_settings = {"model_id": embedding_model_id, "dimension": embedding_dimension, "normalize": normalize_embeddings, "distance_metric": distance_metric}
     
 class Database():
-    def __init__(self, reader, database_name, port=5432):
+    def __init__(self, reader, database_name, port=5432, writer=None, connect_timeout=5, secret_id='AuroraClusterCredentials', statement_timeout_ms=None):
         self.reader_endpoint = reader
         self.username = None
         self.password = None
         self.database_name=database_name
         self.port = port
+        self.connect_timeout = connect_timeout
+        self.secret_id = secret_id
+        self.statement_timeout_ms = statement_timeout_ms
         self.conn = None
+        self.host = None
+        # Chooses the instance of each search among the readers of the cluster, by their latency
+        self.router = ReadRouter(reader, writer)
     
     def fetch_credentials(self):
         secrets_manager = boto3.client('secretsmanager')
         credentials = json.loads(secrets_manager.get_secret_value(
-            SecretId='AuroraClusterCredentials'
+            SecretId=self.secret_id
         )["SecretString"])
         self.username = credentials["username"]
         self.password = credentials["password"]
     
-    def connect_for_reading(self):
+    def connect_for_reading(self, host=None):
         if self.username is None or self.password is None: self.fetch_credentials()
+        if host is None: host = self.router.candidates()[0]
             
-        conn = psycopg2.connect(host=self.reader_endpoint, port=self.port, user=self.username, password=self.password, database=self.database_name)
+        # The statement timeout stops the searches on the server, instead of leaving them running after the caller gave up
+        options = f"-c statement_timeout={self.statement_timeout_ms}" if self.statement_timeout_ms is not None else None
+        conn = psycopg2.connect(host=host, port=self.port, user=self.username, password=self.password, database=self.database_name, connect_timeout=self.connect_timeout, options=options)
         conn.autocommit = True
         self.conn = conn
+        self.host = host
+        # The reader instances change when readers are added, removed or promoted, so they are discovered again from time to time
+        if self.router.needs_refresh(): self.router.refresh(conn)
         return conn
     
     def close_connection(self):
-        self.conn.close()
-        self.conn = None
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            finally:
+                self.conn = None
+                self.host = None
     
-    def search(self, query_template, embedding, num_items=1, additional_query_parameters=[]):
+    def get_catalog_settings(self, model_id, dimension, normalize, distance_metric):
         if self.conn is None:
             self.connect_for_reading()
-        
+        return get_catalog_settings(self.conn, model_id, dimension, normalize, distance_metric)
+    
+    def search(self, query_template, embedding, num_items=1, additional_query_parameters=[], tenant_id=DEFAULT_TENANT, operator=None):
+        # The tenant ID is a literal in the statement, so PostgreSQL prunes the other partitions when planning it
+        # and only the vector index of the tenant is used. It is validated by the handler.
+        # The operator is the one of the distance metric of the catalog, or of the deployment by default.
         all_query_parameters = [embedding, str(num_items)] + additional_query_parameters
-        query_statement = query_template.format(*all_query_parameters)
+        query_statement = query_template.format(*all_query_parameters, distance_operator=operator or distance_operator, tenant_id=tenant_id)
         
-        cur = self.conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
-        # Disabling semgrep rule for raw query as this is meant to be run by admin/engineer with authentication
-        # nosemgrep: python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
-        cur.execute(query_statement)
-        results = cur.fetchall()
-        cur.close()
-        print(f'Query response: {results}')
-        return results
-
-db = Database(reader=reader_endpoint, database_name=database_name)
-db.connect_for_reading()
-
-ssm_llm_parameters = json.loads(ssm.get_parameter(
-    Name=ssm_llm_parameter_name
-)['Parameter']['Value'])
-ssm_recommendation_parameters = json.loads(ssm.get_parameter(
-    Name=ssm_recommendation_parameter_name
-)['Parameter']['Value'])
+        # The search goes to the fastest healthy reader. When the instance is unreachable or fails during the search,
+        # it is skipped for a while and the search is retried on the next one, up to the writer.
+        error = None
+        for host in self.router.candidates(self.host):
+            try:
+                if self.conn is None or self.host != host:
+                    self.close_connection()
+                    self.connect_for_reading(host)
+                started_at = time.monotonic()
+                cur = self.conn.cursor(cursor_factory = psycopg2.extras.RealDictCursor)
+                # Disabling semgrep rule for raw query as this is meant to be run by admin/engineer with authentication
+                # nosemgrep: python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+                cur.execute(query_statement)
+                results = cur.fetchall()
+                cur.close()
+            except psycopg2.errors.QueryCanceled:
+                # Stopped by the statement timeout or cancelled by the caller, which says nothing about the health of the instance
+                raise
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                print(f"The search failed on {host}, trying the next instance: {e}")
+                error = e
+                self.router.mark_unhealthy(host)
+                self.close_connection()
+                continue
+            latency = time.monotonic() - started_at
+            self.router.record_latency(host, latency)
+            print(f'Query response from {host} in {latency * 1000:.0f} ms: {results}')
+            return results
+        raise error
+    
+    def explain_search(self, query_template):
+        # Plan of the search query with sequential scans disabled. If the plan still has no index scan, the vector index
+        # cannot serve the query at all, e.g. because its operator class does not match the distance operator of the query.
+        if self.conn is None:
+            self.connect_for_reading()
+        
+        cur = self.conn.cursor()
+        # The dimension of the vector column is stored as its type modifier
+        cur.execute("SELECT atttypmod FROM pg_attribute WHERE attrelid = 'items'::regclass AND attname = 'embedding';")
+        embedding_dimension = cur.fetchone()[0]
+        query_statement = query_template.format(str([0.0] * embedding_dimension), "1", distance_operator=distance_operator, tenant_id=DEFAULT_TENANT)
+        
+        cur.execute("SET enable_seqscan = off;")
+        try:
+            # Disabling semgrep rule for raw query as the query template is deployed by admin/engineer with authentication
+            # nosemgrep: python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+            cur.execute("EXPLAIN " + query_statement)
+            plan = "\n".join(row[0] for row in cur.fetchall())
+        finally:
+            cur.execute("RESET enable_seqscan;")
+            cur.close()
+        return plan
+
+def get_database():
+    # The cluster of the deployment is the first shard, followed by the additional shards in their configured order
+    if len(additional_shards) == 0: return Database(reader=reader_endpoint, database_name=database_name, writer=writer_endpoint)
+    shards = [Database(reader=reader_endpoint, database_name=database_name, writer=writer_endpoint, statement_timeout_ms=shard_timeout_ms)]
+    for shard in additional_shards:
+        shards.append(Database(reader=shard.get("reader", shard["writer"]), 
+                               database_name=database_name, 
+                               port=shard.get("port", 5432), 
+                               writer=shard["writer"], 
+                               secret_id=shard["secret_arn"], 
+                               statement_timeout_ms=shard_timeout_ms))
+    return ShardedDatabase(shards, shard_timeout_ms=shard_timeout_ms)
+
+db = get_database()
+
+def check_vector_index_usage():
+    query_template = s3.get_object(Bucket=template_bucket_name, Key=query_template_object_path)['Body'].read().decode("utf-8")
+    try:
+        plan = db.explain_search(query_template)
+    except IndexError:
+        print("Skipping the vector index check, as the vector search query template needs additional query parameters")
+        return
+    
+    if "Index Scan" in plan:
+        print(f"The vector search uses the vector index with distance metric {distance_metric}:\n{plan}")
+        return
+    
+    message = f"The vector search query does not use the vector index. Check that the query uses the {distance_operator} operator of the distance metric {distance_metric}, and that the index is built with the same metric. Query plan:\n{plan}"
+    if vector_index_check == "fail": raise Exception(message)
+    print(message)
+
+def get_shards():
+    return db.shards if isinstance(db, ShardedDatabase) else [db]
+
+def get_embedding_provider_for(settings):
+    key = (settings['model_id'], settings['dimension'])
+    if key not in embedding_providers:
+        # The search query is embedded as a query, for the models which embed documents and queries differently
+        embedding_providers[key] = get_embedding_provider(key[0], bedrock=bedrock, dimension=key[1], input_type=INPUT_TYPE_QUERY)
+    return embedding_providers[key]
+
+def connect():
+    # Runs when the execution environment starts, and again after each restore from a SnapStart snapshot
+    global bedrock, s3, ssm, embedding_providers, ssm_llm_parameters, ssm_recommendation_parameters, model_router
+    timer = PhaseTimer()
+    bedrock = boto3.client("bedrock-runtime")
+    s3 = boto3.client('s3')
+    ssm = boto3.client('ssm')
+    # The providers hold the Bedrock client, so they are built again with the new one
+    embedding_providers = {}
+    get_embedding_provider_for(catalog_settings)
+    timer.log("clients")
+    
+    # Read again after a restore, so that the parameters updated after the snapshot are used
+    ssm_llm_parameters = json.loads(ssm.get_parameter(
+        Name=ssm_llm_parameter_name
+    )['Parameter']['Value'])
+    ssm_recommendation_parameters = json.loads(ssm.get_parameter(
+        Name=ssm_recommendation_parameter_name
+    )['Parameter']['Value'])
+    model_router = ModelRouter(ssm_recommendation_parameters.get('model_routing'), ssm_recommendation_parameters['model_id'])
+    timer.log("parameters")
+    
+    # The credentials are fetched again too, in case the secret was rotated after the snapshot
+    for shard in get_shards():
+        shard.fetch_credentials()
+    db.connect_for_reading()
+    timer.log("database")
+
+def disconnect():
+    # The connection and the credentials must not be in the snapshot, as all restored environments would share them
+    db.close_connection()
+    for shard in get_shards():
+        shard.username = None
+        shard.password = None
+        shard.router.reset()
+
+init_timer.log("configuration")
+connect()
+init_timer.log("connect")
+if vector_index_check != "off": check_vector_index_usage()
+init_timer.log("vector index check")
+before_snapshot(disconnect)
+after_restore(connect)
+init_timer.log_total("init")
+
+# Search modes. "reasoning" asks the LLM for the item types first, while "direct" embeds the input text as is and skips the LLM.
+SEARCH_MODE_REASONING = "reasoning"
+SEARCH_MODE_DIRECT = "direct"
+
+def read_catalog_settings():
+    global catalog_settings
+    try:
+        settings = db.get_catalog_settings(embedding_model_id, embedding_dimension, normalize_embeddings, distance_metric)
+    except Exception as e:
+        print(f"Could not read the catalog settings, using the last known ones: {e}")
+        db.close_connection()
+        return catalog_settings
+    if settings != catalog_settings: print(f"Catalog settings: {settings}")
+    catalog_settings = settings
+    return settings
+
+def get_embedding(text, settings):
+    embedding = get_embedding_provider_for(settings).embed(text)
+    # The query embedding is normalized like the stored embeddings
+    return normalize_embedding(embedding) if settings['normalize'] else embedding
+
+def build_llm_parameters(num_types):
+    llm_parameters = dict(ssm_llm_parameters)
+    
+    # Bound the generation to what is needed for num_types item types, instead of the generic max_tokens_to_sample.
+    max_tokens_per_type = int(ssm_recommendation_parameters.get('max_tokens_per_type', 300))
+    token_budget = num_types * max_tokens_per_type
+    if 'max_tokens_to_sample' in llm_parameters:
+        token_budget = min(token_budget, int(llm_parameters['max_tokens_to_sample']))
+    llm_parameters['max_tokens_to_sample'] = token_budget
+    
+    # Stop as soon as the model starts a new conversation turn, on top of any configured stop sequences.
+    stop_sequences = list(llm_parameters.get('stop_sequences', []))
+    if "\n\nHuman:" not in stop_sequences: stop_sequences.append("\n\nHuman:")
+    # A stop sequence ends the generation at its first occurrence, so the delimiter only stops it right after the last item type
+    # when a single one is requested. With more item types, the streamed completion is stopped by counting them, see stream_completion.
+    if num_types == 1 and "\n" + ITEM_TYPE_DELIMITER not in stop_sequences: stop_sequences.append("\n" + ITEM_TYPE_DELIMITER)
+    llm_parameters['stop_sequences'] = stop_sequences
+    return llm_parameters
+
+def get_recommended_item_types(input_text, additional_prompt_parameters=[], latency_tier=None):
+    num_types = int(ssm_recommendation_parameters['num_types'])
+    
+    # Substitute placeholders in the prompt with real values
+    prompt_template = s3.get_object(Bucket=template_bucket_name, Key=prompt_template_object_path)['Body'].read().decode("utf-8")
+    all_prompt_parameters = [input_text, str(num_types)] + additional_prompt_parameters
+    prompt = prompt_template.format(*all_prompt_parameters)
+    
+    # Get the recommended item text from LLM
+    model_id = model_router.choose_model(input_text, latency_tier)
+    stream_completion = str(ssm_recommendation_parameters.get('stream_completion', False)).lower() == "true"
+    completion = model_router.invoke(bedrock, model_id, prompt, build_llm_parameters(num_types), 
+                                     num_types=num_types if stream_completion else None)
+    
+    # Post-process suggested item types where it can be more than 1, and drop any extra item types beyond num_types.
+    return parse_item_types(completion)[:num_types]
+
+def reply(event, mode, status_code, body, content_type=None, request_id=None):
+    if mode == "websocket":
+        # Echo the client request ID, so that a client multiplexing requests on the connection can match the reply
+        if request_id is not None: body = tag_reply(body, status_code, request_id)
+        domain = event['requestContext']['domainName']
+        stage = event['requestContext']['stage']
+        connection_id = event['requestContext']['connectionId']
+        callback_url = f"https://{domain}/{stage}"
+        apigw = boto3.client('apigatewaymanagementapi', endpoint_url= callback_url)
+
+        response = apigw.post_to_connection(
+            Data=bytes(body, "utf-8"),
+            ConnectionId=connection_id
+        )
+        return {
+            "statusCode": status_code
+        }
+    
+    response = {
+        "statusCode": status_code,
+        'body': body
+    }
+    if content_type is not None:
+        response["headers"] = {
+            "Content-Type": content_type
+        }
+
+    return response
 
 def handler(event, context):
     print(event)
-    
-    additional_query_parameters = []
-    additional_prompt_parameters = []
 
     mode = "rest"
     if ('requestContext' in event) and ('routeKey' in event['requestContext']): mode = "websocket"
     
+    try:
+        return handle_request(event, mode)
+    except Exception as e:
+        if mode != "websocket": raise
+        # A WebSocket client waits for the reply with its request ID, so it gets an error reply instead of none
+        print(f"The request failed: {e}")
+        return reply(event, mode, 500, 'Internal server error', request_id=find_request_id(event.get('body')))
+
+def handle_request(event, mode):
+    additional_query_parameters = []
+    additional_prompt_parameters = []
+    search_mode = SEARCH_MODE_REASONING
+    latency_tier = None
+    tenant_id = DEFAULT_TENANT
+    
     event_body = event['body']
     if len(event_body) > 200000:
-        return {
-            "statusCode": 400,
-            'body': 'Event body is too large'
-        }
-    # Disabling semgrep rule for checking data size to be loaded to JSON as the check is already done right above.
-    # nosemgrep: python.aws-lambda.deserialization.tainted-json-aws-lambda.tainted-json-aws-lambda
-    event_body = json.loads(event_body)
+        return reply(event, mode, 400, 'Event body is too large', request_id=find_request_id(event_body))
+    try:
+        # Disabling semgrep rule for checking data size to be loaded to JSON as the check is already done right above.
+        # nosemgrep: python.aws-lambda.deserialization.tainted-json-aws-lambda.tainted-json-aws-lambda
+        event_body = json.loads(event_body)
+    except json.JSONDecodeError:
+        return reply(event, mode, 400, 'Event body must be a JSON object with a "text" string', request_id=find_request_id(event_body))
+    request_id = get_request_id(event_body)
+    if not isinstance(event_body, dict) or not isinstance(event_body.get('text'), str):
+        return reply(event, mode, 400, 'Event body must be a JSON object with a "text" string', request_id=request_id)
     input_text = event_body['text']
 
     if 'num_items' in event_body:
@@ -97,92 +380,66 @@ def handler(event, context):
         additional_query_parameters = event_body['additional_query_parameters']
     if 'additional_prompt_parameters' in event_body:
         additional_prompt_parameters = event_body['additional_prompt_parameters']
+    if 'search_mode' in event_body:
+        search_mode = event_body['search_mode']
+    if 'latency_tier' in event_body:
+        latency_tier = event_body['latency_tier']
+    if 'tenant_id' in event_body:
+        tenant_id = event_body['tenant_id']
     
-    # Substitute placeholders in the prompt with real values
-    prompt_template = s3.get_object(Bucket=template_bucket_name, Key=prompt_template_object_path)['Body'].read().decode("utf-8")
-    all_prompt_parameters = [input_text, str(ssm_recommendation_parameters['num_types'])] + additional_prompt_parameters
-    prompt = prompt_template.format(*all_prompt_parameters)
+    if not is_valid_tenant_id(tenant_id):
+        return reply(event, mode, 400, 'Invalid tenant_id', request_id=request_id)
+    
+    if search_mode not in [SEARCH_MODE_REASONING, SEARCH_MODE_DIRECT]:
+        return reply(event, mode, 400, f'Invalid search_mode. Valid values are: {SEARCH_MODE_REASONING}, {SEARCH_MODE_DIRECT}', request_id=request_id)
     
-    # TODO: Parallelize the below with call to first LLM
     # Download vector search query template from S3
     query_template = s3.get_object(Bucket=template_bucket_name, Key=query_template_object_path)['Body'].read().decode("utf-8")
     
-    # Merge prompt with the LLM parameters
-    ssm_llm_parameters['prompt'] = prompt
-    body = json.dumps(ssm_llm_parameters)
+    if search_mode == SEARCH_MODE_DIRECT:
+        # Fast path which skips the prompt building and the LLM call. The input text itself is used for the vector search.
+        recommended_item_types = [input_text]
+    else:
+        # TODO: Parallelize the below with the download of the vector search query template
+        recommended_item_types = get_recommended_item_types(input_text, additional_prompt_parameters, latency_tier)
     
-    # Get the recommended item text from LLM
-    response = bedrock.invoke_model(body=body, modelId=ssm_recommendation_parameters['model_id'])
-    
-    # Post-process suggested item types where it can be more than 1.
-    # Disabling semgrep rule for checking data size to be loaded to JSON as the source is from Amazon Bedrock
-    # nosemgrep: python.aws-lambda.deserialization.tainted-json-aws-lambda.tainted-json-aws-lambda
-    recommended_item_types = json.loads(response.get("body").read())["completion"]
-    recommended_item_types = recommended_item_types.split("###") if "\n###" in recommended_item_types else [recommended_item_types]
-    recommended_item_types = list(filter(lambda x: x != '' and not x.isspace(), recommended_item_types))
-    
-    recommended_item_embeddings = []
-    
-    # Call the text-to-embedding model to get the embedding for each of the suggested item types.
-    for item_type in recommended_item_types:
-        # Get the embedding of the recommended item text
-        body = json.dumps(
-            {
-                "inputText": item_type,
-            }
-        )
-
-        response = bedrock.invoke_model(body=body, modelId="amazon.titan-embed-text-v1")
-        # Disabling semgrep rule for checking data size to be loaded to JSON as the source is from Amazon Bedrock
-        # nosemgrep: python.aws-lambda.deserialization.tainted-json-aws-lambda.tainted-json-aws-lambda
-        recommended_item_embeddings.append(json.loads(response.get("body").read())["embedding"])
+    # Call the text-to-embedding model to get the embedding for each of the suggested item types,
+    # with the model of the stored vectors, which a catalog rebuild swap may have changed since the deployment.
+    settings = read_catalog_settings()
+    recommended_item_embeddings = [get_embedding(item_type, settings) for item_type in recommended_item_types]
 
     recommended_items = []
+    if isinstance(db, ShardedDatabase): db.failed_shards = set()
     
     # Do search on vector database 
     try:
         for embedding in recommended_item_embeddings:
             recommended_items = recommended_items + db.search(query_template, 
                                           embedding, 
-                                          num_items=ssm_recommendation_parameters['num_items'])
+                                          num_items=ssm_recommendation_parameters['num_items'],
+                                          tenant_id=tenant_id,
+                                          operator=get_distance_operator(settings['distance_metric']))
     except Exception as e:
         print("An exception happened when doing the search on the vector database")
         print(e)
     finally: 
         db.close_connection()
 
-    # Deduplicate
+    # Deduplicate. The IDs are per shard with a sharded catalog, so the items are identified by their shard too.
     final_recommended_items = {}
     for item in sorted(recommended_items, key = lambda k: k["distance"]):
-        if item['id'] not in final_recommended_items: final_recommended_items[item['id']] = item
-
-    final_recommended_items = list({'id': v[1]['id'], 'distance': v[1]['distance'], 'description': v[1]['description']} for v in final_recommended_items.items())
-    
-    if mode == "websocket":
-        domain = event['requestContext']['domainName']
-        stage = event['requestContext']['stage']
-        connection_id = event['requestContext']['connectionId']
-        callback_url = f"https://{domain}/{stage}"
-        apigw = boto3.client('apigatewaymanagementapi', endpoint_url= callback_url)
+        key = (item.get('shard'), item['id'])
+        if key not in final_recommended_items: final_recommended_items[key] = item
 
-        response = apigw.post_to_connection(
-            Data=bytes(json.dumps({
-                "items": final_recommended_items
-            }), "utf-8"),
-            ConnectionId=connection_id
-        )
-        return {
-            "statusCode": 200
-        }
+    final_recommended_items = list({'id': v[1]['id'], 'distance': v[1]['distance'], 'description': v[1]['description'], **({'shard': v[1]['shard']} if 'shard' in v[1] else {})} for v in final_recommended_items.items())
     
-    response = {
-        "statusCode": 200,
-        "headers": {
-            "Content-Type": "application/json"
-        },
-        "body": json.dumps({
-            "items": final_recommended_items
-        })
+    response_body = {
+        "items": final_recommended_items,
+        "search_mode": search_mode
     }
-
-    return response
\ No newline at end of file
+    if isinstance(db, ShardedDatabase) and len(db.failed_shards) > 0:
+        # The items come from the other shards only
+        response_body["partial"] = True
+        response_body["failed_shards"] = sorted(db.failed_shards)
+    
+    return reply(event, mode, 200, json.dumps(response_body), content_type="application/json", request_id=request_id)
@@ -0,0 +1,227 @@
+import json, time
+from collections import deque
+
+# Separator between the item types suggested by the LLM, as instructed in the prompt template.
+ITEM_TYPE_DELIMITER = "###"
+
+LATENCY_TIER_FAST = "fast"
+LATENCY_TIER_STANDARD = "standard"
+
+def parse_item_types(completion):
+    item_types = completion.split(ITEM_TYPE_DELIMITER) if "\n" + ITEM_TYPE_DELIMITER in completion else [completion]
+    return list(filter(lambda x: x != '' and not x.isspace(), item_types))
+
+def count_complete_item_types(completion):
+    # An item type is complete once the delimiter after it has been generated. The last item type may have no delimiter after it,
+    # so the trailing segment is also complete once it ends with a blank line, as a single newline also separates the lines of an item type.
+    segments = completion.split(ITEM_TYPE_DELIMITER)
+    if not segments[-1].endswith("\n\n"): segments = segments[:-1]
+    return len(list(filter(lambda x: x != '' and not x.isspace(), segments)))
+
+def strip_conversation_turns(prompt):
+    # The prompt template follows the "\n\nHuman: ... \n\nAssistant:" format of the Claude text completion API.
+    # Other model families take the plain instruction instead.
+    prompt = prompt.strip()
+    if prompt.startswith("Human:"): prompt = prompt[len("Human:"):]
+    if prompt.endswith("Assistant:"): prompt = prompt[:-len("Assistant:")]
+    return prompt.strip()
+
+class ModelAdapter():
+    # The LLM parameters stored in SSM use the Claude text completion names (temperature, top_k, max_tokens_to_sample, stop_sequences).
+    # Each adapter maps them into the request body of its model family and extracts the generated text from the response.
+    def build_body(self, prompt, llm_parameters):
+        raise NotImplementedError
+
+    def parse_response(self, response_body):
+        raise NotImplementedError
+
+    def parse_stream_chunk(self, chunk):
+        return self.parse_response(chunk)
+
+class ClaudeTextCompletionAdapter(ModelAdapter):
+    def build_body(self, prompt, llm_parameters):
+        body = dict(llm_parameters)
+        body['prompt'] = prompt
+        return body
+
+    def parse_response(self, response_body):
+        return response_body["completion"]
+
+class ClaudeMessagesAdapter(ModelAdapter):
+    def build_body(self, prompt, llm_parameters):
+        body = {
+            "anthropic_version": "bedrock-2023-05-31",
+            "messages": [{"role": "user", "content": strip_conversation_turns(prompt)}],
+            "max_tokens": llm_parameters.get('max_tokens_to_sample', 1000)
+        }
+        for key in ['temperature', 'top_k', 'top_p']:
+            if key in llm_parameters: body[key] = llm_parameters[key]
+        # The Messages API rejects the conversation turn markers as stop sequences
+        stop_sequences = [s for s in llm_parameters.get('stop_sequences', []) if not s.strip().endswith(("Human:", "Assistant:"))]
+        if len(stop_sequences) > 0: body['stop_sequences'] = stop_sequences
+        return body
+
+    def parse_response(self, response_body):
+        return "".join(c.get("text", "") for c in response_body["content"])
+
+    def parse_stream_chunk(self, chunk):
+        if chunk.get("type") == "content_block_delta": return chunk["delta"].get("text", "")
+        return ""
+
+class TitanTextAdapter(ModelAdapter):
+    def build_body(self, prompt, llm_parameters):
+        generation_config = {
+            "maxTokenCount": llm_parameters.get('max_tokens_to_sample', 1000)
+        }
+        if 'temperature' in llm_parameters: generation_config['temperature'] = llm_parameters['temperature']
+        if 'top_p' in llm_parameters: generation_config['topP'] = llm_parameters['top_p']
+        stop_sequences = [s for s in llm_parameters.get('stop_sequences', []) if not s.strip().endswith(("Human:", "Assistant:"))]
+        if len(stop_sequences) > 0: generation_config['stopSequences'] = stop_sequences
+        return {
+            "inputText": strip_conversation_turns(prompt),
+            "textGenerationConfig": generation_config
+        }
+
+    def parse_response(self, response_body):
+        return "".join(r["outputText"] for r in response_body["results"])
+
+    def parse_stream_chunk(self, chunk):
+        return chunk.get("outputText", "")
+
+class LlamaAdapter(ModelAdapter):
+    def build_body(self, prompt, llm_parameters):
+        body = {
+            "prompt": strip_conversation_turns(prompt),
+            "max_gen_len": llm_parameters.get('max_tokens_to_sample', 1000)
+        }
+        for key in ['temperature', 'top_p']:
+            if key in llm_parameters: body[key] = llm_parameters[key]
+        return body
+
+    def parse_response(self, response_body):
+        return response_body["generation"]
+
+def get_model_adapter(model_id):
+    # Model IDs may have a cross-region inference profile prefix e.g. "us.anthropic.claude-3-haiku-20240307-v1:0"
+    model_name = model_id.split("/")[-1]
+    if "anthropic.claude-v2" in model_name or "anthropic.claude-instant" in model_name:
+        return ClaudeTextCompletionAdapter()
+    if "anthropic.claude" in model_name:
+        return ClaudeMessagesAdapter()
+    if "amazon.titan-text" in model_name:
+        return TitanTextAdapter()
+    if "meta.llama" in model_name:
+        return LlamaAdapter()
+    raise Exception(f'Unsupported model: {model_id}')
+
+def invoke_llm(bedrock, model_id, prompt, llm_parameters):
+    adapter = get_model_adapter(model_id)
+    body = json.dumps(adapter.build_body(prompt, llm_parameters))
+    response = bedrock.invoke_model(body=body, modelId=model_id)
+    # Disabling semgrep rule for checking data size to be loaded to JSON as the source is from Amazon Bedrock
+    # nosemgrep: python.aws-lambda.deserialization.tainted-json-aws-lambda.tainted-json-aws-lambda
+    return adapter.parse_response(json.loads(response.get("body").read()))
+
+def invoke_llm_with_early_stop(bedrock, model_id, prompt, llm_parameters, num_types):
+    adapter = get_model_adapter(model_id)
+    body = json.dumps(adapter.build_body(prompt, llm_parameters))
+    response = bedrock.invoke_model_with_response_stream(body=body, modelId=model_id)
+    stream = response.get("body")
+
+    completion = ""
+    for event in stream:
+        chunk = event.get("chunk")
+        if chunk is None: continue
+        # Disabling semgrep rule for checking data size to be loaded to JSON as the source is from Amazon Bedrock
+        # nosemgrep: python.aws-lambda.deserialization.tainted-json-aws-lambda.tainted-json-aws-lambda
+        completion += adapter.parse_stream_chunk(json.loads(chunk.get("bytes").decode("utf-8")))
+
+        # Cancel the stream once enough item types are generated, so we do not wait for text to be thrown away.
+        if count_complete_item_types(completion) >= num_types:
+            print(f"Stopping the LLM stream early after {num_types} item types")
+            stream.close()
+            break
+
+    return completion
+
+class ModelRouter():
+    # Chooses the LLM for each request based on the input length, the requested latency tier and the latency observed
+    # on previous invocations in this Lambda execution environment.
+    #
+    # routing_parameters example:
+    # {
+    #     "short_input_length": 500,   # Inputs shorter than this go to the "fast" tier when no tier is requested.
+    #     "latency_window": 20,        # Number of latest invocations per model used for the rolling latency.
+    #     "failure_cooldown": 60,      # Seconds a model which failed, e.g. throttled, is avoided while other models fit.
+    #     "models": [
+    #         {"model_id": "anthropic.claude-instant-v1", "latency_tier": "fast", "max_input_length": 2000},
+    #         {"model_id": "anthropic.claude-v2", "latency_tier": "standard"}
+    #     ]
+    # }
+    def __init__(self, routing_parameters, default_model_id):
+        if routing_parameters is None: routing_parameters = {}
+        self.default_model_id = default_model_id
+        self.models = routing_parameters.get('models', [])
+        self.short_input_length = int(routing_parameters.get('short_input_length', 500))
+        self.latency_window = int(routing_parameters.get('latency_window', 20))
+        self.failure_cooldown = float(routing_parameters.get('failure_cooldown', 60))
+        self.latencies = {}
+        self.unhealthy_until = {}
+
+    def rolling_latency(self, model_id):
+        if model_id not in self.latencies or len(self.latencies[model_id]) == 0: return None
+        return sum(self.latencies[model_id]) / len(self.latencies[model_id])
+
+    def record_latency(self, model_id, latency):
+        if model_id not in self.latencies: self.latencies[model_id] = deque(maxlen=self.latency_window)
+        self.latencies[model_id].append(latency)
+
+    def mark_unhealthy(self, model_id):
+        # A failed call returns quickly, so it is not recorded as a latency sample. The model is avoided for a cooldown instead,
+        # and its previous latencies are dropped, so that it is measured again once it is back.
+        self.unhealthy_until[model_id] = time.monotonic() + self.failure_cooldown
+        self.latencies.pop(model_id, None)
+
+    def is_healthy(self, model_id):
+        return time.monotonic() >= self.unhealthy_until.get(model_id, 0)
+
+    def choose_model(self, input_text, latency_tier=None):
+        if len(self.models) == 0: return self.default_model_id
+
+        if latency_tier is None:
+            latency_tier = LATENCY_TIER_FAST if len(input_text) < self.short_input_length else LATENCY_TIER_STANDARD
+
+        fitting_models = [m for m in self.models if len(input_text) <= int(m.get('max_input_length', len(input_text)))]
+        if len(fitting_models) == 0: fitting_models = self.models
+        candidates = [m for m in fitting_models if m.get('latency_tier', LATENCY_TIER_STANDARD) == latency_tier]
+        if len(candidates) == 0: candidates = fitting_models
+        # The models which failed recently are only used when no other candidate is left
+        healthy_candidates = [m for m in candidates if self.is_healthy(m['model_id'])]
+        if len(healthy_candidates) == 0: healthy_candidates = [m for m in fitting_models if self.is_healthy(m['model_id'])]
+        if len(healthy_candidates) > 0: candidates = healthy_candidates
+
+        # Models without observed latency yet are tried first (in the configured order), then the fastest one is preferred.
+        def sort_key(indexed_model):
+            index, model = indexed_model
+            latency = self.rolling_latency(model['model_id'])
+            return (latency is not None, latency if latency is not None else 0, index)
+        model = sorted(enumerate(candidates), key=sort_key)[0][1]
+
+        print(f"Routing to model {model['model_id']} for latency tier {latency_tier} and input length {len(input_text)}")
+        return model['model_id']
+
+    def invoke(self, bedrock, model_id, prompt, llm_parameters, num_types=None):
+        start_time = time.monotonic()
+        try:
+            if num_types is None:
+                completion = invoke_llm(bedrock, model_id, prompt, llm_parameters)
+            else:
+                completion = invoke_llm_with_early_stop(bedrock, model_id, prompt, llm_parameters, num_types)
+        except Exception as e:
+            self.mark_unhealthy(model_id)
+            print(f"LLM {model_id} failed after {time.monotonic() - start_time:.3f}s, avoiding it for {self.failure_cooldown:.0f}s: {e}")
+            raise
+        latency = time.monotonic() - start_time
+        self.record_latency(model_id, latency)
+        print(f"LLM {model_id} latency: {latency:.3f}s, rolling latency: {self.rolling_latency(model_id):.3f}s")
+        return completion
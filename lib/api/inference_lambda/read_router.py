@@ -0,0 +1,91 @@
+import random, re, time
+from collections import deque
+
+# Aurora endpoints are "<cluster>.cluster-ro-<suffix>" for the readers and "<instance>.<suffix>" for each instance
+CLUSTER_ENDPOINT_PATTERN = re.compile(r"^[^.]+\.cluster-(?:ro-)?(.+)$")
+
+class ReadRouter():
+    # Chooses the database instance for each search. The reader endpoint of the cluster resolves to a random reader by DNS,
+    # whether that reader is busy, slow or restarting, and the DNS answer may still point to a reader which is gone.
+    # Instead, the reader instances are discovered from aurora_replica_status(), and each search goes to the healthy reader
+    # with the lowest rolling latency observed in this execution environment. Readers without observed latency yet are tried first,
+    # and a share of the searches goes to a random healthy reader, so that the latencies of the others stay up to date.
+    # A reader which fails is skipped for a cooldown, and the writer serves the searches when no reader is available.
+    def __init__(self, reader_endpoint, writer_endpoint=None, refresh_interval=60, latency_window=20, cooldown=30, explore_rate=0.1):
+        self.reader_endpoint = reader_endpoint
+        self.writer_endpoint = writer_endpoint
+        self.refresh_interval = refresh_interval
+        self.latency_window = latency_window
+        self.cooldown = cooldown
+        self.explore_rate = explore_rate
+        match = CLUSTER_ENDPOINT_PATTERN.match(reader_endpoint)
+        # Without an Aurora cluster endpoint, e.g. with a plain PostgreSQL host, the reader endpoint is used as it is
+        self.instance_suffix = match.group(1) if match else None
+        self.reset()
+
+    def reset(self):
+        # Forgets the instances and their latencies, e.g. before a SnapStart snapshot, as they would be stale in the restored environments
+        self.readers = []
+        self.refreshed_at = None
+        self.latencies = {}
+        self.unhealthy_until = {}
+
+    def needs_refresh(self):
+        if self.instance_suffix is None: return False
+        return self.refreshed_at is None or time.monotonic() - self.refreshed_at > self.refresh_interval
+
+    def refresh(self, conn):
+        # Reads the instances of the cluster from any of its instances. Only the instances which reported recently are kept.
+        self.refreshed_at = time.monotonic()
+        cur = conn.cursor()
+        try:
+            cur.execute("""SELECT server_id, session_id = 'MASTER_SESSION_ID' AS is_writer FROM aurora_replica_status()
+                           WHERE last_update_timestamp > now() - interval '5 minutes';""")
+            instances = cur.fetchall()
+        except Exception as e:
+            # e.g. on PostgreSQL without Aurora. The searches keep going to the instances known so far, or to the reader endpoint.
+            print(f"Could not discover the reader instances: {e}")
+            return
+        finally:
+            cur.close()
+
+        readers = sorted(f"{server_id}.{self.instance_suffix}" for server_id, is_writer in instances if not is_writer)
+        if readers != self.readers: print(f"Reader instances: {readers}")
+        self.readers = readers
+
+    def rolling_latency(self, host):
+        if host not in self.latencies or len(self.latencies[host]) == 0: return None
+        return sum(self.latencies[host]) / len(self.latencies[host])
+
+    def record_latency(self, host, latency):
+        if host not in self.latencies: self.latencies[host] = deque(maxlen=self.latency_window)
+        self.latencies[host].append(latency)
+
+    def mark_unhealthy(self, host):
+        self.unhealthy_until[host] = time.monotonic() + self.cooldown
+        # The latency before the failure says nothing about the instance once it is back
+        self.latencies.pop(host, None)
+
+    def is_healthy(self, host):
+        return time.monotonic() >= self.unhealthy_until.get(host, 0)
+
+    def candidates(self, current_host=None):
+        # The hosts to try for a search in order: the chosen reader, the other healthy readers, then the writer.
+        # The host of the current connection is kept while it is healthy, so the searches of one request share a connection.
+        readers = self.readers if len(self.readers) > 0 else [self.reader_endpoint]
+        healthy_readers = [host for host in readers if self.is_healthy(host)]
+        # When all readers failed recently and there is no writer to fall back to, they are tried again anyway
+        if len(healthy_readers) == 0 and self.writer_endpoint is None: healthy_readers = readers
+
+        def sort_key(host):
+            latency = self.rolling_latency(host)
+            return (0, 0) if latency is None else (1, latency)
+        ordered = sorted(healthy_readers, key=sort_key)
+        if len(ordered) > 1 and random.random() < self.explore_rate:
+            explored = random.choice(ordered[1:])
+            ordered = [explored] + [host for host in ordered if host != explored]
+        if current_host in ordered:
+            ordered = [current_host] + [host for host in ordered if host != current_host]
+
+        if self.writer_endpoint is not None: ordered.append(self.writer_endpoint)
+        return ordered
@@ -0,0 +1,63 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from helper.tenant import DEFAULT_TENANT
+from helper.sharding import merge_top_k
+
+class ShardedDatabase():
+    # Catalog split across the databases of several clusters, see helper/sharding.py. Each search queries the top-k of all shards
+    # in parallel and merges them into the overall top-k, with the shard of each item in its "shard" field, as the IDs are per shard.
+    # The shards which fail or do not answer within the shard timeout are left out, and recorded in failed_shards for the reply.
+    def __init__(self, shards, shard_timeout_ms=3000):
+        self.shards = shards
+        self.shard_timeout_ms = shard_timeout_ms
+        # One thread per shard. A search which timed out keeps its thread until its statement timeout stops it.
+        self.executor = ThreadPoolExecutor(max_workers=len(shards))
+        self.running = {}
+        self.failed_shards = set()
+    
+    def connect_for_reading(self):
+        for shard in self.shards: shard.connect_for_reading()
+    
+    def close_connection(self):
+        # The connection of a shard still running a search which timed out is closed by the next request once the search ends
+        for i, shard in enumerate(self.shards):
+            if i not in self.running or self.running[i].done(): shard.close_connection()
+    
+    def explain_search(self, query_template):
+        # The shards are set up with the same schema and settings, so the plan of the first one stands for all
+        return self.shards[0].explain_search(query_template)
+    
+    def get_catalog_settings(self, model_id, dimension, normalize, distance_metric):
+        # Catalog rebuilds run on the first shard only
+        return self.shards[0].get_catalog_settings(model_id, dimension, normalize, distance_metric)
+    
+    def search(self, query_template, embedding, num_items=1, additional_query_parameters=[], tenant_id=DEFAULT_TENANT, operator=None):
+        futures = {}
+        for i, shard in enumerate(self.shards):
+            if i in self.running and not self.running[i].done():
+                print(f"Skipping shard {i}, which is still running a search which timed out")
+                self.failed_shards.add(i)
+                continue
+            futures[i] = self.executor.submit(shard.search, query_template, embedding, num_items, additional_query_parameters, tenant_id, operator)
+        
+        done, not_done = wait(futures.values(), timeout=self.shard_timeout_ms / 1000)
+        results_per_shard = []
+        for i, future in futures.items():
+            if future in not_done:
+                print(f"Shard {i} did not answer within {self.shard_timeout_ms} ms")
+                self.failed_shards.add(i)
+                self.running[i] = future
+                # Cancelling is safe from another thread, and frees the connection of the shard for the next search
+                conn = self.shards[i].conn
+                if conn is not None:
+                    try:
+                        conn.cancel()
+                    except Exception as e:
+                        print(f"Could not cancel the search on shard {i}: {e}")
+            elif future.exception() is not None:
+                print(f"The search failed on shard {i}: {future.exception()}")
+                self.failed_shards.add(i)
+            else:
+                results_per_shard.append([{**item, "shard": i} for item in future.result()])
+        
+        if len(results_per_shard) == 0: raise Exception("The search failed on all shards")
+        return merge_top_k(results_per_shard, int(num_items))
@@ -14,6 +14,40 @@ from api.api_stack import APIStack
 from notebooks.notebooks_stack import NotebooksStack
 
 database_name = "vectordb"
+# Distance metric of the vector search: "l2", "cosine" or "inner_product". It sets both the operator class of the vector index and
+# the distance operator of the search query, so that the query can use the index.
+distance_metric = "l2"
+# Store and search unit-length embeddings. With normalized embeddings, "inner_product" ranks the same as "cosine" but is cheaper.
+normalize_embeddings = distance_metric == "inner_product"
+# Embedding model of the data loading and the search. To change it on a loaded catalog, use a catalog rebuild (see the README) and then deploy with the new model.
+embedding_model_id = "amazon.titan-embed-text-v1"
+# Dimension of the embeddings of the model: 1536 for amazon.titan-embed-text-v1, 1024, 512 or 256 for amazon.titan-embed-text-v2:0,
+# and 1024 for cohere.embed-*. The "local" model embeds with a deterministic hash on the CPU, e.g. to load-test without Amazon Bedrock.
+embedding_dimension = 1536
+# Storage layout of the catalog: "single" keeps the embeddings in the items table next to the descriptions, while "split" keeps them
+# in the narrow item_vectors table, so the vector search does not read the descriptions until it joins the final top-k items.
+# "chunked" splits long descriptions into overlapping chunks with one embedding each in the item_chunks table, and ranks each item by its closest chunk.
+storage_layout = "single"
+# Tenants, e.g. brands, with separate catalogs. Each one is stored in its own partition with its own vector index,
+# and is selected with "tenant_id" when loading and searching items. The "default" tenant is always created.
+tenants = ["default"]
+# Ingest mode: "direct" inserts the items into the indexed table, while "staged" appends them to the unindexed items_staging table,
+# which is merged into the indexed table every minute in large batches. The searches also scan the staging table, so new items are found right away.
+ingest_mode = "direct"
+# Near-duplicates: before inserting, the data loading probes the vector index for the nearest item of each new item. If its cosine similarity
+# is at least duplicate_min_similarity, "skip" drops the new item, "link" records it in item_links pointing to the existing item,
+# and "merge" replaces the existing item with it. "off" inserts every new item.
+duplicate_policy = "off"
+duplicate_min_similarity = 0.95
+# SnapStart for the inference function: its initialization is snapshotted when a version is published, and new execution environments
+# are restored from the snapshot, which cuts the cold starts. Set to False to initialize each execution environment from scratch.
+inference_snap_start = True
+# Additional Aurora PostgreSQL clusters for a catalog whose vector index outgrows the memory of one cluster. The items are spread
+# across the cluster of this deployment and these ones by the hash of their content, and each search queries all of them in parallel.
+# Each one is {"writer": <writer endpoint>, "reader": <reader endpoint>, "secret_arn": <ARN of its credentials secret>}, optionally with a "port".
+# They must be reachable from the VPC and set up with the same database name, schema, storage layout and tenants.
+# The order of the clusters decides where each item is stored, so do not change the list once items are loaded.
+additional_db_shards = []
 account=os.environ["CDK_DEPLOY_ACCOUNT"]
 region=os.environ["CDK_DEPLOY_REGION"]
 allowed_regions = ["us-east-1", "us-west-2"]
@@ -48,9 +82,21 @@ class RecommenderStack(Stack):
             vpc= common.vpc, 
             private_subnets= common.private_subnets,
             private_with_egress_subnets= common.private_with_egress_subnets,
-            embedding_dimension=1536,  # For Titan Embedding model, set to 1536
+            embedding_dimension=embedding_dimension,
             database_name=database_name,
-            deploy_bastion_host=deploy_bastion_host
+            deploy_bastion_host=deploy_bastion_host,
+            storage_layout=storage_layout,
+            tenants=tenants,
+            # ANN index on the item embeddings. See lib/vectordb/db_setup_lambda/vector_index.py for all settings and their defaults.
+            vector_index_settings={
+                "distance_metric": distance_metric,
+                "index_type": "hnsw",       # "hnsw" or "ivfflat"
+                "m": 16,                    # HNSW only
+                "ef_construction": 64,      # HNSW only
+                "lists": None,              # IVFFlat only, None to derive it from the number of rows
+                "maintenance_work_mem": "512MB",
+                "max_parallel_maintenance_workers": 2
+            }
         )
         api = APIStack(self, "APIStack", 
             vpc=common.vpc, 
@@ -60,6 +106,16 @@ class RecommenderStack(Stack):
             db_reader_endpoint=vector_db.db_reader_endpoint,
             database_name=database_name,
             db_secret_arn=vector_db.db_secret_arn,
+            distance_metric=distance_metric,
+            normalize_embeddings=normalize_embeddings,
+            storage_layout=storage_layout,
+            embedding_model_id=embedding_model_id,
+            embedding_dimension=embedding_dimension,
+            ingest_mode=ingest_mode,
+            duplicate_policy=duplicate_policy,
+            duplicate_min_similarity=duplicate_min_similarity,
+            inference_snap_start=inference_snap_start,
+            additional_db_shards=additional_db_shards,
             environment=environment
         )
         notebooks = NotebooksStack(self, "NotebooksStack", 
@@ -72,6 +128,7 @@ class RecommenderStack(Stack):
                                    db_writer_endpoint=vector_db.db_writer_endpoint,
                                    db_reader_endpoint=vector_db.db_reader_endpoint,
                                    db_secret_arn=vector_db.db_secret_arn,
+                                   vector_index_admin_function_arn=vector_db.vector_index_admin_function_arn,
                                    ssm_llm_parameter=api.ssm_llm_parameter,
                                    ssm_recommendation_parameter=api.ssm_recommendation_parameter,
                                    bastion_host_asg_name=vector_db.bastion_host_asg_name if deploy_bastion_host else ""
@@ -82,6 +139,14 @@ class RecommenderStack(Stack):
         CfnOutput(self, "db_writer_endpoint", value=vector_db.db_writer_endpoint.hostname)
         CfnOutput(self, "db_reader_endpoint", value=vector_db.db_reader_endpoint.hostname)
         CfnOutput(self, "bucket_name", value=common.bucket.bucket_name)
+        CfnOutput(self, "vector_index_admin_function_name", value=vector_db.vector_index_admin_function_name)
+        CfnOutput(self, "distance_metric", value=distance_metric)
+        CfnOutput(self, "normalize_embeddings", value=str(normalize_embeddings).lower())
+        CfnOutput(self, "embedding_model_id", value=embedding_model_id)
+        CfnOutput(self, "embedding_dimension", value=str(embedding_dimension))
+        CfnOutput(self, "storage_layout", value=storage_layout)
+        CfnOutput(self, "ingest_mode", value=ingest_mode)
+        CfnOutput(self, "catalog_reembed_function_name", value=api.catalog_reembed_function_name)
         CfnOutput(self, "api_url", value = api.api_url)
         CfnOutput(self, "ws_api_endpoint", value = api.ws_api_endpoint)
         CfnOutput(self, "ws_api_stage", value = api.ws_api_stage)
@@ -22,7 +22,8 @@ class CommonStack(NestedStack):
            removal_policy=RemovalPolicy.DESTROY,
            #auto_delete_objects=True,
            server_access_logs_prefix="access_logs/",
-           enforce_ssl=True
+           enforce_ssl=True,
+           event_bridge_enabled=True # Catalog files uploaded under "catalog/" trigger the S3 ingest Lambda function through Amazon EventBridge
         )
         self.bucket = bucket
         
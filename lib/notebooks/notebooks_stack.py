@@ -25,6 +25,7 @@ class NotebooksStack(NestedStack):
         db_writer_endpoint,
         db_reader_endpoint,
         db_secret_arn: str,
+        vector_index_admin_function_arn: str,
         ssm_llm_parameter,
         ssm_recommendation_parameter,
         bastion_host_asg_name: str,
@@ -61,6 +62,7 @@ class NotebooksStack(NestedStack):
                         db_writer_endpoint=db_writer_endpoint,
                         db_reader_endpoint=db_reader_endpoint,
                         db_secret_arn=db_secret_arn,
+                        vector_index_admin_function_arn=vector_index_admin_function_arn,
                         ssm_llm_parameter=ssm_llm_parameter,
                         ssm_recommendation_parameter=ssm_recommendation_parameter,
                         bastion_host_asg_name=bastion_host_asg_name
@@ -39,6 +39,7 @@ class SageMakerStudio(Construct):
         db_writer_endpoint: str,
         db_reader_endpoint: str,
         db_secret_arn: str,
+        vector_index_admin_function_arn: str,
         ssm_llm_parameter,
         ssm_recommendation_parameter,
         bastion_host_asg_name: str,
@@ -171,6 +172,12 @@ class SageMakerStudio(Construct):
                     resources=[db_secret_arn]
                 )]
             ),
+            "lambda": iam.PolicyDocument(
+                statements=[iam.PolicyStatement(
+                    actions=["lambda:InvokeFunction"],
+                    resources=[vector_index_admin_function_arn]
+                )]
+            ),
             "bedrock": iam.PolicyDocument(
                 statements=[iam.PolicyStatement(
                     actions=["bedrock:InvokeModel"],
@@ -194,6 +201,18 @@ class SageMakerStudio(Construct):
                         f"arn:aws:ssm:{aws_region}::document/AWS-RunShellScript",
                         f"arn:aws:ssm:{aws_region}:{aws_account_id}:*"
                     ]
+                ),
+                # Add permission to forward a local port to the database through the bastion host
+                iam.PolicyStatement(
+                    actions=["ssm:StartSession"],
+                    resources=[
+                        f"arn:aws:ec2:{aws_region}:{aws_account_id}:instance/*",
+                        f"arn:aws:ssm:{aws_region}::document/AWS-StartPortForwardingSessionToRemoteHost"
+                    ]
+                ),
+                iam.PolicyStatement(
+                    actions=["ssm:TerminateSession", "ssm:ResumeSession"],
+                    resources=[f"arn:aws:ssm:{aws_region}:{aws_account_id}:session/*"]
                 )]
             )
         }
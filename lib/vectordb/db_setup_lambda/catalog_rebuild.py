@@ -0,0 +1,341 @@
+import json
+from vector_index import OPERATORS, get_index_settings, get_index_name, create_index, find_index
+from tenants import DEFAULT_TENANT, get_partition_name, list_tenants
+from helper.storage_layout import STORAGE_LAYOUT_SINGLE, STORAGE_LAYOUT_CHUNKED, get_vector_table
+from helper.catalog_settings import (STATUS_PREPARED, STATUS_LOADING, STATUS_LOADED, STATUS_INDEXED, STATUS_VALIDATED, STATUS_SWAPPED,
+                                     STATUS_CLEANED, STATUS_ABORTED, STATUS_ROLLED_BACK)
+
+# Blue/green rebuild of the vector table, e.g. to change the embedding model, the embedding dimension or the vector index,
+# without rebuilding the table which serves the searches. The steps are run with the vector index admin Lambda function:
+#   rebuild_prepare  creates the shadow table <vector table>_new, partitioned by tenant like the live one.
+#   (The catalog re-embed Lambda function then copies the items into the shadow table and embeds them with the new model.)
+#   rebuild_index    builds the vector index on each tenant partition of the shadow table.
+#   rebuild_validate compares the row counts with the live catalog and measures the recall of the new index on a sample.
+#   rebuild_swap     renames the live table to <vector table>_old and the shadow table to the live name, in one short transaction.
+#   rebuild_cleanup  drops the previous table once the new one is confirmed.
+# rebuild_abort drops the shadow table at any step before the swap, and rebuild_rollback swaps the previous table back in before the cleanup.
+# The data loading and the search embed with the settings of the latest swapped rebuild, read from this table, see helper/catalog_settings.py.
+# The tenant IDs starting with new_ or old_ are reserved in helper/tenant.py, so the partitions of these tables never have the name of a live partition.
+SHADOW_SUFFIX = "_new"
+OLD_SUFFIX = "_old"
+
+def get_active_rebuild(conn):
+    # There is at most one rebuild which is neither cleaned up, aborted nor rolled back
+    cur = conn.cursor()
+    cur.execute("SELECT id, status, settings, validation, created_at, updated_at FROM catalog_rebuilds WHERE status NOT IN (%s, %s, %s) ORDER BY id DESC LIMIT 1;",
+                (STATUS_CLEANED, STATUS_ABORTED, STATUS_ROLLED_BACK))
+    row = cur.fetchone()
+    cur.close()
+    if row is None: return None
+    return {"id": row[0], "status": row[1], "settings": row[2], "validation": row[3], "created_at": str(row[4]), "updated_at": str(row[5])}
+
+def require_active_rebuild(conn, statuses):
+    rebuild = get_active_rebuild(conn)
+    if rebuild is None: raise Exception("There is no catalog rebuild in progress. Start one with rebuild_prepare")
+    if rebuild['status'] not in statuses:
+        raise Exception(f"The catalog rebuild {rebuild['id']} is {rebuild['status']}, while this step needs it to be one of {statuses}")
+    return rebuild
+
+def set_rebuild_status(conn, rebuild_id, status, validation=None):
+    cur = conn.cursor()
+    if validation is None:
+        cur.execute("UPDATE catalog_rebuilds SET status = %s, updated_at = now() WHERE id = %s;", (status, rebuild_id))
+    else:
+        cur.execute("UPDATE catalog_rebuilds SET status = %s, validation = %s, updated_at = now() WHERE id = %s;", (status, json.dumps(validation), rebuild_id))
+    cur.close()
+    print(f"Catalog rebuild {rebuild_id} is {status}")
+
+def get_embedding_dimension(conn, table):
+    cur = conn.cursor()
+    cur.execute("SELECT atttypmod FROM pg_attribute WHERE attrelid = %s::regclass AND attname = 'embedding';", (table,))
+    dimension = cur.fetchone()[0]
+    cur.close()
+    return dimension
+
+def create_shadow_table(conn, settings, tenants):
+    # Same columns, keys and partitions as the live table, with the embedding dimension of the rebuild. The vector indexes are built after the load.
+    table = settings['table']
+    shadow_table = settings['shadow_table']
+    dimension = int(settings['dimension'])
+    cur = conn.cursor()
+    # Disable semgrep rule for flagging formatted query as the table names and the dimension are not user facing input.
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"DROP TABLE IF EXISTS {shadow_table};")
+    if table == "items":
+        # New items keep getting their IDs from the sequence of the live table
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"""CREATE TABLE {shadow_table} (id bigint NOT NULL DEFAULT nextval('items_id_seq'), tenant_id text NOT NULL DEFAULT '{DEFAULT_TENANT}',
+                        description text, embedding vector({dimension}), content_hash char(64),
+                        CONSTRAINT {shadow_table}_tenant_pkey PRIMARY KEY (tenant_id, id)) PARTITION BY LIST (tenant_id);""")
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"CREATE UNIQUE INDEX {shadow_table}_tenant_content_hash_idx ON {shadow_table} (tenant_id, content_hash);")
+    else:
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"""CREATE TABLE {shadow_table} (id bigint NOT NULL, tenant_id text NOT NULL DEFAULT '{DEFAULT_TENANT}', embedding vector({dimension}),
+                        CONSTRAINT {shadow_table}_tenant_pkey PRIMARY KEY (tenant_id, id),
+                        CONSTRAINT {shadow_table}_item_fkey FOREIGN KEY (tenant_id, id) REFERENCES items (tenant_id, id) ON DELETE CASCADE) PARTITION BY LIST (tenant_id);""")
+    for tenant_id in tenants:
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"CREATE TABLE {get_partition_name(shadow_table, tenant_id)} PARTITION OF {shadow_table} FOR VALUES IN ('{tenant_id}');")
+    cur.close()
+
+def prepare_rebuild(conn, storage_layout, settings=None):
+    # settings: "model_id" and "dimension" of the new embeddings, "vector_index" settings of the new index, and "normalize".
+    # The ones not given keep the current values.
+    settings = settings or {}
+    if get_active_rebuild(conn) is not None: raise Exception("Another catalog rebuild is in progress. Finish or abort it first")
+
+    # The re-embed embeds one vector per item. The chunks are made at loading, so a chunked catalog is rebuilt by loading it again.
+    if storage_layout == STORAGE_LAYOUT_CHUNKED: raise Exception("Catalog rebuilds are not supported with the chunked storage layout")
+    table = get_vector_table(storage_layout)
+    current_dimension = get_embedding_dimension(conn, table)
+    dimension = int(settings.get('dimension', current_dimension))
+    # With the split layout, the items table still has an embedding column of the current dimension
+    if storage_layout != STORAGE_LAYOUT_SINGLE and dimension != current_dimension:
+        raise Exception("Changing the embedding dimension is only supported with the single storage layout")
+
+    index_settings = get_index_settings(settings.get('vector_index'))
+    rebuild_settings = {
+        "storage_layout": storage_layout,
+        "table": table,
+        "shadow_table": table + SHADOW_SUFFIX,
+        "model_id": settings.get('model_id'), # None uses the model configured for the data loading
+        "dimension": dimension,
+        "normalize": str(settings.get('normalize', index_settings['distance_metric'] == "inner_product")).lower() == "true",
+        "vector_index": index_settings
+    }
+    create_shadow_table(conn, rebuild_settings, list_tenants(conn))
+
+    cur = conn.cursor()
+    cur.execute("INSERT INTO catalog_rebuilds (status, settings) VALUES (%s, %s) RETURNING id;", (STATUS_PREPARED, json.dumps(rebuild_settings)))
+    rebuild_id = cur.fetchone()[0]
+    cur.close()
+    print(f"Prepared catalog rebuild {rebuild_id}: {rebuild_settings}")
+    return get_active_rebuild(conn)
+
+def index_rebuild(conn, connect=None):
+    rebuild = require_active_rebuild(conn, [STATUS_LOADED, STATUS_INDEXED])
+    settings = rebuild['settings']
+    cur = conn.cursor()
+    # Fresh statistics for the planner, as the shadow table was loaded in bulk
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"ANALYZE {settings['shadow_table']};")
+    cur.close()
+    for tenant_id in list_tenants(conn):
+        create_index(conn, get_index_settings(settings['vector_index']), connect=connect, table=get_partition_name(settings['shadow_table'], tenant_id))
+    set_rebuild_status(conn, rebuild['id'], STATUS_INDEXED)
+    return get_active_rebuild(conn)
+
+def count_rows(cur, table, tenant_id):
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"SELECT count(*), count(*) FILTER (WHERE embedding IS NULL) FROM {table} WHERE tenant_id = %s;", (tenant_id,))
+    return cur.fetchone()
+
+def measure_recall(conn, table, tenant_id, operator, sample_size, k):
+    # Average share of the exact top-k neighbors which the vector index returns, using sampled rows of the tenant as queries
+    cur = conn.cursor()
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"SELECT embedding::text FROM {table} WHERE tenant_id = %s AND embedding IS NOT NULL ORDER BY random() LIMIT %s;", (tenant_id, sample_size))
+    samples = [row[0] for row in cur.fetchall()]
+    if len(samples) == 0:
+        cur.close()
+        return None
+
+    query = f"SELECT id FROM {table} WHERE tenant_id = %s ORDER BY embedding {operator} %s::vector LIMIT %s;"
+    def search_all():
+        results = []
+        for embedding in samples:
+            # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+            cur.execute(query, (tenant_id, embedding, k))
+            results.append(set(row[0] for row in cur.fetchall()))
+        return results
+
+    try:
+        cur.execute("SET enable_seqscan = off;")
+        approximate = search_all()
+        cur.execute("RESET enable_seqscan;")
+        cur.execute("SET enable_indexscan = off;")
+        exact = search_all()
+    finally:
+        cur.execute("RESET enable_seqscan;")
+        cur.execute("RESET enable_indexscan;")
+        cur.close()
+    return sum(len(a & e) / len(e) if len(e) > 0 else 1.0 for a, e in zip(approximate, exact)) / len(samples)
+
+def validate_rebuild(conn, sample_size=20, k=10, min_recall=0.9):
+    rebuild = require_active_rebuild(conn, [STATUS_INDEXED, STATUS_VALIDATED])
+    settings = rebuild['settings']
+    operator = OPERATORS[settings['vector_index']['distance_metric']]
+
+    validation = {"passed": True, "sample_size": sample_size, "k": k, "min_recall": min_recall, "tenants": {}}
+    cur = conn.cursor()
+    for tenant_id in list_tenants(conn):
+        live_rows, _ = count_rows(cur, "items", tenant_id)
+        shadow_rows, missing_embeddings = count_rows(cur, settings['shadow_table'], tenant_id)
+        index_valid = find_index(conn, get_index_name(get_partition_name(settings['shadow_table'], tenant_id))) is True
+        recall = measure_recall(conn, settings['shadow_table'], tenant_id, operator, sample_size, k)
+        passed = live_rows == shadow_rows and missing_embeddings == 0 and index_valid and (recall is None or recall >= min_recall)
+        validation['tenants'][tenant_id] = {
+            "live_rows": live_rows,
+            "shadow_rows": shadow_rows,
+            "missing_embeddings": missing_embeddings,
+            "index_valid": index_valid,
+            "recall": recall,
+            "passed": passed
+        }
+        validation['passed'] = validation['passed'] and passed
+    cur.close()
+
+    print(f"Validation of catalog rebuild {rebuild['id']}: {validation}")
+    set_rebuild_status(conn, rebuild['id'], STATUS_VALIDATED if validation['passed'] else STATUS_INDEXED, validation=validation)
+    return get_active_rebuild(conn)
+
+def rename_relation(cur, name, new_name):
+    # Rename a table together with its indexes and foreign keys named after it, e.g. items_new_tenant_pkey to items_tenant_pkey.
+    # Renaming the index of a primary key also renames the constraint.
+    cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s AND starts_with(indexname, %s);", (name, name + "_"))
+    index_names = [row[0] for row in cur.fetchall()]
+    cur.execute("SELECT conname FROM pg_constraint WHERE conrelid = %s::regclass AND contype = 'f' AND starts_with(conname, %s);", (name, name + "_"))
+    constraint_names = [row[0] for row in cur.fetchall()]
+    for index_name in index_names:
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"ALTER INDEX {index_name} RENAME TO {new_name + index_name[len(name):]};")
+    for constraint_name in constraint_names:
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"ALTER TABLE {name} RENAME CONSTRAINT {constraint_name} TO {new_name + constraint_name[len(name):]};")
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"ALTER TABLE {name} RENAME TO {new_name};")
+
+def rename_partitioned_table(cur, name, new_name, tenants):
+    for tenant_id in tenants:
+        rename_relation(cur, get_partition_name(name, tenant_id), get_partition_name(new_name, tenant_id))
+    rename_relation(cur, name, new_name)
+
+def point_to_items_table(cur):
+    # Keep the sequence of the item IDs when the other table is dropped, and point the foreign keys of item_vectors and item_chunks to the live table
+    cur.execute("ALTER SEQUENCE items_id_seq OWNED BY items.id;")
+    cur.execute("ALTER TABLE item_vectors DROP CONSTRAINT IF EXISTS item_vectors_item_fkey;")
+    cur.execute("ALTER TABLE item_vectors ADD CONSTRAINT item_vectors_item_fkey FOREIGN KEY (tenant_id, id) REFERENCES items (tenant_id, id) ON DELETE CASCADE;")
+    cur.execute("ALTER TABLE item_chunks DROP CONSTRAINT IF EXISTS item_chunks_item_fkey;")
+    cur.execute("ALTER TABLE item_chunks ADD CONSTRAINT item_chunks_item_fkey FOREIGN KEY (tenant_id, id) REFERENCES items (tenant_id, id) ON DELETE CASCADE;")
+
+def require_empty_staging(conn, cur, dimension, step):
+    # Items of the staged ingest mode were embedded with the settings before the swap, and would be merged into the other table as they are
+    cur.execute("LOCK TABLE items_staging IN SHARE ROW EXCLUSIVE MODE;")
+    cur.execute("SELECT count(*) FROM items_staging;")
+    staged_rows = cur.fetchone()[0]
+    if staged_rows > 0:
+        raise Exception(f"The staging table still has {staged_rows} items. Wait for the staging merge to empty it, then {step} again")
+    if get_embedding_dimension(conn, "items_staging") != dimension:
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"ALTER TABLE items_staging ALTER COLUMN embedding TYPE vector({dimension});")
+
+def swap_rebuild(conn, lock_timeout="10s"):
+    rebuild = require_active_rebuild(conn, [STATUS_VALIDATED])
+    settings = rebuild['settings']
+    table = settings['table']
+    shadow_table = settings['shadow_table']
+    tenants = list_tenants(conn)
+
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    cur = conn.cursor()
+    try:
+        # Give up instead of queueing the searches behind the swap when a long running query holds the tables
+        cur.execute("SET LOCAL lock_timeout = %s;", (lock_timeout,))
+        # Block the writes while the catalog is compared and swapped. The searches keep using the live table until the renames.
+        cur.execute("LOCK TABLE items IN SHARE ROW EXCLUSIVE MODE;")
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"LOCK TABLE {table}, {shadow_table} IN SHARE ROW EXCLUSIVE MODE;")
+
+        # Items loaded or deleted since the validation would be lost or come back with the swap
+        for tenant_id in tenants:
+            cur.execute("SELECT to_regclass(%s);", (get_partition_name(shadow_table, tenant_id),))
+            if cur.fetchone()[0] is None:
+                raise Exception(f"The shadow table has no partition for the tenant {tenant_id}. Run the catalog re-embed Lambda function again")
+            live_rows, _ = count_rows(cur, "items", tenant_id)
+            shadow_rows, missing_embeddings = count_rows(cur, shadow_table, tenant_id)
+            if live_rows != shadow_rows or missing_embeddings > 0:
+                raise Exception(f"The shadow table is behind the live catalog of the tenant {tenant_id} ({shadow_rows - missing_embeddings} of {live_rows} items). Run the catalog re-embed Lambda function again to catch up, then swap again")
+
+        require_empty_staging(conn, cur, int(settings['dimension']), "swap")
+
+        rename_partitioned_table(cur, table, table + OLD_SUFFIX, tenants)
+        rename_partitioned_table(cur, shadow_table, table, tenants)
+        if table == "items": point_to_items_table(cur)
+        set_rebuild_status(conn, rebuild['id'], STATUS_SWAPPED)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.autocommit = autocommit
+
+    print(f"Swapped {shadow_table} in as {table}. The previous table is kept as {table + OLD_SUFFIX} until rebuild_cleanup")
+    return get_active_rebuild(conn)
+
+def cleanup_rebuild(conn):
+    rebuild = require_active_rebuild(conn, [STATUS_SWAPPED])
+    cur = conn.cursor()
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"DROP TABLE IF EXISTS {rebuild['settings']['table'] + OLD_SUFFIX};")
+    cur.close()
+    set_rebuild_status(conn, rebuild['id'], STATUS_CLEANED)
+    return rebuild['id']
+
+def rollback_rebuild(conn, lock_timeout="10s"):
+    # Swaps the previous table back in, e.g. when the search quality dropped with the new model. Only possible before the cleanup,
+    # and as long as the catalog did not change since the swap, as the previous table does not have the changes.
+    rebuild = require_active_rebuild(conn, [STATUS_SWAPPED])
+    settings = rebuild['settings']
+    table = settings['table']
+    old_table = table + OLD_SUFFIX
+    rolled_back_table = settings['shadow_table']
+    tenants = list_tenants(conn)
+
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    cur = conn.cursor()
+    try:
+        cur.execute("SET LOCAL lock_timeout = %s;", (lock_timeout,))
+        cur.execute("LOCK TABLE items IN SHARE ROW EXCLUSIVE MODE;")
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"LOCK TABLE {table}, {old_table} IN SHARE ROW EXCLUSIVE MODE;")
+
+        for tenant_id in tenants:
+            cur.execute("SELECT to_regclass(%s);", (get_partition_name(old_table, tenant_id),))
+            if cur.fetchone()[0] is None:
+                raise Exception(f"The previous table has no partition for the tenant {tenant_id}, which was added after the swap. The rebuild cannot be rolled back")
+            live_rows, _ = count_rows(cur, table, tenant_id)
+            old_rows, _ = count_rows(cur, old_table, tenant_id)
+            if live_rows != old_rows:
+                raise Exception(f"The catalog of the tenant {tenant_id} changed since the swap ({live_rows} items, {old_rows} in the previous table). The rebuild cannot be rolled back. Start a new rebuild with the previous settings instead")
+
+        require_empty_staging(conn, cur, get_embedding_dimension(conn, old_table), "roll back")
+
+        rename_partitioned_table(cur, table, rolled_back_table, tenants)
+        rename_partitioned_table(cur, old_table, table, tenants)
+        if table == "items": point_to_items_table(cur)
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"DROP TABLE {rolled_back_table};")
+        set_rebuild_status(conn, rebuild['id'], STATUS_ROLLED_BACK)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.autocommit = autocommit
+
+    print(f"Swapped {old_table} back in as {table}")
+    return rebuild['id']
+
+def abort_rebuild(conn):
+    rebuild = require_active_rebuild(conn, [STATUS_PREPARED, STATUS_LOADING, STATUS_LOADED, STATUS_INDEXED, STATUS_VALIDATED])
+    cur = conn.cursor()
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"DROP TABLE IF EXISTS {rebuild['settings']['shadow_table']};")
+    cur.close()
+    set_rebuild_status(conn, rebuild['id'], STATUS_ABORTED)
+    return rebuild['id']
@@ -1,10 +1,17 @@
 import json, os
 import boto3
 import psycopg2
+from vector_index import get_index_settings, get_index_name, create_index, rebuild_index, drop_index, get_index_status
+from migrations import run_migrations
+from helper.storage_layout import STORAGE_LAYOUT_SINGLE, get_vector_table
+from storage_layout import apply_storage_layout
+from tenants import DEFAULT_TENANT, get_partition_name, create_tenant, list_tenants
+from catalog_rebuild import get_active_rebuild, prepare_rebuild, index_rebuild, validate_rebuild, swap_rebuild, cleanup_rebuild, abort_rebuild, rollback_rebuild
 
 database_name = os.environ['DATABASE_NAME']
 embedding_dimension = os.environ["EMBEDDING_DIMENSION"]
 writer_endpoint = os.environ['DB_WRITER_ENDPOINT']
+storage_layout = os.environ.get('STORAGE_LAYOUT', STORAGE_LAYOUT_SINGLE)
 
 class Database():
     def __init__(self, writer, database_name, embedding_dimension, port=5432):
@@ -14,7 +21,6 @@ class Database():
         self.port = port
         self.database_name = database_name
         self.embedding_dimension = embedding_dimension
-        self.conn = None
     
     def fetch_credentials(self):
         secrets_manager = boto3.client('secretsmanager')
@@ -24,31 +30,14 @@ class Database():
         self.username = credentials["username"]
         self.password = credentials["password"]
     
-    def connect_for_writing(self):
+    def connect_for_maintenance(self):
+        # Separate autocommit connection, as concurrent index builds cannot run inside a transaction block
         if self.username is None or self.password is None: self.fetch_credentials()
-            
+        
         conn = psycopg2.connect(host=self.writer_endpoint, port=self.port, user=self.username, password=self.password, database=self.database_name)
-        self.conn = conn
+        conn.autocommit = True
         return conn
     
-    def close_connection(self):
-        self.conn.close()
-        self.conn = None
-    
-    def setup_vector_db(self, embedding_dimension):
-        if self.conn is None:
-            self.connect_for_writing()
-        
-        cur = self.conn.cursor()
-        cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
-        cur.execute("DROP TABLE IF EXISTS items;")
-        # Disable semgrep rule for flagging formatted query as this Lambda is to be invoked in deployment phase by CloudFormation, not user facing.
-        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
-        cur.execute(f"CREATE TABLE items (id bigserial PRIMARY KEY, description text, embedding vector({str(embedding_dimension)}));")
-        self.conn.commit()
-        cur.close()
-        return True
-    
 db = Database(writer=writer_endpoint, database_name = database_name, embedding_dimension = embedding_dimension)
     
 def on_event(event, context):
@@ -63,26 +52,127 @@ def on_event(event, context):
     raise Exception(f'Invalid request type: {request_type}')
 
 
-def on_create(event):
-    #props = event["ResourceProperties"]
-    #print(props)
-    #print(f'create new resource with {props}')
-    
+def setup_database(settings, layout, tenants, old_settings=None, old_layout=None):
+    # Apply the pending schema migrations, create the partitions of the tenants, then make sure the storage layout and
+    # the vector index of each tenant match their settings. Nothing is dropped, so the loaded items are kept across deployments.
+    conn = db.connect_for_maintenance()
     try:
-        db.setup_vector_db(embedding_dimension)
-        db.close_connection()
-    except Exception as e:
-        print(e)
-    
+        run_migrations(conn, embedding_dimension)
+        
+        for tenant_id in tenants: create_tenant(conn, tenant_id)
+        
+        layout_changed = old_layout is not None and layout != old_layout
+        if layout_changed:
+            # Move the embeddings first, so the index of the new vector table is built once over all of them
+            print(f"Storage layout changed from {old_layout} to {layout}")
+            apply_storage_layout(conn, layout)
+        elif old_settings is not None and settings != old_settings:
+            print(f"Vector index settings changed from {old_settings} to {settings}")
+        
+        # Tenants removed from the configuration keep their partitions and indexes, so they are also included here.
+        for tenant_id in list_tenants(conn):
+            table = get_partition_name(get_vector_table(layout), tenant_id)
+            if layout_changed:
+                create_index(conn, get_index_settings(settings), connect=db.connect_for_maintenance, table=table)
+                drop_index(conn, get_index_name(get_partition_name(get_vector_table(old_layout), tenant_id)))
+            elif old_settings is not None and settings != old_settings:
+                # Rebuild the index when its settings change
+                rebuild_index(conn, get_index_settings(settings), connect=db.connect_for_maintenance, table=table)
+            else:
+                create_index(conn, get_index_settings(settings), connect=db.connect_for_maintenance, table=table)
+    finally:
+        conn.close()
+
+def get_tenants(props):
+    # The default tenant always exists, as it holds the items loaded without a tenant ID.
+    tenants = props.get('tenants', [])
+    return [DEFAULT_TENANT] + [t for t in tenants if t != DEFAULT_TENANT]
+
+def on_create(event):
+    props = event["ResourceProperties"]
+    setup_database(props.get('vector_index'), props.get('storage_layout', STORAGE_LAYOUT_SINGLE), get_tenants(props))
     return {'PhysicalResourceId': "VectorDBDatabaseSetup"}
 
 
 def on_update(event):
     physical_id = event["PhysicalResourceId"]
-    print("no op")
+    props = event["ResourceProperties"]
+    old_props = event.get("OldResourceProperties", {})
+    # A failed migration fails the update. The migrations applied before it are recorded, so the next deployment continues from there.
+    setup_database(props.get('vector_index'), props.get('storage_layout', STORAGE_LAYOUT_SINGLE), get_tenants(props),
+                   old_settings=old_props.get('vector_index'), 
+                   old_layout=old_props.get('storage_layout', STORAGE_LAYOUT_SINGLE))
     return {'PhysicalResourceId': physical_id}
 
 def on_delete(event):
     physical_id = event["PhysicalResourceId"]
     print("no op")
     return {'PhysicalResourceId': physical_id}
+
+def admin_handler(event, context):
+    # Entry point to manage the tenants and their vector indexes after the deployment, e.g.
+    # aws lambda invoke --function-name <VectorIndexAdminLambda> --payload '{"action": "rebuild", "tenant": "brand_a", "settings": {"m": 24}}' out.json
+    # The actions apply to all tenants unless "tenant" is given. The settings not given in the event fall back to the defaults in vector_index.py.
+    # "create_tenant" creates the partitions and the vector index of a new tenant without a deployment.
+    # The "rebuild_*" actions run the steps of a blue/green catalog rebuild, see catalog_rebuild.py.
+    print(event)
+    action = event.get('action', 'status')
+    
+    if action.startswith('rebuild_'): return rebuild_handler(action, event)
+    
+    conn = db.connect_for_maintenance()
+    try:
+        if action == 'create_tenant':
+            create_tenant(conn, event['tenant'])
+            action = 'create'
+        
+        tenants = [event['tenant']] if 'tenant' in event else list_tenants(conn)
+        status = {}
+        for tenant_id in tenants:
+            table = get_partition_name(get_vector_table(storage_layout), tenant_id)
+            if action == 'create':
+                create_index(conn, get_index_settings(event.get('settings')), connect=db.connect_for_maintenance, table=table)
+            elif action == 'rebuild':
+                rebuild_index(conn, get_index_settings(event.get('settings')), connect=db.connect_for_maintenance, table=table)
+            elif action == 'drop':
+                drop_index(conn, get_index_name(table))
+            elif action != 'status':
+                raise Exception(f'Invalid action: {action}')
+            
+            status[tenant_id] = get_index_status(conn, get_index_name(table))
+    finally:
+        conn.close()
+    
+    print(status)
+    return status
+
+def rebuild_handler(action, event):
+    # e.g. {"action": "rebuild_prepare", "settings": {"model_id": "amazon.titan-embed-text-v2:0", "dimension": 1024, "vector_index": {"m": 24}}}
+    conn = db.connect_for_maintenance()
+    try:
+        if action == 'rebuild_prepare':
+            result = prepare_rebuild(conn, storage_layout, event.get('settings'))
+        elif action == 'rebuild_index':
+            result = index_rebuild(conn, connect=db.connect_for_maintenance)
+        elif action == 'rebuild_validate':
+            result = validate_rebuild(conn, 
+                                      sample_size=int(event.get('sample_size', 20)), 
+                                      k=int(event.get('k', 10)), 
+                                      min_recall=float(event.get('min_recall', 0.9)))
+        elif action == 'rebuild_swap':
+            result = swap_rebuild(conn)
+        elif action == 'rebuild_cleanup':
+            result = {"cleaned": cleanup_rebuild(conn)}
+        elif action == 'rebuild_abort':
+            result = {"aborted": abort_rebuild(conn)}
+        elif action == 'rebuild_rollback':
+            result = {"rolled_back": rollback_rebuild(conn)}
+        elif action == 'rebuild_status':
+            result = get_active_rebuild(conn)
+        else:
+            raise Exception(f'Invalid action: {action}')
+    finally:
+        conn.close()
+    
+    print(result)
+    return result
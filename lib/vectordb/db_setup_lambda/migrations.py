@@ -0,0 +1,194 @@
+import time
+from vector_index import find_index, drop_index
+from tenants import DEFAULT_TENANT
+
+# Forward-only schema migrations of the vector database, applied in order by the database setup custom resource on create and update.
+# The applied versions are recorded in the schema_migrations table, so each migration runs once per database.
+# Never change or remove a migration which may have been applied. Add a new one with the next version instead.
+#
+# A migration is a function of (conn, embedding_dimension). Transactional migrations run in a transaction together with the
+# recording of their version. Non-transactional ones run in autocommit mode, which is needed for CREATE INDEX CONCURRENTLY,
+# and must be safe to run again if they fail halfway.
+
+# Arbitrary key of the advisory lock which keeps two runners from applying migrations at the same time
+MIGRATION_LOCK_KEY = 7245801
+
+def create_index_concurrently(conn, index_name, index_definition):
+    # Build an index without blocking writes. An invalid index left by a failed build is dropped and built again.
+    valid = find_index(conn, index_name)
+    if valid is True: return
+    if valid is False: drop_index(conn, index_name)
+    cur = conn.cursor()
+    # Disable semgrep rule for flagging formatted query as the statement is defined in the migrations, not user facing input.
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"CREATE INDEX CONCURRENTLY {index_name} {index_definition};")
+    cur.close()
+
+def migration_0001_create_items_table(conn, embedding_dimension):
+    cur = conn.cursor()
+    cur.execute("CREATE EXTENSION IF NOT EXISTS vector;")
+    # IF NOT EXISTS keeps the items of deployments where the table was created before the migrations were introduced.
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"CREATE TABLE IF NOT EXISTS items (id bigserial PRIMARY KEY, description text, embedding vector({int(embedding_dimension)}));")
+    cur.close()
+
+def migration_0002_add_content_hash_column(conn, embedding_dimension):
+    # Content hash of the normalized description, used to skip loading the same item again
+    cur = conn.cursor()
+    cur.execute("ALTER TABLE items ADD COLUMN IF NOT EXISTS content_hash char(64);")
+    cur.close()
+
+def migration_0003_create_content_hash_index(conn, embedding_dimension):
+    # The plain unique index was created by the former setup; only build it if it is missing.
+    create_index_concurrently(conn, "items_content_hash_idx", "UNIQUE ON items (content_hash)")
+
+def migration_0004_create_item_vectors_table(conn, embedding_dimension):
+    # Narrow table of the "split" storage layout. It stays empty with the "single" layout.
+    cur = conn.cursor()
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"CREATE TABLE IF NOT EXISTS item_vectors (id bigint PRIMARY KEY REFERENCES items (id) ON DELETE CASCADE, embedding vector({int(embedding_dimension)}));")
+    cur.close()
+
+def migration_0005_partition_by_tenant(conn, embedding_dimension):
+    # A table cannot be turned into a partitioned one in place. The current tables are renamed and attached as the partitions
+    # of the default tenant, so the loaded items and their vector indexes are kept without copying the rows.
+    # The unique indexes of the new primary keys and of (tenant_id, content_hash) are built on the existing rows while the tables are locked.
+    dimension = int(embedding_dimension)
+    cur = conn.cursor()
+    cur.execute("ALTER TABLE item_vectors DROP CONSTRAINT IF EXISTS item_vectors_id_fkey;")
+    for table in ["items", "item_vectors"]:
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"ALTER TABLE {table} RENAME TO {table}_{DEFAULT_TENANT};")
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"ALTER INDEX IF EXISTS {table}_embedding_idx RENAME TO {table}_{DEFAULT_TENANT}_embedding_idx;")
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"ALTER TABLE {table}_{DEFAULT_TENANT} ADD COLUMN tenant_id text NOT NULL DEFAULT '{DEFAULT_TENANT}';")
+    # Content is deduplicated per tenant, so the unique index on content_hash alone is replaced by the one on (tenant_id, content_hash)
+    cur.execute("DROP INDEX IF EXISTS items_content_hash_idx;")
+
+    # The items keep their IDs, and the new items keep getting theirs from the same sequence.
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"""CREATE TABLE items (id bigint NOT NULL DEFAULT nextval('items_id_seq'), tenant_id text NOT NULL DEFAULT '{DEFAULT_TENANT}',
+                    description text, embedding vector({dimension}), content_hash char(64),
+                    CONSTRAINT items_tenant_pkey PRIMARY KEY (tenant_id, id)) PARTITION BY LIST (tenant_id);""")
+    cur.execute("CREATE UNIQUE INDEX items_tenant_content_hash_idx ON items (tenant_id, content_hash);")
+    cur.execute("ALTER SEQUENCE items_id_seq OWNED BY items.id;")
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"ALTER TABLE items ATTACH PARTITION items_{DEFAULT_TENANT} FOR VALUES IN ('{DEFAULT_TENANT}');")
+
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"""CREATE TABLE item_vectors (id bigint NOT NULL, tenant_id text NOT NULL DEFAULT '{DEFAULT_TENANT}', embedding vector({dimension}),
+                    CONSTRAINT item_vectors_tenant_pkey PRIMARY KEY (tenant_id, id),
+                    CONSTRAINT item_vectors_item_fkey FOREIGN KEY (tenant_id, id) REFERENCES items (tenant_id, id) ON DELETE CASCADE) PARTITION BY LIST (tenant_id);""")
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"ALTER TABLE item_vectors ATTACH PARTITION item_vectors_{DEFAULT_TENANT} FOR VALUES IN ('{DEFAULT_TENANT}');")
+    cur.close()
+
+def migration_0006_create_catalog_rebuilds_table(conn, embedding_dimension):
+    # State of the blue/green catalog rebuilds, see catalog_rebuild.py
+    cur = conn.cursor()
+    cur.execute("""CREATE TABLE IF NOT EXISTS catalog_rebuilds (id serial PRIMARY KEY, status text NOT NULL, settings jsonb NOT NULL, validation jsonb,
+                   created_at timestamptz NOT NULL DEFAULT now(), updated_at timestamptz NOT NULL DEFAULT now());""")
+    cur.close()
+
+def migration_0007_create_items_staging_table(conn, embedding_dimension):
+    # Insert buffer of the "staged" ingest mode. It has no vector index, so inserts do not pay for the graph updates,
+    # and it is merged into the items table in large batches. The items keep the IDs they get here.
+    cur = conn.cursor()
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS items_staging (id bigint PRIMARY KEY DEFAULT nextval('items_id_seq'), tenant_id text NOT NULL DEFAULT '{DEFAULT_TENANT}',
+                    description text, embedding vector({int(embedding_dimension)}), content_hash char(64), created_at timestamptz NOT NULL DEFAULT now());""")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS items_staging_tenant_content_hash_idx ON items_staging (tenant_id, content_hash);")
+    cur.close()
+
+def migration_0008_create_item_chunks_table(conn, embedding_dimension):
+    # Chunk vectors of the "chunked" storage layout, one row per chunk of the item description. It stays empty with the other layouts.
+    cur = conn.cursor()
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS item_chunks (id bigint NOT NULL, tenant_id text NOT NULL DEFAULT '{DEFAULT_TENANT}', chunk_index integer NOT NULL,
+                    embedding vector({int(embedding_dimension)}),
+                    CONSTRAINT item_chunks_tenant_pkey PRIMARY KEY (tenant_id, id, chunk_index),
+                    CONSTRAINT item_chunks_item_fkey FOREIGN KEY (tenant_id, id) REFERENCES items (tenant_id, id) ON DELETE CASCADE) PARTITION BY LIST (tenant_id);""")
+    # Partitions of the tenants which already exist. The partitions of new tenants are created with the tenant.
+    cur.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'items'::regclass;")
+    for (partition,) in cur.fetchall():
+        tenant_id = partition[len("items_"):]
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"CREATE TABLE IF NOT EXISTS item_chunks_{tenant_id} PARTITION OF item_chunks FOR VALUES IN ('{tenant_id}');")
+    cur.close()
+
+def migration_0009_create_item_links_table(conn, embedding_dimension):
+    # Near-duplicates found at loading, kept apart from the items and their vector index. Each one points to its canonical item,
+    # and its content hash makes later loads of the same content skip it without calling the embedding model.
+    cur = conn.cursor()
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"""CREATE TABLE IF NOT EXISTS item_links (tenant_id text NOT NULL DEFAULT '{DEFAULT_TENANT}', content_hash char(64) NOT NULL, canonical_id bigint NOT NULL,
+                    description text, similarity real, created_at timestamptz NOT NULL DEFAULT now(),
+                    CONSTRAINT item_links_pkey PRIMARY KEY (tenant_id, content_hash));""")
+    cur.execute("CREATE INDEX IF NOT EXISTS item_links_canonical_idx ON item_links (tenant_id, canonical_id);")
+    cur.close()
+
+# (version, description, migration, transactional)
+MIGRATIONS = [
+    (1, "Create the pgvector extension and the items table", migration_0001_create_items_table, True),
+    (2, "Add the content_hash column", migration_0002_add_content_hash_column, True),
+    (3, "Create the unique index on content_hash", migration_0003_create_content_hash_index, False),
+    (4, "Create the item_vectors table for the split storage layout", migration_0004_create_item_vectors_table, True),
+    (5, "Partition the items and item_vectors tables by tenant", migration_0005_partition_by_tenant, True),
+    (6, "Create the catalog_rebuilds table", migration_0006_create_catalog_rebuilds_table, True),
+    (7, "Create the items_staging table for the staged ingest mode", migration_0007_create_items_staging_table, True),
+    (8, "Create the item_chunks table for the chunked storage layout", migration_0008_create_item_chunks_table, True),
+    (9, "Create the item_links table for the near-duplicates", migration_0009_create_item_links_table, True),
+]
+
+def get_applied_versions(conn):
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS schema_migrations (version integer PRIMARY KEY, description text, applied_at timestamptz NOT NULL DEFAULT now(), duration_seconds real);")
+    cur.execute("SELECT version FROM schema_migrations;")
+    versions = set(row[0] for row in cur.fetchall())
+    cur.close()
+    return versions
+
+def record_version(cur, version, description, duration):
+    cur.execute("INSERT INTO schema_migrations (version, description, duration_seconds) VALUES (%s, %s, %s);", (version, description, duration))
+
+def run_migrations(conn, embedding_dimension):
+    # Must be called with an autocommit connection. Returns the versions which were applied by this run.
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_KEY,))
+    applied = []
+    try:
+        applied_versions = get_applied_versions(conn)
+        for version, description, migration, transactional in sorted(MIGRATIONS, key=lambda m: m[0]):
+            if version in applied_versions: continue
+
+            print(f"Applying migration {version}: {description}")
+            start_time = time.time()
+            if transactional:
+                conn.autocommit = False
+                try:
+                    migration(conn, embedding_dimension)
+                    migration_cur = conn.cursor()
+                    record_version(migration_cur, version, description, time.time() - start_time)
+                    migration_cur.close()
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    conn.autocommit = True
+            else:
+                migration(conn, embedding_dimension)
+                migration_cur = conn.cursor()
+                record_version(migration_cur, version, description, time.time() - start_time)
+                migration_cur.close()
+
+            print(f"Applied migration {version} in {time.time() - start_time:.1f}s")
+            applied.append(version)
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_KEY,))
+        cur.close()
+
+    print(f"Database schema is at version {max([m[0] for m in MIGRATIONS])}, applied {applied if len(applied) > 0 else 'nothing'} in this run")
+    return applied
@@ -0,0 +1,50 @@
+# The storage layouts of the catalog are described in helper/storage_layout.py
+from helper.storage_layout import STORAGE_LAYOUT_SPLIT, STORAGE_LAYOUT_CHUNKED, get_vector_table
+
+def apply_storage_layout(conn, storage_layout):
+    # Move the embeddings loaded with the other layout into the vector table of this layout, in one transaction.
+    # This rewrites every moved row, so switching the layout of a large catalog takes a while and leaves dead rows for autovacuum.
+    get_vector_table(storage_layout)
+    autocommit = conn.autocommit
+    conn.autocommit = False
+    cur = conn.cursor()
+    try:
+        # An item with several chunks has no embedding of the whole description, so only the items with a single chunk can be moved out of item_chunks
+        single_chunks = "SELECT tenant_id, id, embedding FROM item_chunks c WHERE NOT EXISTS (SELECT 1 FROM item_chunks o WHERE o.tenant_id = c.tenant_id AND o.id = c.id AND o.chunk_index <> c.chunk_index)"
+        if storage_layout == STORAGE_LAYOUT_SPLIT:
+            cur.execute("INSERT INTO item_vectors (tenant_id, id, embedding) SELECT tenant_id, id, embedding FROM items WHERE embedding IS NOT NULL ON CONFLICT (tenant_id, id) DO NOTHING;")
+            moved = cur.rowcount
+            # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+            cur.execute(f"INSERT INTO item_vectors (tenant_id, id, embedding) {single_chunks} ON CONFLICT (tenant_id, id) DO NOTHING;")
+            moved = moved + cur.rowcount
+            cur.execute("UPDATE items SET embedding = NULL WHERE embedding IS NOT NULL;")
+            cur.execute("DELETE FROM item_chunks;")
+        elif storage_layout == STORAGE_LAYOUT_CHUNKED:
+            # The items loaded with the other layouts become items with a single chunk. To chunk them, delete them and load them again.
+            cur.execute("INSERT INTO item_chunks (tenant_id, id, chunk_index, embedding) SELECT tenant_id, id, 0, embedding FROM items WHERE embedding IS NOT NULL ON CONFLICT DO NOTHING;")
+            moved = cur.rowcount
+            cur.execute("INSERT INTO item_chunks (tenant_id, id, chunk_index, embedding) SELECT tenant_id, id, 0, embedding FROM item_vectors ON CONFLICT DO NOTHING;")
+            moved = moved + cur.rowcount
+            cur.execute("UPDATE items SET embedding = NULL WHERE embedding IS NOT NULL;")
+            cur.execute("DELETE FROM item_vectors;")
+        else:
+            cur.execute("UPDATE items SET embedding = item_vectors.embedding FROM item_vectors WHERE item_vectors.tenant_id = items.tenant_id AND item_vectors.id = items.id AND items.embedding IS NULL;")
+            moved = cur.rowcount
+            # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+            cur.execute(f"UPDATE items SET embedding = c.embedding FROM ({single_chunks}) c WHERE c.tenant_id = items.tenant_id AND c.id = items.id AND items.embedding IS NULL;")
+            moved = moved + cur.rowcount
+            cur.execute("DELETE FROM item_vectors;")
+            cur.execute("DELETE FROM item_chunks;")
+        if storage_layout != STORAGE_LAYOUT_CHUNKED:
+            # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+            cur.execute(f"SELECT count(*) FROM items i WHERE NOT EXISTS (SELECT 1 FROM {get_vector_table(storage_layout)} v WHERE v.tenant_id = i.tenant_id AND v.id = i.id AND v.embedding IS NOT NULL);")
+            unembedded = cur.fetchone()[0]
+            if unembedded > 0: print(f"{unembedded} items have no embedding in the {storage_layout} layout, e.g. because they were chunked. Delete them and load them again to embed them")
+        conn.commit()
+        print(f"Storage layout is {storage_layout}, moved {moved} embeddings")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        conn.autocommit = autocommit
@@ -0,0 +1,25 @@
+from helper.tenant import DEFAULT_TENANT, validate_tenant_id
+
+# The items, item_vectors and item_chunks tables are list-partitioned by tenant_id, with one partition per tenant named <table>_<tenant_id>.
+# The vector index is built on each partition, so the search of one tenant only scans and indexes the catalog of that tenant.
+PARTITIONED_TABLES = ["items", "item_vectors", "item_chunks"]
+
+def get_partition_name(table, tenant_id):
+    return f"{table}_{validate_tenant_id(tenant_id)}"
+
+def create_tenant(conn, tenant_id):
+    # Create the partitions of the tenant, if they do not exist yet. The vector index is created separately.
+    cur = conn.cursor()
+    for table in PARTITIONED_TABLES:
+        # The tenant ID is validated above, so it is safe to use it in the statement.
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {get_partition_name(table, tenant_id)} PARTITION OF {table} FOR VALUES IN ('{tenant_id}');")
+    cur.close()
+
+def list_tenants(conn):
+    # Tenants which have a partition of the items table, including the ones which were removed from the deployment configuration.
+    cur = conn.cursor()
+    cur.execute("SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'items'::regclass ORDER BY c.relname;")
+    tenants = [row[0][len("items_"):] for row in cur.fetchall()]
+    cur.close()
+    return tenants
@@ -0,0 +1,168 @@
+import threading, time
+from helper.distance_metric import DISTANCE_METRICS
+
+# Approximate nearest neighbor (ANN) index on the embedding column of the vector table, which is the items table or
+# the narrow item_vectors table depending on the storage layout. Each tenant partition of the vector table has its own index,
+# as concurrent index builds are not supported on the partitioned table itself.
+VECTOR_TABLE = "items_default"
+INDEX_NAME = "items_default_embedding_idx"
+INDEX_TYPE_HNSW = "hnsw"
+INDEX_TYPE_IVFFLAT = "ivfflat"
+INDEX_TYPES = [INDEX_TYPE_HNSW, INDEX_TYPE_IVFFLAT]
+
+# Operator class and distance operator of each distance metric, from the same definition as the operators of the vector search
+OPCLASSES = {name: metric["opclass"] for name, metric in DISTANCE_METRICS.items()}
+OPERATORS = {name: metric["operator"] for name, metric in DISTANCE_METRICS.items()}
+
+# Index settings, which can be overridden with the vector_index properties of the database setup custom resource,
+# or in the event of the vector index admin Lambda function.
+DEFAULT_INDEX_SETTINGS = {
+    "index_type": INDEX_TYPE_HNSW,
+    "distance_metric": "l2",            # "l2", "cosine" or "inner_product". Sets the operator class of the index.
+    "m": 16,                            # HNSW: max number of connections per layer
+    "ef_construction": 64,              # HNSW: size of the candidate list when building the graph
+    "lists": None,                      # IVFFlat: number of lists. By default rows / 1000 up to 1M rows, then sqrt(rows).
+    "maintenance_work_mem": "512MB",    # The build is much faster when the graph fits into maintenance_work_mem.
+    "max_parallel_maintenance_workers": 2,
+    "progress_interval_seconds": 10
+}
+
+def get_index_settings(overrides=None):
+    settings = dict(DEFAULT_INDEX_SETTINGS)
+    if overrides is not None:
+        settings.update({k: v for k, v in overrides.items() if v is not None and v != ""})
+    if settings['index_type'] not in INDEX_TYPES:
+        raise Exception(f"Invalid index type: {settings['index_type']}. Valid types are {INDEX_TYPES}")
+    if settings['distance_metric'] not in OPCLASSES:
+        raise Exception(f"Invalid distance metric: {settings['distance_metric']}. Valid metrics are {list(OPCLASSES.keys())}")
+    return settings
+
+def get_index_name(table):
+    return f"{table}_embedding_idx"
+
+def get_ivfflat_lists(conn, table):
+    cur = conn.cursor()
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"SELECT count(*) FROM {table};")
+    rows = cur.fetchone()[0]
+    cur.close()
+    if rows <= 1000000: return max(1, rows // 1000)
+    return int(rows ** 0.5)
+
+def build_create_index_statement(conn, index_name, settings, table):
+    if settings['index_type'] == INDEX_TYPE_HNSW:
+        options = f"m = {int(settings['m'])}, ef_construction = {int(settings['ef_construction'])}"
+    else:
+        lists = settings['lists'] if settings['lists'] is not None else get_ivfflat_lists(conn, table)
+        options = f"lists = {int(lists)}"
+    # CONCURRENTLY keeps the table writable while the index is built.
+    return f"CREATE INDEX CONCURRENTLY {index_name} ON {table} USING {settings['index_type']} (embedding {OPCLASSES[settings['distance_metric']]}) WITH ({options});"
+
+def find_index(conn, index_name):
+    # Returns None if the index does not exist, otherwise whether it is valid.
+    # A failed concurrent build leaves an invalid index behind, which is not used by queries but still slows down writes.
+    cur = conn.cursor()
+    cur.execute("SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s;", (index_name,))
+    row = cur.fetchone()
+    cur.close()
+    return None if row is None else row[0]
+
+def get_index_definition(conn, index_name):
+    cur = conn.cursor()
+    cur.execute("SELECT indexdef FROM pg_indexes WHERE indexname = %s;", (index_name,))
+    row = cur.fetchone()
+    cur.close()
+    return None if row is None else row[0]
+
+def report_build_progress(connect, stop_event, interval, table):
+    # Poll pg_stat_progress_create_index on a separate connection while the index is being built.
+    conn = connect()
+    conn.autocommit = True
+    try:
+        while not stop_event.wait(interval):
+            cur = conn.cursor()
+            cur.execute("SELECT phase, blocks_done, blocks_total, tuples_done, tuples_total FROM pg_stat_progress_create_index WHERE relid = %s::regclass;", (table,))
+            for phase, blocks_done, blocks_total, tuples_done, tuples_total in cur.fetchall():
+                blocks = f", blocks {blocks_done}/{blocks_total} ({blocks_done / blocks_total:.0%})" if blocks_total else ""
+                tuples = f", tuples {tuples_done}/{tuples_total}" if tuples_total else ""
+                print(f"Index build progress: {phase}{blocks}{tuples}")
+            cur.close()
+    except Exception as e:
+        print(f"Stopped reporting the index build progress: {e}")
+    finally:
+        conn.close()
+
+def run_index_build(conn, connect, statement, settings, table):
+    # Must be called with an autocommit connection, as concurrent index builds cannot run in a transaction block.
+    cur = conn.cursor()
+    cur.execute("SET maintenance_work_mem = %s;", (str(settings['maintenance_work_mem']),))
+    cur.execute("SET max_parallel_maintenance_workers = %s;", (int(settings['max_parallel_maintenance_workers']),))
+
+    stop_event = threading.Event()
+    progress_thread = None
+    if connect is not None:
+        progress_thread = threading.Thread(target=report_build_progress, args=(connect, stop_event, settings['progress_interval_seconds'], table))
+        progress_thread.start()
+
+    start_time = time.time()
+    try:
+        print(statement)
+        # Disable semgrep rule for flagging formatted query as the statement is built from the deployment configuration, not user facing input.
+        # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+        cur.execute(statement)
+    finally:
+        stop_event.set()
+        if progress_thread is not None: progress_thread.join()
+        cur.execute("RESET maintenance_work_mem;")
+        cur.execute("RESET max_parallel_maintenance_workers;")
+        cur.close()
+    print(f"Index build finished in {time.time() - start_time:.1f}s")
+
+def drop_index(conn, index_name=INDEX_NAME):
+    cur = conn.cursor()
+    # Disable semgrep rule for flagging formatted query as the index name is not user facing input.
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name};")
+    cur.close()
+    print(f"Dropped index {index_name}")
+
+def create_index(conn, settings, connect=None, table=VECTOR_TABLE):
+    # Create the ANN index if it does not exist yet. An invalid index left by a failed build is dropped and built again.
+    index_name = get_index_name(table)
+    valid = find_index(conn, index_name)
+    if valid is True:
+        print(f"Index {index_name} already exists: {get_index_definition(conn, index_name)}")
+        return False
+    if valid is False: drop_index(conn, index_name)
+
+    run_index_build(conn, connect, build_create_index_statement(conn, index_name, settings, table), settings, table)
+    return True
+
+def rebuild_index(conn, settings, connect=None, table=VECTOR_TABLE):
+    # Build the new index next to the current one, so searches keep using the current index until the new one is ready.
+    index_name = get_index_name(table)
+    new_index_name = f"{index_name}_new"
+    if find_index(conn, new_index_name) is not None: drop_index(conn, new_index_name)
+    run_index_build(conn, connect, build_create_index_statement(conn, new_index_name, settings, table), settings, table)
+
+    drop_index(conn, index_name)
+    cur = conn.cursor()
+    # nosemgrep: python.lang.security.audit.formatted-sql-query.formatted-sql-query, python.sqlalchemy.security.sqlalchemy-execute-raw-query.sqlalchemy-execute-raw-query
+    cur.execute(f"ALTER INDEX {new_index_name} RENAME TO {index_name};")
+    cur.close()
+    return True
+
+def get_index_status(conn, index_name=INDEX_NAME):
+    valid = find_index(conn, index_name)
+    status = {
+        "index_name": index_name,
+        "exists": valid is not None,
+        "valid": valid is True,
+        "definition": get_index_definition(conn, index_name)
+    }
+    if valid is not None:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_size_pretty(pg_relation_size(%s::regclass));", (index_name,))
+        status["size"] = cur.fetchone()[0]
+        cur.close()
+    return status
@@ -13,7 +13,7 @@ from aws_cdk import (
 from aws_cdk import CustomResource, RemovalPolicy
 from aws_cdk.custom_resources import Provider
 from cdk_nag import NagSuppressions
-import json
+import json, hashlib
 
 class VectorDBStack(NestedStack):
     def __init__(self, 
@@ -25,6 +25,9 @@ class VectorDBStack(NestedStack):
                  embedding_dimension, 
                  database_name,
                  deploy_bastion_host,
+                 storage_layout="single",
+                 tenants=[],
+                 vector_index_settings={},
                  **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
         
@@ -202,7 +205,8 @@ class VectorDBStack(NestedStack):
         # Provisioning the Aurora Serverless database
         aurora_cluster = rds.DatabaseCluster(self, 'AuroraDatabase',
           credentials= aurora_cluster_credentials,
-          engine= rds.DatabaseClusterEngine.aurora_postgres(version=rds.AuroraPostgresEngineVersion.VER_15_3),
+          # Aurora PostgreSQL 15.5 comes with pgvector 0.5.1, which is needed for HNSW indexes.
+          engine= rds.DatabaseClusterEngine.aurora_postgres(version=rds.AuroraPostgresEngineVersion.VER_15_5),
           writer=rds.ClusterInstance.serverless_v2("writer"),
           readers=[
             rds.ClusterInstance.serverless_v2("reader1",  scale_with_writer=True),
@@ -222,23 +226,40 @@ class VectorDBStack(NestedStack):
         self.db_reader_endpoint = aurora_cluster.cluster_read_endpoint
         
         # Lambda for setting up database
-        db_setup_event_handler = _lambda.Function(self, 'DatabaseSetupHandler',
-            runtime=_lambda.Runtime.PYTHON_3_12,
-            timeout=Duration.minutes(1),
-            code=_lambda.Code.from_asset('./lib/vectordb/db_setup_lambda',
+        db_setup_code = _lambda.Code.from_asset('./lib/vectordb/db_setup_lambda',
+            bundling= BundlingOptions(
+              image= _lambda.Runtime.PYTHON_3_12.bundling_image,
+              command= [
+                'bash',
+                '-c',
+                'pip install -r requirements.txt -t /asset-output && cp -au . /asset-output',
+              ],
+            )
+        )
+        # Layer with the helper modules shared with the API Lambda functions, e.g. the distance metrics of the vector index and the search
+        helper_layer = _lambda.LayerVersion(self, "DatabaseSetupHelperLayer",
+            code=_lambda.Code.from_asset('./helper',
                 bundling= BundlingOptions(
                   image= _lambda.Runtime.PYTHON_3_12.bundling_image,
                   command= [
                     'bash',
                     '-c',
-                    'pip install -r requirements.txt -t /asset-output && cp -au . /asset-output',
+                    'mkdir -p /asset-output/python/helper && cp -au *.py /asset-output/python/helper',
                   ],
                 )
             ),
+            compatible_runtimes=[_lambda.Runtime.PYTHON_3_12]
+        )
+        db_setup_event_handler = _lambda.Function(self, 'DatabaseSetupHandler',
+            runtime=_lambda.Runtime.PYTHON_3_12,
+            timeout=Duration.minutes(15), # Rebuilding the vector index on update can take a while on a large catalog
+            code=db_setup_code,
+            layers=[helper_layer],
             environment = {
                 'DB_WRITER_ENDPOINT': self.db_writer_endpoint.hostname,
                 'DATABASE_NAME': database_name,
-                "EMBEDDING_DIMENSION": str(embedding_dimension)
+                "EMBEDDING_DIMENSION": str(embedding_dimension),
+                'STORAGE_LAYOUT': storage_layout
             },
             vpc=vpc,
             vpc_subnets=private_with_egress_subnets,
@@ -274,7 +295,47 @@ class VectorDBStack(NestedStack):
             id='DatabaseSetup',
             service_token=provider.service_token,
             removal_policy=RemovalPolicy.DESTROY,
-            resource_type="Custom::DatabaseSetupCustomResource"
+            resource_type="Custom::DatabaseSetupCustomResource",
+            # Changing the vector index settings rebuilds the index on the next deployment
+            properties={
+                "vector_index": {k: str(v) for k, v in vector_index_settings.items() if v is not None},
+                # Changing the storage layout moves the embeddings to the vector table of the new layout
+                "storage_layout": storage_layout,
+                # Each tenant gets its own partition and vector index. Tenants removed from the list keep their data.
+                "tenants": tenants,
+                # Adding a schema migration changes this hash, so that the next deployment runs the update handler which applies it
+                "migrations_hash": hashlib.sha256(open('./lib/vectordb/db_setup_lambda/migrations.py', 'rb').read()).hexdigest()
+            }
         )
 
-        db_setup_custom_resource.node.add_dependency(aurora_cluster)     
+        db_setup_custom_resource.node.add_dependency(aurora_cluster)
+        
+        # Lambda for creating, rebuilding, dropping and checking the vector index after the deployment
+        vector_index_admin_function = _lambda.Function(self, 'VectorIndexAdminLambda',
+            runtime=_lambda.Runtime.PYTHON_3_12,
+            timeout=Duration.minutes(15),
+            code=db_setup_code,
+            layers=[helper_layer],
+            environment = {
+                'DB_WRITER_ENDPOINT': self.db_writer_endpoint.hostname,
+                'DATABASE_NAME': database_name,
+                "EMBEDDING_DIMENSION": str(embedding_dimension),
+                'STORAGE_LAYOUT': storage_layout
+            },
+            vpc=vpc,
+            vpc_subnets=private_with_egress_subnets,
+            handler='index.admin_handler'
+        )
+        
+        # Suppress CDK nag rule to allow the use of AWS managed policies/roles AWSLambdaVPCAccessExecutionRole and AWSLambdaBasicExecutionRole
+        NagSuppressions.add_resource_suppressions(vector_index_admin_function, [
+            { "id": 'AwsSolutions-IAM4', "reason": 'Allow the use of AWS managed policies/roles AWSLambdaVPCAccessExecutionRole and AWSLambdaBasicExecutionRole'},
+        ], True)
+        
+        statement = iam.PolicyStatement()
+        statement.add_actions("secretsmanager:GetSecretValue")
+        statement.add_resources(aurora_cluster_secret.secret_full_arn)
+        vector_index_admin_function.add_to_role_policy(statement)
+        
+        self.vector_index_admin_function_name = vector_index_admin_function.function_name
+        self.vector_index_admin_function_arn = vector_index_admin_function.function_arn     
@@ -0,0 +1,458 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Loads a catalog file into the vector database from a workstation, a CI runner or the SageMaker Studio, e.g.
+#   python load_catalog.py data/data.txt --delimiter "###" --tenant default
+#   python load_catalog.py data/data.txt --dry-run
+# The file is parsed, embedded and written in a pipeline of three threads, so the embedding model and the database work at the same time.
+# The settings of the deployment are read from deployment-output.json, like in the notebooks, and can be overridden with the options.
+# The items are written into the standard tables of the storage layout and the ingest mode. With a customized insert query template,
+# load the items with notebook 01 or the data loading API instead.
+import argparse
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+import psycopg2
+from helper.catalog_settings import get_catalog_settings
+from helper.chunking import DEFAULT_CHUNK_OVERLAP, DEFAULT_CHUNK_SIZE, ChunkedEmbeddingClient
+from helper.content_hash import find_existing_content_hashes, get_content_hash
+from helper.embedding_client import EmbeddingClient
+from helper.embedding_provider import DEFAULT_MODEL_ID
+from helper.storage_layout import STORAGE_LAYOUT_CHUNKED, STORAGE_LAYOUT_SINGLE, STORAGE_LAYOUT_SPLIT, STORAGE_LAYOUTS
+from helper.tenant import DEFAULT_TENANT, validate_tenant_id
+
+INGEST_MODES = ["direct", "staged"]
+
+READ_BLOCK_SIZE = 1024 * 1024
+
+# Batch writes: the batch is copied into temporary tables with COPY, then inserted into the tables of the storage layout in one statement,
+# which skips the items already in the database with ON CONFLICT.
+WRITE_QUERIES = {
+    STORAGE_LAYOUT_SINGLE: """INSERT INTO items (tenant_id, description, embedding, content_hash)
+                 SELECT %(tenant)s, load_items.description, load_vectors.embedding, load_items.content_hash FROM load_items JOIN load_vectors USING (content_hash)
+                 ON CONFLICT (tenant_id, content_hash) DO NOTHING;""",
+    "staged": """INSERT INTO items_staging (tenant_id, description, embedding, content_hash)
+                 SELECT %(tenant)s, load_items.description, load_vectors.embedding, load_items.content_hash FROM load_items JOIN load_vectors USING (content_hash)
+                 ON CONFLICT (tenant_id, content_hash) DO NOTHING;""",
+    STORAGE_LAYOUT_SPLIT: """WITH inserted AS (INSERT INTO items (tenant_id, description, content_hash) SELECT %(tenant)s, description, content_hash FROM load_items
+                                  ON CONFLICT (tenant_id, content_hash) DO NOTHING RETURNING tenant_id, id, content_hash),
+                vectors AS (INSERT INTO item_vectors (tenant_id, id, embedding) SELECT inserted.tenant_id, inserted.id, load_vectors.embedding FROM inserted JOIN load_vectors USING (content_hash))
+                SELECT count(*) FROM inserted;""",
+    STORAGE_LAYOUT_CHUNKED: """WITH inserted AS (INSERT INTO items (tenant_id, description, content_hash) SELECT %(tenant)s, description, content_hash FROM load_items
+                                    ON CONFLICT (tenant_id, content_hash) DO NOTHING RETURNING tenant_id, id, content_hash),
+                  chunks AS (INSERT INTO item_chunks (tenant_id, id, chunk_index, embedding) SELECT inserted.tenant_id, inserted.id, load_vectors.chunk_index, load_vectors.embedding FROM inserted JOIN load_vectors USING (content_hash))
+                  SELECT count(*) FROM inserted;"""
+}
+
+def copy_value(value) -> str:
+    # Escape a value for the text format of COPY
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r").replace("\x00", "")
+
+def format_vector(embedding) -> str:
+    return "[" + ",".join(str(x) for x in embedding) + "]"
+
+def format_duration(seconds) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+def read_items(path, delimiter, start_offset=0):
+    # Streams the items of the file without loading it into memory. Yields each non-empty item with the byte offset after it,
+    # from which the file is read again when the load is resumed.
+    delimiter = delimiter.encode("utf-8")
+    with open(path, "rb") as f:
+        f.seek(start_offset)
+        offset = start_offset
+        buffer = b""
+        while True:
+            block = f.read(READ_BLOCK_SIZE)
+            buffer = buffer + block
+            while True:
+                index = buffer.find(delimiter)
+                if index < 0: break
+                item = buffer[:index]
+                buffer = buffer[index + len(delimiter):]
+                offset = offset + index + len(delimiter)
+                if item.strip() != b"": yield item.decode("utf-8"), offset
+            if block == b"":
+                offset = offset + len(buffer)
+                if buffer.strip() != b"": yield buffer.decode("utf-8"), offset
+                return
+
+def read_batches(path, delimiter, batch_size, start_offset=0):
+    batch = []
+    for text, offset in read_items(path, delimiter, start_offset):
+        batch.append(text)
+        if len(batch) >= batch_size:
+            yield batch, offset
+            batch = []
+    if len(batch) > 0: yield batch, os.path.getsize(path)
+
+class Checkpoint():
+    # Progress of the load of one file into one tenant, saved after each written batch.
+    # It is only used again for the same file, i.e. a changed file is loaded from the start.
+    def __init__(self, path, data_file, delimiter, tenant_id):
+        stat = os.stat(data_file)
+        self.path = path
+        self.key = {"data_file": os.path.abspath(data_file), "size": stat.st_size, "mtime": int(stat.st_mtime), "delimiter": delimiter, "tenant_id": tenant_id}
+        self.state = {"offset": 0, "items_read": 0, "items_loaded": 0, "items_skipped": 0, "items_failed": 0}
+
+    def load(self):
+        if not os.path.exists(self.path): return
+        with open(self.path, "r") as f:
+            checkpoint = json.load(f)
+        if {k: checkpoint.get(k) for k in self.key} != self.key:
+            print(f"The checkpoint {self.path} is for another file or tenant, loading from the start")
+            return
+        self.state = {k: checkpoint[k] for k in self.state}
+        print(f"Resuming at byte {self.state['offset']} after {self.state['items_read']} items")
+
+    def save(self):
+        # Written to a temporary file first, so an interrupted write does not corrupt the checkpoint
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump({**self.key, **self.state, "updated_at": time.time()}, f)
+        os.replace(temp_path, self.path)
+
+class Progress():
+    def __init__(self, total_bytes, start_offset):
+        self.total_bytes = max(1, total_bytes)
+        self.start_offset = start_offset
+        self.started_at = time.monotonic()
+        self.items = 0
+
+    def update(self, offset, items):
+        self.items = self.items + items
+        elapsed = max(0.001, time.monotonic() - self.started_at)
+        fraction = offset / self.total_bytes
+        bytes_per_second = (offset - self.start_offset) / elapsed
+        eta = (self.total_bytes - offset) / bytes_per_second if bytes_per_second > 0 else 0
+        bar = "#" * int(fraction * 30)
+        sys.stderr.write(f"\r[{bar:<30}] {fraction:6.1%} {self.items} items {self.items / elapsed:,.1f} items/s ETA {format_duration(eta)}")
+        sys.stderr.flush()
+
+    def finish(self):
+        sys.stderr.write("\n")
+        sys.stderr.flush()
+
+class CatalogWriter():
+    def __init__(self, connect, storage_layout, ingest_mode, tenant_id):
+        self.connect = connect
+        self.query = WRITE_QUERIES["staged" if ingest_mode == "staged" else storage_layout]
+        self.tenant_id = tenant_id
+        self.conn = None
+
+    def open(self):
+        self.conn = self.connect()
+        cur = self.conn.cursor()
+        # Emptied at the end of each transaction, i.e. of each batch
+        cur.execute("CREATE TEMP TABLE load_items (description text, content_hash char(64)) ON COMMIT DELETE ROWS;")
+        cur.execute("CREATE TEMP TABLE load_vectors (content_hash char(64), chunk_index int, embedding vector) ON COMMIT DELETE ROWS;")
+        cur.close()
+        self.conn.commit()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def write(self, texts, content_hashes, embeddings):
+        # Returns the number of items inserted. The embeddings of the chunked layout are lists of chunk embeddings.
+        items = io.StringIO()
+        vectors = io.StringIO()
+        for text, content_hash, embedding in zip(texts, content_hashes, embeddings):
+            items.write(f"{copy_value(text)}\t{content_hash}\n")
+            chunk_embeddings = embedding if isinstance(embedding[0], list) else [embedding]
+            for chunk_index, chunk_embedding in enumerate(chunk_embeddings):
+                vectors.write(f"{content_hash}\t{chunk_index}\t{format_vector(chunk_embedding)}\n")
+        items.seek(0)
+        vectors.seek(0)
+
+        cur = self.conn.cursor()
+        try:
+            cur.copy_expert("COPY load_items (description, content_hash) FROM STDIN", items)
+            cur.copy_expert("COPY load_vectors (content_hash, chunk_index, embedding) FROM STDIN", vectors)
+            cur.execute(self.query, {"tenant": self.tenant_id})
+            inserted = cur.fetchone()[0] if cur.description is not None else cur.rowcount
+            self.conn.commit()
+            return inserted
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+
+def get_settings(args):
+    # The options override the settings of the deployment
+    deployment = {}
+    if os.path.exists(args.deployment_output):
+        with open(args.deployment_output, "r") as f:
+            deployment = json.load(f).get("RecommenderStack", {})
+
+    def setting(value, key, default=None):
+        if value is not None: return value
+        return deployment.get(key, default)
+
+    settings = {
+        "host": setting(args.host, "dbwriterendpoint"),
+        "bastion_asg": deployment.get("bastionhostasgname", ""),
+        "model_id": setting(args.model_id, "embeddingmodelid", DEFAULT_MODEL_ID),
+        "dimension": setting(args.dimension, "embeddingdimension"),
+        "normalize": args.normalize if args.normalize is not None else deployment.get("normalizeembeddings") == "true",
+        "distance_metric": deployment.get("distancemetric", "l2"),
+        "storage_layout": setting(args.storage_layout, "storagelayout", STORAGE_LAYOUT_SINGLE),
+        "ingest_mode": setting(args.ingest_mode, "ingestmode", "direct")
+    }
+    if settings["dimension"] is not None: settings["dimension"] = int(settings["dimension"])
+    if settings["storage_layout"] not in STORAGE_LAYOUTS: raise Exception(f"Invalid storage layout: {settings['storage_layout']}. Valid layouts are {STORAGE_LAYOUTS}")
+    if settings["ingest_mode"] not in INGEST_MODES: raise Exception(f"Invalid ingest mode: {settings['ingest_mode']}. Valid modes are {INGEST_MODES}")
+    if settings["ingest_mode"] == "staged" and settings["storage_layout"] == STORAGE_LAYOUT_CHUNKED: raise Exception("The staged ingest mode is not supported with the chunked storage layout")
+    return settings
+
+def apply_catalog_settings(args, settings, conn):
+    # After a catalog rebuild swap, the stored vectors are of the model and dimension of the rebuild, which the deployment output does not know.
+    # They are read from the database like the data loading Lambda functions do, and an option which contradicts them is an error.
+    catalog_settings = get_catalog_settings(conn, settings["model_id"], settings["dimension"], settings["normalize"], settings["distance_metric"])
+    if "rebuild_id" not in catalog_settings: return settings
+    for key, option in [("model_id", args.model_id), ("dimension", args.dimension), ("normalize", args.normalize)]:
+        if option is not None and option != catalog_settings[key]:
+            raise Exception(f"The {key} {option} of the options does not match the {key} {catalog_settings[key]} of the catalog since the catalog rebuild {catalog_settings['rebuild_id']}")
+    print(f"Embedding with {catalog_settings['model_id']}, dimension {catalog_settings['dimension']}, normalize {catalog_settings['normalize']}, of the catalog rebuild {catalog_settings['rebuild_id']}")
+    return {**settings, **{key: catalog_settings[key] for key in ["model_id", "dimension", "normalize", "distance_metric"]}}
+
+def get_embedding_client(args, settings):
+    embedding_client = EmbeddingClient(model_id=settings["model_id"], dimension=settings["dimension"], max_concurrency=args.concurrency,
+                                       max_requests_per_second=args.max_requests_per_second, normalize=settings["normalize"])
+    if settings["storage_layout"] == STORAGE_LAYOUT_CHUNKED:
+        embedding_client = ChunkedEmbeddingClient(embedding_client, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+    return embedding_client
+
+def get_connect(args, settings):
+    # Returns a function which opens a new connection to the writer, through the bastion host if asked
+    import boto3
+
+    if os.environ.get("PGPASSWORD"):
+        credentials = {"user": os.environ.get("PGUSER", "postgres"), "password": os.environ["PGPASSWORD"]}
+    else:
+        secrets_manager = boto3.client("secretsmanager")
+        secret = json.loads(secrets_manager.get_secret_value(SecretId=args.secret_id)["SecretString"])
+        credentials = {"user": secret["username"], "password": secret["password"]}
+
+    if settings["host"] is None: raise Exception("The database host is not in the deployment output, set it with --host")
+
+    if not args.via_bastion:
+        return lambda: psycopg2.connect(host=settings["host"], port=args.port, database=args.database, **credentials)
+
+    from helper.bastion import find_instances
+    from helper.ssm_tunnel import SSMTunnel
+    bastion_id = find_instances(settings["bastion_asg"]) if settings["bastion_asg"] != "" else None
+    if bastion_id is None: raise Exception("No bastion host is deployed")
+    tunnel = SSMTunnel(bastion_id, settings["host"], remote_port=args.port)
+    return lambda: tunnel.connect(database=args.database, **credentials)
+
+def dry_run(args, settings):
+    # Counts the items and embeds a sample of them without writing anything, to estimate the duration of the load.
+    # The database is not used, so the items already loaded are counted too.
+    started_at = time.monotonic()
+    items = 0
+    characters = 0
+    sample = []
+    for text, _ in read_items(args.data_file, args.delimiter):
+        items = items + 1
+        characters = characters + len(text)
+        if len(sample) < args.sample_size: sample.append(text)
+    parse_seconds = time.monotonic() - started_at
+    print(f"{items} items, {characters / max(1, items):,.0f} characters per item on average, parsed in {parse_seconds:.1f} s")
+    if items == 0: return
+
+    embedding_client = get_embedding_client(args, settings)
+    started_at = time.monotonic()
+    embeddings = embedding_client.embed_many(sample)
+    embed_seconds = max(0.001, time.monotonic() - started_at)
+    failures = [e for e in embeddings if isinstance(e, Exception)]
+    if len(failures) > 0: print(f"{len(failures)} of {len(sample)} sample items failed, e.g. {failures[0]}")
+
+    items_per_second = (len(sample) - len(failures)) / embed_seconds
+    stats = embedding_client.stats()
+    print(f"Embedded {len(sample)} sample items with {settings['model_id']} in {embed_seconds:.1f} s: {items_per_second:,.1f} items/s, "
+          f"{stats['successes']} requests, throttle rate {stats['throttle_rate']:.1%}, concurrency limit {stats['concurrency_limit']}")
+    if items_per_second > 0:
+        # The concurrency is still growing during a short sample, so the estimate is on the safe side
+        print(f"Estimated embedding time for {items} items: {format_duration(items / items_per_second)}. "
+              f"The writes run in parallel and are usually faster than the embedding.")
+
+def load(args, settings):
+    tenant_id = args.tenant
+    checkpoint = Checkpoint(args.checkpoint_file or f"{args.data_file}.{tenant_id}.checkpoint.json", args.data_file, args.delimiter, tenant_id)
+    if not args.restart: checkpoint.load()
+    failed_path = f"{args.data_file}.{tenant_id}.failed"
+
+    connect = get_connect(args, settings)
+    conn = connect()
+    try:
+        settings = apply_catalog_settings(args, settings, conn)
+    finally:
+        conn.close()
+    embedding_client = get_embedding_client(args, settings)
+    writer = CatalogWriter(connect, settings["storage_layout"], settings["ingest_mode"], tenant_id)
+    writer.open()
+
+    # Bounded queues between the stages, so that the parser does not read far ahead of the writes
+    parsed = queue.Queue(maxsize=args.queue_size)
+    embedded = queue.Queue(maxsize=args.queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def put(q, value):
+        while not stop.is_set():
+            try:
+                q.put(value, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def get(q):
+        # Returns None, like the end of the stage before, once a stage failed. The failed stage may not be able to queue its end,
+        # e.g. when the queue is full, so the next stages must not wait for it.
+        while not stop.is_set():
+            try:
+                return q.get(timeout=1)
+            except queue.Empty:
+                pass
+        return None
+
+    def parse():
+        try:
+            for batch, offset in read_batches(args.data_file, args.delimiter, args.batch_size, checkpoint.state["offset"]):
+                if stop.is_set(): return
+                put(parsed, (batch, offset))
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            put(parsed, None)
+
+    def embed():
+        # Only the items which are not in the database yet are embedded
+        conn = None
+        try:
+            conn = connect()
+            conn.autocommit = True
+            while not stop.is_set():
+                work = get(parsed)
+                if work is None: break
+                texts, offset = work
+                content_hashes = [get_content_hash(text) for text in texts]
+                existing_content_hashes = find_existing_content_hashes(conn, list(set(content_hashes)), tenant_id)
+                new_texts = []
+                new_content_hashes = []
+                for text, content_hash in zip(texts, content_hashes):
+                    if content_hash in existing_content_hashes: continue
+                    existing_content_hashes.add(content_hash)
+                    new_texts.append(text)
+                    new_content_hashes.append(content_hash)
+                embeddings = embedding_client.embed_many(new_texts) if len(new_texts) > 0 else []
+                put(embedded, (len(texts), new_texts, new_content_hashes, embeddings, offset))
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            if conn is not None: conn.close()
+            put(embedded, None)
+
+    threads = [threading.Thread(target=parse, daemon=True), threading.Thread(target=embed, daemon=True)]
+    for thread in threads: thread.start()
+
+    progress = Progress(checkpoint.key["size"], checkpoint.state["offset"])
+    try:
+        while True:
+            work = get(embedded)
+            if work is None: break
+            read, texts, content_hashes, embeddings, offset = work
+
+            rows = [(text, content_hash, embedding) for text, content_hash, embedding in zip(texts, content_hashes, embeddings) if not isinstance(embedding, Exception)]
+            failed = [text for text, embedding in zip(texts, embeddings) if isinstance(embedding, Exception)]
+            if len(failed) > 0:
+                # Kept in a file with the same delimiter, so that they can be loaded again with this loader
+                with open(failed_path, "a") as f:
+                    for text in failed: f.write(text + args.delimiter)
+                print(f"\n{len(failed)} items failed to embed, e.g. {next(e for e in embeddings if isinstance(e, Exception))}. They are in {failed_path}")
+
+            inserted = 0
+            if len(rows) > 0:
+                try:
+                    inserted = writer.write(*zip(*rows))
+                except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                    # The connection is lost, e.g. when the port forwarding session ended. Connect again and retry the batch once.
+                    print(f"\nReconnecting after: {e}")
+                    writer.close()
+                    writer.open()
+                    inserted = writer.write(*zip(*rows))
+
+            checkpoint.state["offset"] = offset
+            checkpoint.state["items_read"] += read
+            checkpoint.state["items_loaded"] += inserted
+            checkpoint.state["items_skipped"] += read - len(failed) - inserted
+            checkpoint.state["items_failed"] += len(failed)
+            checkpoint.save()
+            progress.update(offset, read)
+    except KeyboardInterrupt:
+        stop.set()
+        progress.finish()
+        print(f"Interrupted. Run the same command again to resume from {checkpoint.path}")
+        return
+    except Exception:
+        stop.set()
+        progress.finish()
+        raise
+    finally:
+        writer.close()
+
+    progress.finish()
+    if len(errors) > 0: raise errors[0]
+    state = checkpoint.state
+    print(f"Loaded {state['items_loaded']} items, skipped {state['items_skipped']} already loaded, {state['items_failed']} failed, of {state['items_read']} items in {args.data_file}")
+    print(embedding_client.stats())
+
+def main():
+    parser = argparse.ArgumentParser(description="Load a catalog file into the vector database")
+    parser.add_argument("data_file", help="The file of items, e.g. data/data.txt")
+    parser.add_argument("--delimiter", default="###", help="The delimiter of the items in the file")
+    parser.add_argument("--tenant", default=DEFAULT_TENANT, help="The tenant (catalog) to load the items into")
+    parser.add_argument("--deployment-output", default="./deployment-output.json", help="The deployment output file with the settings of the deployment")
+    parser.add_argument("--host", help="The writer endpoint of the database")
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--database", default="vectordb")
+    parser.add_argument("--secret-id", default="AuroraClusterCredentials", help="The secret with the database credentials, unless PGUSER and PGPASSWORD are set")
+    parser.add_argument("--via-bastion", action="store_true", help="Connect through a port forwarding session to the bastion host")
+    parser.add_argument("--model-id", help="The embedding model, e.g. local")
+    parser.add_argument("--dimension", type=int, help="The embedding dimension")
+    parser.add_argument("--normalize", action=argparse.BooleanOptionalAction, default=None, help="Unit-normalize the embeddings")
+    parser.add_argument("--storage-layout", choices=STORAGE_LAYOUTS)
+    parser.add_argument("--ingest-mode", choices=INGEST_MODES)
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument("--chunk-overlap", type=int, default=DEFAULT_CHUNK_OVERLAP)
+    parser.add_argument("--batch-size", type=int, default=500, help="The number of items per write")
+    parser.add_argument("--concurrency", type=int, default=32, help="The maximum number of concurrent embedding requests")
+    parser.add_argument("--max-requests-per-second", type=float, help="Cap of the embedding request rate, e.g. the account quota of the model")
+    parser.add_argument("--queue-size", type=int, default=4, help="The number of batches buffered between the stages")
+    parser.add_argument("--checkpoint-file", help="Defaults to <data file>.<tenant>.checkpoint.json")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and load from the start")
+    parser.add_argument("--dry-run", action="store_true", help="Parse the file and embed a sample to estimate the load time, without writing")
+    parser.add_argument("--sample-size", type=int, default=200, help="The number of items embedded by the dry run")
+    args = parser.parse_args()
+
+    validate_tenant_id(args.tenant)
+    settings = get_settings(args)
+    print(f"Loading {args.data_file} into tenant {args.tenant} with {settings['model_id']}, {settings['storage_layout']} storage layout, {settings['ingest_mode']} ingest mode")
+    if args.dry_run:
+        dry_run(args, settings)
+    else:
+        load(args, settings)
+
+if __name__ == "__main__":
+    main()
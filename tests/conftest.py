@@ -0,0 +1,6 @@
+import os, sys
+
+# The lambda functions import their modules and the helper layer as top-level modules, as in the deployed package
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in [ROOT, os.path.join(ROOT, "lib", "api", "data_loading_lambda"), os.path.join(ROOT, "lib", "api", "inference_lambda")]:
+    if path not in sys.path: sys.path.insert(0, path)
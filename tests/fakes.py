@@ -0,0 +1,19 @@
+class FakeDatabase():
+    # Stands in for database.Database, keeping the inserted rows of each tenant in memory with their content hashes
+    def __init__(self, fail_texts=[]):
+        self.conn = None
+        self.rows = {}
+        self.fail_texts = set(fail_texts)
+        self.batch_inserts = 0
+
+    def find_existing_content_hashes(self, content_hashes, tenant_id):
+        return set(content_hash for _, _, _, content_hash in self.rows.get(tenant_id, []) if content_hash in content_hashes)
+
+    def insert_vectors(self, query_template, rows, tenant_id):
+        self.batch_inserts = self.batch_inserts + 1
+        if any(text in self.fail_texts for text, _, _, _ in rows): raise Exception("Batch insert failed")
+        self.rows.setdefault(tenant_id, []).extend(rows)
+
+    def insert_vector(self, query_template, text, embedding, additional_query_parameters=[], content_hash=None, tenant_id=None):
+        if text in self.fail_texts: raise Exception(f"Could not insert {text}")
+        self.rows.setdefault(tenant_id, []).append((text, embedding, additional_query_parameters, content_hash))
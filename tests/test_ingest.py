@@ -0,0 +1,42 @@
+from helper.embedding_client import EmbeddingClient
+from helper.tenant import DEFAULT_TENANT
+from ingest import ingest_items
+from fakes import FakeDatabase
+
+QUERY_TEMPLATE = "INSERT INTO items (description, embedding, content_hash) VALUES (%s, %s, {content_hash});"
+
+def test_ingest_items_with_the_local_embedding_model():
+    db = FakeDatabase()
+    embedding_client = EmbeddingClient(model_id="local", dimension=16)
+    items = [{"text": "red shoes"}, {"text": "blue shirt"}, {"text": "red shoes"}, {"text": "green hat"}]
+
+    results = ingest_items(db, embedding_client, QUERY_TEMPLATE, items, batch_size=2)
+
+    assert [r['index'] for r in results] == [0, 1, 2, 3]
+    assert [r['status'] for r in results] == ["succeeded", "succeeded", "skipped", "succeeded"]
+    rows = db.rows[DEFAULT_TENANT]
+    assert [text for text, _, _, _ in rows] == ["red shoes", "blue shirt", "green hat"]
+    assert all(len(embedding) == 16 for _, embedding, _, _ in rows)
+    # The local model is deterministic, so the same text always gets the same embedding
+    assert rows[0][1] == EmbeddingClient(model_id="local", dimension=16).embed("red shoes")
+
+def test_ingest_items_skips_the_content_already_in_the_catalog_of_the_tenant():
+    db = FakeDatabase()
+    embedding_client = EmbeddingClient(model_id="local", dimension=16)
+    ingest_items(db, embedding_client, QUERY_TEMPLATE, [{"text": "red shoes"}], tenant_id="brand_a")
+
+    results = ingest_items(db, embedding_client, QUERY_TEMPLATE, [{"text": "red shoes"}, {"text": "blue shirt"}], tenant_id="brand_a")
+    other_results = ingest_items(db, embedding_client, QUERY_TEMPLATE, [{"text": "red shoes"}], tenant_id="brand_b")
+
+    assert [r['status'] for r in results] == ["skipped", "succeeded"]
+    assert [r['status'] for r in other_results] == ["succeeded"]
+
+def test_ingest_items_retries_a_failed_batch_row_by_row():
+    db = FakeDatabase(fail_texts=["blue shirt"])
+    embedding_client = EmbeddingClient(model_id="local", dimension=16)
+
+    results = ingest_items(db, embedding_client, QUERY_TEMPLATE, [{"text": "red shoes"}, {"text": "blue shirt"}, {"text": "green hat"}])
+
+    assert [r['status'] for r in results] == ["succeeded", "failed", "succeeded"]
+    assert results[1]['error'].startswith("Insert failed")
+    assert [text for text, _, _, _ in db.rows[DEFAULT_TENANT]] == ["red shoes", "green hat"]
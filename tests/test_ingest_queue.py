@@ -0,0 +1,55 @@
+import json
+import ingest_queue
+from helper.embedding_client import EmbeddingClient
+from ingest_queue import SQLiteIngestQueue, enqueue_job, drain_queue
+from fakes import FakeDatabase
+
+QUERY_TEMPLATE = "INSERT INTO items (description, embedding, content_hash) VALUES (%s, %s, {content_hash});"
+
+def test_enqueue_job_and_consume_messages_with_the_sqlite_queue(tmp_path, monkeypatch):
+    # Small parts, so the job is split into several messages like a large request
+    monkeypatch.setattr(ingest_queue, "MAX_MESSAGE_SIZE", 60)
+    queue = SQLiteIngestQueue(str(tmp_path / "queue.db"))
+    items = [{"text": f"item {i}"} for i in range(7)] + [{"text": "item 2"}]
+    job_id, parts = enqueue_job(queue, items, tenant_id="brand_a")
+    assert parts > 1
+    assert queue.depth() == parts
+
+    saved = {}
+    def save_job_results(job, job_results):
+        saved[(job['job_id'], job['part'])] = job_results
+
+    db = FakeDatabase()
+    drain_queue(queue, db, EmbeddingClient(model_id="local", dimension=8), QUERY_TEMPLATE, max_messages=2, save_job_results=save_job_results)
+
+    assert queue.depth() == 0
+    assert sorted(saved.keys()) == [(job_id, part) for part in range(parts)]
+    # The results are mapped back to the index of each item in the original request
+    results = sorted([r for job_results in saved.values() for r in job_results], key=lambda r: r['index'])
+    assert [r['index'] for r in results] == list(range(len(items)))
+    assert [r['status'] for r in results] == ["succeeded"] * 7 + ["skipped"]
+    assert len(db.rows["brand_a"]) == 7
+
+def test_sqlite_queue_delivers_an_undeleted_message_again_after_the_visibility_timeout(tmp_path):
+    queue = SQLiteIngestQueue(str(tmp_path / "queue.db"), visibility_timeout=0)
+    queue.send(json.dumps({"job_id": "1"}))
+
+    first = queue.receive()
+    second = queue.receive()
+    assert len(first) == 1
+    assert [m['id'] for m in second] == [first[0]['id']]
+
+    queue.delete(second[0])
+    assert queue.depth() == 0
+    assert queue.receive() == []
+
+def test_drain_queue_keeps_the_messages_which_failed(tmp_path):
+    queue = SQLiteIngestQueue(str(tmp_path / "queue.db"), visibility_timeout=300)
+    enqueue_job(queue, [{"text": "red shoes"}])
+
+    class FailingDatabase(FakeDatabase):
+        def find_existing_content_hashes(self, content_hashes, tenant_id):
+            raise Exception("Database unavailable")
+
+    drain_queue(queue, FailingDatabase(), EmbeddingClient(model_id="local", dimension=8), QUERY_TEMPLATE)
+    assert queue.depth() == 1
@@ -0,0 +1,15 @@
+import json
+from helper.request_id import get_request_id, find_request_id, tag_reply
+
+def test_find_request_id_in_a_body_which_is_not_parsed():
+    body = json.dumps({"text": "x" * 1000, "request_id": "2f1c-7"})
+    assert find_request_id(body) == "2f1c-7"
+    assert find_request_id(body[:-1]) == "2f1c-7"
+    assert find_request_id('{"text": "a"}') is None
+    assert find_request_id('{"request_id": ""}') is None
+    assert find_request_id(None) is None
+
+def test_tag_reply():
+    assert json.loads(tag_reply("Event body is too large", 400, "1")) == {"message": "Event body is too large", "request_id": "1", "status_code": 400}
+    assert json.loads(tag_reply(json.dumps({"items": []}), 200, "1")) == {"items": [], "request_id": "1", "status_code": 200}
+    assert get_request_id({"request_id": "x" * 129}) is None
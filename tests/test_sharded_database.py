@@ -0,0 +1,47 @@
+import time
+import pytest
+from helper.tenant import DEFAULT_TENANT
+from sharded_database import ShardedDatabase
+
+class FakeShard():
+    # Stands in for the Database of one shard, returning fixed search results
+    def __init__(self, items=[], error=None, delay=0):
+        self.items = items
+        self.error = error
+        self.delay = delay
+        self.conn = None
+        self.searches = []
+
+    def search(self, query_template, embedding, num_items=1, additional_query_parameters=[], tenant_id=DEFAULT_TENANT, operator=None):
+        self.searches.append((num_items, tenant_id))
+        if self.delay > 0: time.sleep(self.delay)
+        if self.error is not None: raise self.error
+        return self.items[:num_items]
+
+def test_search_merges_the_top_k_of_all_shards():
+    shards = [FakeShard([{"id": 1, "distance": 0.1}, {"id": 2, "distance": 0.4}]),
+              FakeShard([{"id": 1, "distance": 0.2}, {"id": 2, "distance": 0.3}, {"id": 3, "distance": 0.5}])]
+    db = ShardedDatabase(shards)
+
+    results = db.search("SELECT ...", [0.0], num_items=3, tenant_id="brand_a")
+
+    assert [(r['shard'], r['id'], r['distance']) for r in results] == [(0, 1, 0.1), (1, 1, 0.2), (1, 2, 0.3)]
+    assert db.failed_shards == set()
+    # Each shard is asked for the whole top-k, as all of it may come from one shard
+    assert [shard.searches for shard in shards] == [[(3, "brand_a")], [(3, "brand_a")]]
+
+def test_search_reports_the_shards_which_failed():
+    shards = [FakeShard([{"id": 1, "distance": 0.3}]),
+              FakeShard(error=Exception("Connection refused")),
+              FakeShard([{"id": 1, "distance": 0.1}], delay=1)]
+    db = ShardedDatabase(shards, shard_timeout_ms=100)
+
+    results = db.search("SELECT ...", [0.0], num_items=2)
+
+    assert [(r['shard'], r['id']) for r in results] == [(0, 1)]
+    assert db.failed_shards == {1, 2}
+
+def test_search_fails_when_all_shards_failed():
+    db = ShardedDatabase([FakeShard(error=Exception("Connection refused"))])
+    with pytest.raises(Exception, match="The search failed on all shards"):
+        db.search("SELECT ...", [0.0])
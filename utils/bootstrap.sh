@@ -27,7 +27,7 @@ region=${region:-$default_region}
 export CDK_DEPLOY_REGION=$region
 echo $region > .DEFAULT_REGION
 
-zip -r notebooks.zip 01-load-data.ipynb 02-prompt-building-and-inference-test.ipynb 03-deploy-templates-and-parameters.ipynb 04-inference-and-data-loading-with-api.ipynb LICENSE CODE_OF_CONDUCT.md CONTRIBUTING.md README.md helper data assets
+zip -r notebooks.zip 01-load-data.ipynb 02-prompt-building-and-inference-test.ipynb 03-deploy-templates-and-parameters.ipynb 04-inference-and-data-loading-with-api.ipynb load_catalog.py LICENSE CODE_OF_CONDUCT.md CONTRIBUTING.md README.md helper data assets
 
 zip prompt_template.txt.zip prompt_template.txt
 zip vector_search_query.txt.zip vector_search_query.txt
@@ -33,7 +33,7 @@ default_environment="dev" # This is a default value
 read -p "What is the environment name? (default: dev) :" environment
 environment=${environment:-$default_environment} 
 
-zip -r notebooks.zip 01-load-data.ipynb 02-prompt-building-and-inference-test.ipynb 03-deploy-templates-and-parameters.ipynb 04-inference-and-data-loading-with-api.ipynb LICENSE CODE_OF_CONDUCT.md CONTRIBUTING.md README.md helper data assets
+zip -r notebooks.zip 01-load-data.ipynb 02-prompt-building-and-inference-test.ipynb 03-deploy-templates-and-parameters.ipynb 04-inference-and-data-loading-with-api.ipynb load_catalog.py LICENSE CODE_OF_CONDUCT.md CONTRIBUTING.md README.md helper data assets
 
 zip prompt_template.txt.zip prompt_template.txt
 zip vector_search_query.txt.zip vector_search_query.txt